@@ -1,6 +1,120 @@
+import copy
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import re
+import threading
+import time
+from multiprocessing.util import Finalize
+
+MESSAGE_TYPE = re.compile(r"[A-Za-z_]+")
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps 1 in N records of a message type, or at most N of them per second. The type of a record is the word
+    its message starts with, such as calculated_coordinates, and types without a rule are all kept. The counts
+    are shared by every thread that logs, such as the detector workers, under a lock.
+    """
+    def __init__(self, rules: dict):
+        """
+        Args:
+            rules (dict): message type -> (N, per_second), see parse_sampling.
+        """
+        super().__init__()
+        self.rules = rules
+        self._seen = {}  # message type -> records seen, or [second, records kept in it] for a rate limit
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        match = MESSAGE_TYPE.match(str(record.msg))
+        rule = self.rules.get(match.group() if match else None)
+        if rule is None:
+            return True
+        limit, per_second = rule
+        message_type = match.group()
+        with self._lock:
+            if per_second:
+                second = int(time.monotonic())
+                window = self._seen.get(message_type)
+                if window is None or window[0] != second:
+                    window = self._seen[message_type] = [second, 0]
+                window[1] += 1
+                return window[1] <= limit
+            seen = self._seen.get(message_type, 0)
+            self._seen[message_type] = seen + 1
+            return seen % limit == 0
+
+def parse_sampling(spec: str) -> dict:
+    """
+    Parse sampling rules such as "calculated_coordinates=10,received_coordinates=5/s": keep 1 in 10 of the
+    first type and at most 5 per second of the second.
+
+    Returns:
+        dict: message type -> (N, per_second).
+
+    Raises:
+        ValueError: If a rule is malformed.
+    """
+    rules = {}
+    for rule in filter(None, (part.strip() for part in (spec or "").split(","))):
+        message_type, _, limit = rule.partition("=")
+        per_second = limit.endswith("/s")
+        try:
+            limit = int(limit[:-2] if per_second else limit)
+        except ValueError:
+            raise ValueError("log sampling rule {!r} is not type=N or type=N/s".format(rule))
+        if limit < 1:
+            raise ValueError("log sampling rule {!r} must keep at least 1".format(rule))
+        rules[message_type.strip()] = (limit, per_second)
+    return rules
+
+class JsonFormatter(logging.Formatter):
+    """
+    One compact JSON object per line: time, level, logger, message type and message.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        match = MESSAGE_TYPE.match(message)
+        entry = {"t": round(record.created, 6), "level": record.levelname, "logger": record.name,
+                 "type": match.group() if match else None, "msg": message}
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"))
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the listener thread with their message merged with its arguments, so an argument changed
+    after the log call, such as a list or an array, is logged as it was. The standard QueueHandler also formats
+    the whole line in the calling thread and drops the exception info, the listener's own formatters are left
+    to do that here, so the JSON format still gets the traceback as a field.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def setup_logging(name, filepath, asynchronous: bool = None, sampling: str = None, structured: bool = None):
+    """
+    Create a logger that writes to the console and to filepath.
+
+    Args:
+        name: Name of the logger.
+        filepath: The log file.
+        asynchronous (bool, optional): Write on a listener thread, a log call only puts the record on a queue.
+            Defaults to the env LOG_ASYNC, on unless it is 0.
+        sampling (str, optional): Sampling rules of per-frame messages, see parse_sampling. Defaults to the env LOG_SAMPLING.
+        structured (bool, optional): Write JSON lines instead of text. Defaults to the env LOG_FORMAT=json.
+    """
+    if asynchronous is None:
+        asynchronous = os.environ.get("LOG_ASYNC", "1") != "0"
+    if sampling is None:
+        sampling = os.environ.get("LOG_SAMPLING")
+    if structured is None:
+        structured = os.environ.get("LOG_FORMAT") == "json"
 
-def setup_logging(name,filepath):
     # Create the logger
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
@@ -14,16 +128,31 @@ def setup_logging(name,filepath):
     file_handler.setLevel(logging.DEBUG)
 
     # Create a formatter for the log messages
-    formatter = logging.Formatter(
-        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-    )
+    if structured:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+        )
 
     # Add the formatter to the handlers
     console_handler.setFormatter(formatter)
     file_handler.setFormatter(formatter)
 
+    handlers = [console_handler, file_handler]
+    if asynchronous:
+        records = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+        listener.start()
+        # flush the queue when the program, or the multiprocessing.Process that set this up, exits
+        Finalize(None, listener.stop, exitpriority=0)
+        handlers = [DeferredQueueHandler(records)]
+
     # Add the handlers to the logger
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
+    rules = parse_sampling(sampling)
+    for handler in handlers:
+        if rules:
+            handler.addFilter(SamplingFilter(rules))
+        logger.addHandler(handler)
 
     return logger
@@ -0,0 +1,138 @@
+import time
+from collections import OrderedDict
+
+REPORT_INTERVAL = 1.0  # seconds between two load reports the server asks the client for
+SEQUENCE_FPS = 30  # frame rate of the sequence, sent with a stride of 1
+SCALES = (1.0, 0.75, 0.5)  # render sizes relative to the sequence, tried in this order
+# a report above either high mark counts as overloaded, one below both low marks as having spare capacity
+HIGH_DROP_RATE = 0.2
+LOW_DROP_RATE = 0.05
+HIGH_LAG_MS = 150
+LOW_LAG_MS = 50
+
+class LoadMonitor:
+    """
+    Measures how well the client keeps up with the stream, for the load reports it sends to the server.
+
+    The lag is the mean time from receiving a frame to sending its result, in milliseconds, and the drop rate
+    the share of received frames the frame ring dropped since the last report. Both are independent of the
+    frame rate, so a client that keeps up at a lower one is seen to have spare capacity.
+    """
+    def __init__(self, read_dropped, history_size: int = 300):
+        """
+        Args:
+            read_dropped: Called with no arguments, returns the number of frames dropped so far.
+            history_size (int, optional): Received frames to remember the time of. Defaults to 300.
+        """
+        self.read_dropped = read_dropped
+        self.received = OrderedDict()  # pts -> time it was received, of the last history_size frames
+        self.history_size = history_size
+        self.frames = 0
+        self._lag_total = 0.0
+        self._lag_count = 0
+        self._reported_frames = 0
+        self._reported_dropped = 0
+
+    def on_frame(self, pts: int):
+        self.frames += 1
+        self.received[pts] = time.monotonic()
+        if len(self.received) > self.history_size:
+            self.received.popitem(last=False)
+
+    def on_sent(self, pts: int):
+        """
+        Called with the pts of the frame a result was detected in, not the frame it was predicted for.
+        """
+        received = self.received.get(pts)
+        if received is not None:
+            self._lag_total += time.monotonic() - received
+            self._lag_count += 1
+
+    def report(self) -> tuple:
+        """
+        Returns:
+            tuple: (lag in milliseconds, drop rate) since the previous report.
+        """
+        dropped = self.read_dropped()
+        frames = self.frames - self._reported_frames
+        drop_rate = (dropped - self._reported_dropped) / frames if frames else 0.0
+        if self._lag_count:
+            lag_ms = self._lag_total / self._lag_count * 1000
+        elif frames:
+            # frames arrived but no result was sent for any of them, detection is stuck
+            lag_ms = REPORT_INTERVAL * 1000
+        else:
+            lag_ms = 0.0
+        self._reported_frames, self._reported_dropped = self.frames, dropped
+        self._lag_total, self._lag_count = 0.0, 0
+        return lag_ms, min(drop_rate, 1.0)
+
+class RateController:
+    """
+    Picks the frame rate and render size of the stream from the client's load reports, with hysteresis.
+
+    The levels go from the full frame rate at full size, through lower frame rates down to min_fps, to smaller
+    sizes down to min_scale. The stream steps one level lighter after overload_reports overloaded reports in a
+    row, and one level back after underload_reports reports with spare capacity in a row, which is slower on
+    purpose so that a client at its limit doesn't flap between two levels.
+    """
+    def __init__(self, min_fps: float = 10, max_fps: float = SEQUENCE_FPS, min_scale: float = 0.5, overload_reports: int = 2, underload_reports: int = 5):
+        """
+        Args:
+            min_fps (float, optional): Lowest frame rate. Defaults to 10.
+            max_fps (float, optional): Highest frame rate, at most SEQUENCE_FPS. Defaults to SEQUENCE_FPS.
+            min_scale (float, optional): Smallest render size relative to the sequence. Defaults to 0.5.
+            overload_reports (int, optional): Overloaded reports in a row before stepping down. Defaults to 2.
+            underload_reports (int, optional): Reports with spare capacity in a row before stepping up. Defaults to 5.
+
+        Raises:
+            ValueError: If no frame rate of the sequence is within the bounds.
+        """
+        # a lower frame rate sends every stride-th frame of the sequence
+        strides = [stride for stride in range(1, SEQUENCE_FPS + 1) if min_fps <= SEQUENCE_FPS / stride <= max_fps]
+        if not strides:
+            raise ValueError("no frame rate of {} / n between {} and {} fps".format(SEQUENCE_FPS, min_fps, max_fps))
+        self.levels = [(stride, 1.0) for stride in strides]
+        self.levels += [(strides[-1], scale) for scale in SCALES[1:] if scale >= min_scale]
+        self.level = 0
+        self.overload_reports = overload_reports
+        self.underload_reports = underload_reports
+        self._overloaded = 0
+        self._underloaded = 0
+
+    @property
+    def stride(self) -> int:
+        return self.levels[self.level][0]
+
+    @property
+    def scale(self) -> float:
+        return self.levels[self.level][1]
+
+    @property
+    def fps(self) -> float:
+        return SEQUENCE_FPS / self.stride
+
+    def update(self, lag_ms: float, drop_rate: float) -> bool:
+        """
+        Add a load report of the client.
+
+        Returns:
+            bool: True if the level changed.
+        """
+        if drop_rate > HIGH_DROP_RATE or lag_ms > HIGH_LAG_MS:
+            self._overloaded, self._underloaded = self._overloaded + 1, 0
+        elif drop_rate < LOW_DROP_RATE and lag_ms < LOW_LAG_MS:
+            self._overloaded, self._underloaded = 0, self._underloaded + 1
+        else:
+            self._overloaded = self._underloaded = 0
+        level = self.level
+        if self._overloaded >= self.overload_reports:
+            level = min(level + 1, len(self.levels) - 1)
+        elif self._underloaded >= self.underload_reports:
+            level = max(level - 1, 0)
+        if level == self.level:
+            return False
+        # the next reports still describe the old level, start counting again
+        self.level = level
+        self._overloaded = self._underloaded = 0
+        return True
@@ -0,0 +1,499 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import queue
+import select
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from aiortc import RTCPeerConnection
+from aiortc.contrib.media import MediaBlackhole
+from aiortc.contrib.signaling import TcpSocketSignaling
+from multiprocessing import Event, Process, Queue, Value
+from frame_ring import FrameRing
+from ball_bouncing import BouncingBallVideoStreamTrack
+from client import create_detector, process_a, DETECTORS, MAX_OBJECTS
+from coordinate_record import CoordinateRecord
+from detector import MultiBallTracker, luma_plane
+from protocol import encode_json, encode_batch, decode_batch
+
+RESOLUTIONS = {"480p": (640, 480), "720p": (1280, 720), "1080p": (1920, 1080)}
+TRANSPORTS = ("queue", "frame_ring", "thread")
+RESULT_TIMEOUT = 10  # seconds to wait for the coordinates of one frame before giving up on a run
+
+def _consume_frames(transport, num_of_frames: int, ready: Event):
+    """
+    Consumer side of benchmark_transport, takes num_of_frames images off the transport.
+    """
+    ready.set()
+    for _ in range(num_of_frames):
+        image = transport.get()
+        image[0, 0]
+    if isinstance(transport, FrameRing):
+        transport.release()
+
+def benchmark_transport(transport, width: int, height: int, num_of_frames: int = 300) -> dict:
+    """
+    Measure how fast frames of the given size can be handed from this process to another one.
+
+    Args:
+        transport: A multiprocessing Queue or a FrameRing.
+        width (int): Width of the frames.
+        height (int): Height of the frames.
+        num_of_frames (int, optional): Number of frames to send. Defaults to 300.
+
+    Returns:
+        dict: frames per second and megabytes per second through the transport.
+    """
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    ready = Event()
+    consumer = Process(target=_consume_frames, args=(transport, num_of_frames, ready))
+    consumer.start()
+    ready.wait()
+    start = time.perf_counter()
+    for _ in range(num_of_frames):
+        transport.put(image)
+    consumer.join()
+    elapsed = time.perf_counter() - start
+    return {
+        "fps": num_of_frames / elapsed,
+        "mb_per_sec": num_of_frames * image.nbytes / elapsed / 1e6,
+    }
+
+def run_transport_benchmarks(num_of_frames: int = 300):
+    """
+    Compare the multiprocessing Queue against the shared memory FrameRing at 480p, 720p and 1080p.
+    """
+    for name, (width, height) in RESOLUTIONS.items():
+        result = benchmark_transport(Queue(), width, height, num_of_frames)
+        print("transport=queue resolution={} fps={:.1f} MB/s={:.1f}".format(name, result["fps"], result["mb_per_sec"]))
+        ring = FrameRing(width, height, policy="bounded")
+        try:
+            result = benchmark_transport(ring, width, height, num_of_frames)
+        finally:
+            ring.close()
+        print("transport=frame_ring resolution={} fps={:.1f} MB/s={:.1f}".format(name, result["fps"], result["mb_per_sec"]))
+
+def benchmark_detector(detector: str, frames: list, luma: bool = False) -> dict:
+    """
+    Measure the time a detector takes per frame over a sequence of decoded frames, including the conversion
+    of each frame into the detector's input.
+
+    Args:
+        detector (str): Name of the detector, see client.create_detector.
+        frames (list): The yuv420p VideoFrames of the sequence, in order.
+        luma (bool, optional): Detect on the luma plane instead of a BGR image. Defaults to False.
+
+    Returns:
+        dict: mean milliseconds per frame and frames per second.
+    """
+    detect = create_detector(detector)
+    start = time.perf_counter()
+    for frame in frames:
+        detect(luma_plane(frame) if luma else frame.to_ndarray(format="bgr24"))
+    elapsed = time.perf_counter() - start
+    return {
+        "ms_per_frame": elapsed * 1000 / len(frames),
+        "fps": len(frames) / elapsed,
+    }
+
+def run_detector_benchmarks(num_of_frames: int = 300):
+    """
+    Compare the detectors, on BGR images and on the luma plane, on bouncing ball sequences at 480p, 720p and 1080p.
+    """
+    for name, (width, height) in RESOLUTIONS.items():
+        bouncing_ball = BouncingBallVideoStreamTrack(width, height, num_of_frames)
+        # the client receives yuv420p frames from the decoder
+        frames = [frame.reformat(format="yuv420p") for frame in bouncing_ball.frames]
+        baseline = None
+        for detector in DETECTORS:
+            for luma in (False, True):
+                result = benchmark_detector(detector, frames, luma)
+                baseline = baseline or result["ms_per_frame"]
+                print("detector={} input={} resolution={} ms/frame={:.3f} fps={:.1f} speedup={:.1f}x".format(
+                    detector, "luma" if luma else "bgr24", name, result["ms_per_frame"], result["fps"], baseline / result["ms_per_frame"]))
+
+def benchmark_tracker(frames: list) -> dict:
+    """
+    Measure the time the multi detector takes to find and identify every ball in a frame.
+
+    Args:
+        frames (list): The yuv420p VideoFrames of the sequence, in order.
+
+    Returns:
+        dict: mean milliseconds per frame, frames per second and mean number of objects found per frame.
+    """
+    tracker = MultiBallTracker()
+    num_of_objects = 0
+    start = time.perf_counter()
+    for frame in frames:
+        num_of_objects += len(tracker.find(luma_plane(frame)))
+    elapsed = time.perf_counter() - start
+    return {
+        "ms_per_frame": elapsed * 1000 / len(frames),
+        "fps": len(frames) / elapsed,
+        "objects_per_frame": num_of_objects / len(frames),
+    }
+
+def run_tracker_benchmarks(num_of_frames: int = 300):
+    """
+    Time the multi detector on 10, 100 and 300 balls at 720p and 1080p.
+    """
+    for name in ("720p", "1080p"):
+        width, height = RESOLUTIONS[name]
+        for num_of_balls in (10, 100, 300):
+            bouncing_ball = BouncingBallVideoStreamTrack(width, height, num_of_frames, radius=8, num_of_balls=num_of_balls)
+            frames = []
+            for index in range(num_of_frames):
+                # render() draws into the buffer of the current counter
+                bouncing_ball.counter = index
+                frames.append(bouncing_ball.frame_at(index)[0].reformat(format="yuv420p"))
+            result = benchmark_tracker(frames)
+            print("tracker resolution={} balls={} ms/frame={:.3f} fps={:.1f} objects/frame={:.1f}".format(
+                name, num_of_balls, result["ms_per_frame"], result["fps"], result["objects_per_frame"]))
+
+def benchmark_protocol(protocol: str, batch_size: int, num_of_frames: int) -> dict:
+    """
+    Measure the cost of encoding and decoding the coordinates of num_of_frames frames.
+
+    Args:
+        protocol (str): "json" (one message per frame) or "binary".
+        batch_size (int): Frames per binary message.
+        num_of_frames (int): Number of frames.
+
+    Returns:
+        dict: encode and decode microseconds per frame, and bytes on the wire per frame.
+    """
+    frames = [(pts * 3000, [(pts % 640, pts % 480)]) for pts in range(num_of_frames)]
+    start = time.perf_counter()
+    if protocol == "json":
+        messages = [encode_json(pts, *points[0]) for pts, points in frames]
+    else:
+        messages = [encode_batch(frames[i:i + batch_size]) for i in range(0, num_of_frames, batch_size)]
+    encoded = time.perf_counter()
+    for message in messages:
+        json.loads(message) if protocol == "json" else decode_batch(message)
+    decoded = time.perf_counter()
+    return {
+        "encode_us_per_frame": (encoded - start) * 1e6 / num_of_frames,
+        "decode_us_per_frame": (decoded - encoded) * 1e6 / num_of_frames,
+        "bytes_per_frame": sum(len(message) for message in messages) / num_of_frames,
+        "messages": len(messages),
+    }
+
+def run_protocol_benchmarks(num_of_frames: int = 300):
+    """
+    Compare the JSON coordinate messages with binary batches of 1, 10 and 30 frames.
+    """
+    # encoding is too fast to time on a few hundred frames
+    num_of_frames *= 100
+    for protocol, batch_size in (("json", 1), ("binary", 1), ("binary", 10), ("binary", 30)):
+        result = benchmark_protocol(protocol, batch_size, num_of_frames)
+        print("protocol={} batch={} encode_us/frame={:.2f} decode_us/frame={:.2f} bytes/frame={:.1f} messages={}".format(
+            protocol, batch_size, result["encode_us_per_frame"], result["decode_us_per_frame"], result["bytes_per_frame"], result["messages"]))
+
+def _peak_rss_mb(pid: int) -> float:
+    """
+    Returns:
+        float: The peak resident memory in MB of a process since it started or since _reset_peak_rss.
+    """
+    with open("/proc/{}/status".format(pid)) as file:
+        return next(int(line.split()[1]) for line in file if line.startswith("VmHWM:")) / 1024
+
+def _reset_peak_rss(pid: int):
+    """
+    Reset the peak resident memory of a process to its current resident memory, where the kernel allows it.
+    """
+    try:
+        with open("/proc/{}/clear_refs".format(pid), "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+def _pipeline_images(width: int, height: int, num_of_frames: int, radius: int, num_of_balls: int):
+    """
+    The luma planes of a bouncing ball sequence, drawn one at a time so a 1080p run needs no more memory than a
+    480p one.
+    """
+    bouncing_ball = BouncingBallVideoStreamTrack(width, height, num_of_frames, radius, lazy=True, num_of_balls=num_of_balls)
+    for index in range(num_of_frames):
+        # render() draws into the buffer of the current counter
+        bouncing_ball.counter = index
+        yield np.ascontiguousarray(luma_plane(bouncing_ball.frame_at(index)[0].reformat(format="yuv420p")))
+
+def benchmark_pipeline(detector: str, transport: str, width: int, height: int, num_of_frames: int = 300, radius: int = 10, num_of_balls: int = 1) -> dict:
+    """
+    Measure the client's detection pipeline without the network: frames are handed to client.process_a over the
+    given transport and its coordinates come back through a CoordinateRecord, as in the client.
+
+    One frame is in flight at a time, so the latency of a frame is the time from putting it on the transport to
+    receiving its coordinates, without any queueing behind other frames.
+
+    Args:
+        detector (str): Name of the detector, see client.create_detector.
+        transport (str): "queue" (multiprocessing Queue), "frame_ring" (shared memory FrameRing) or "thread"
+            (queue.Queue to process_a running on a thread of this process).
+        width (int): Width of the frames.
+        height (int): Height of the frames.
+        num_of_frames (int, optional): Number of frames. Defaults to 300.
+        radius (int, optional): Radius of the ball. Defaults to 10.
+        num_of_balls (int, optional): Number of balls. Defaults to 1.
+
+    Returns:
+        dict: frames per second, p50 and p99 latency in milliseconds and the peak resident memory in MB of this
+            process and of the detector process.
+
+    Raises:
+        RuntimeError: If the detector does not answer a frame within RESULT_TIMEOUT.
+    """
+    logger = logging.getLogger("benchmark.pipeline")
+    logger.propagate = False
+    logger.addHandler(logging.NullHandler())
+    record = CoordinateRecord(MAX_OBJECTS)
+    if transport == "frame_ring":
+        frames = FrameRing(width, height, channels=1, num_slots=2, policy="bounded")
+    elif transport == "queue":
+        frames = Queue()
+    else:
+        frames = queue.Queue()
+    args = (frames, Value('i', 0), Value('i', 0), Value('b', False), logger, 1, detector, record)
+    consumer = threading.Thread(target=process_a, args=args) if transport == "thread" else Process(target=process_a, args=args)
+    consumer.start()
+    consumer_pid = os.getpid() if transport == "thread" else consumer.pid
+    _reset_peak_rss(os.getpid())
+    _reset_peak_rss(consumer_pid)
+    latencies = []
+    try:
+        for image in _pipeline_images(width, height, num_of_frames, radius, num_of_balls):
+            start = time.perf_counter()
+            frames.put(image)
+            if not select.select([record.fileno()], [], [], RESULT_TIMEOUT)[0]:
+                raise RuntimeError("{} detector over {} returned no coordinates in {}s".format(detector, transport, RESULT_TIMEOUT))
+            record.receive_objects() if detector == "multi" else record.receive()
+            latencies.append(time.perf_counter() - start)
+        peak_rss_mb = _peak_rss_mb(os.getpid())
+        consumer_peak_rss_mb = _peak_rss_mb(consumer_pid)
+    finally:
+        frames.put(None)
+        consumer.join(RESULT_TIMEOUT)
+        if transport == "frame_ring":
+            frames.close()
+    p50, p99 = np.percentile(latencies, (50, 99)) * 1000
+    return {
+        "fps": len(latencies) / sum(latencies),
+        "latency_ms_p50": float(p50),
+        "latency_ms_p99": float(p99),
+        "peak_rss_mb": peak_rss_mb,
+        "detector_peak_rss_mb": consumer_peak_rss_mb,
+    }
+
+def run_pipeline_benchmarks(num_of_frames: int = 300) -> list:
+    """
+    Run every detector over every transport on sequences at 480p, 720p and 1080p with small and large balls,
+    and the multi detector also with 10 and 100 balls.
+
+    Returns:
+        list: One dict per run, with its parameters and the results of benchmark_pipeline.
+    """
+    results = []
+    for name, (width, height) in RESOLUTIONS.items():
+        for radius in (5, 20):
+            for detector in DETECTORS:
+                for num_of_balls in ((1, 10, 100) if detector == "multi" else (1,)):
+                    for transport in TRANSPORTS:
+                        result = benchmark_pipeline(detector, transport, width, height, num_of_frames, radius, num_of_balls)
+                        result.update(resolution=name, radius=radius, detector=detector, balls=num_of_balls, transport=transport)
+                        results.append(result)
+                        print("pipeline resolution={} radius={} detector={} balls={} transport={} fps={:.1f} p50_ms={:.3f} p99_ms={:.3f} peak_rss_MB={:.1f} detector_peak_rss_MB={:.1f}".format(
+                            name, radius, detector, num_of_balls, transport, result["fps"], result["latency_ms_p50"],
+                            result["latency_ms_p99"], result["peak_rss_mb"], result["detector_peak_rss_mb"]))
+    return results
+
+def compare_results(results: list, baseline: list, tolerance: float = 0.2) -> list:
+    """
+    Compare pipeline results with those of an earlier version, matched on their parameters.
+
+    Args:
+        results (list): The results of run_pipeline_benchmarks.
+        baseline (list): The results of an earlier run_pipeline_benchmarks.
+        tolerance (float, optional): Relative increase of the p50 or p99 latency that counts as a regression.
+            Defaults to 0.2.
+
+    Returns:
+        list: A description of every regression.
+    """
+    keys = ("resolution", "radius", "detector", "balls", "transport")
+    previous = {tuple(result[key] for key in keys): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(tuple(result[key] for key in keys))
+        if old is None:
+            continue
+        for metric in ("latency_ms_p50", "latency_ms_p99"):
+            if result[metric] > old[metric] * (1 + tolerance):
+                regressions.append("{} {} {:.3f} -> {:.3f}".format(
+                    " ".join("{}={}".format(key, result[key]) for key in keys), metric, old[metric], result[metric]))
+    return regressions
+
+def _process_usage(pid: int):
+    """
+    Returns:
+        tuple: (CPU seconds used so far, resident memory in MB) of a process, read from /proc.
+    """
+    with open("/proc/{}/stat".format(pid)) as file:
+        # the fields after the command name, which may contain spaces
+        fields = file.read().rsplit(")", 1)[1].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    with open("/proc/{}/status".format(pid)) as file:
+        rss_kb = next(int(line.split()[1]) for line in file if line.startswith("VmRSS:"))
+    return cpu_seconds, rss_kb / 1024
+
+async def _connect_peer(port: int, attempts: int = 50):
+    """
+    Connect one receive-only peer to the multi-peer server: answer its offer and discard the video.
+
+    Returns:
+        tuple: (RTCPeerConnection, TcpSocketSignaling, MediaBlackhole) to close when done.
+    """
+    for attempt in range(attempts):
+        signaling = TcpSocketSignaling("localhost", port)
+        try:
+            offer = await signaling.receive()
+            break
+        except ConnectionError:
+            # the server is still starting
+            await asyncio.sleep(0.1)
+    else:
+        raise ConnectionError("multi-peer server did not start on port {}".format(port))
+    pc = RTCPeerConnection()
+    blackhole = MediaBlackhole()
+    pc.on("track", blackhole.addTrack)
+    await pc.setRemoteDescription(offer)
+    await pc.setLocalDescription(await pc.createAnswer())
+    await signaling.send(pc.localDescription)
+    await blackhole.start()
+    return pc, signaling, blackhole
+
+async def benchmark_fanout(port: int, server_pid: int, num_of_peers: int, duration: float = 5) -> dict:
+    """
+    Measure the CPU and memory of a running multi-peer server while num_of_peers peers receive its stream.
+
+    Args:
+        port (int): Signaling port of the server.
+        server_pid (int): Process id of the server.
+        num_of_peers (int): Number of peers to connect.
+        duration (float, optional): Seconds to measure for, once every peer is connected. Defaults to 5.
+
+    Returns:
+        dict: server CPU in percent of one core and resident memory in MB.
+    """
+    peers = [await _connect_peer(port) for _ in range(num_of_peers)]
+    try:
+        # let the connections and encoders settle before measuring
+        await asyncio.sleep(1)
+        cpu_start, _ = _process_usage(server_pid)
+        await asyncio.sleep(duration)
+        cpu_end, rss_mb = _process_usage(server_pid)
+    finally:
+        for pc, signaling, blackhole in peers:
+            await blackhole.stop()
+            await signaling.close()
+            await pc.close()
+    return {
+        "cpu_percent": (cpu_end - cpu_start) * 100 / duration,
+        "rss_mb": rss_mb,
+    }
+
+def run_fanout_benchmarks(num_of_frames: int = 300, port: int = 9099):
+    """
+    Start server.py --multi-peer and show how its CPU and memory grow with 1, 2, 4 and 8 connected peers,
+    when it encodes the stream for every peer and when it replays the packet cache.
+    """
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    for mode, options in (("encode", []), ("packet_cache", ["--packet-cache"])):
+        # the server writes its logs into its working directory
+        with tempfile.TemporaryDirectory() as work_dir:
+            server = subprocess.Popen(
+                [sys.executable, os.path.join(source_dir, "server.py"), "--multi-peer", "--lazy", "--port", str(port)] + options,
+                cwd=work_dir, stdout=subprocess.DEVNULL, env=dict(os.environ, PYTHONPATH=source_dir))
+            try:
+                for num_of_peers in (1, 2, 4, 8):
+                    if server.poll() is not None:
+                        raise RuntimeError("multi-peer server exited with code {}".format(server.returncode))
+                    result = asyncio.run(benchmark_fanout(port, server.pid, num_of_peers))
+                    print("fanout mode={} peers={} server_cpu%={:.1f} cpu%/peer={:.1f} server_rss_MB={:.1f}".format(
+                        mode, num_of_peers, result["cpu_percent"], result["cpu_percent"] / num_of_peers, result["rss_mb"]))
+            finally:
+                server.terminate()
+                server.wait()
+
+def run_pyramid_benchmarks(num_of_frames: int = 300) -> list:
+    """
+    Compare the full frame scan with the coarse to fine detector from 480p up to 4K, with small and large balls.
+    The luma planes are drawn one at a time and timed per frame, so a 4K run needs no more than a frame of memory.
+
+    Returns:
+        list: One dict per run, with its parameters, mean milliseconds per frame and the largest distance in
+            pixels from the ball's position on either axis.
+    """
+    results = []
+    for name, (width, height) in dict(RESOLUTIONS, **{"2160p": (3840, 2160)}).items():
+        for radius in (5, 20):
+            coordinates = BouncingBallVideoStreamTrack(width, height, num_of_frames, radius, lazy=True).coordinates
+            for detector in ("full", "pyramid"):
+                detect = create_detector(detector)
+                elapsed = 0.0
+                max_error = 0
+                for index, image in enumerate(_pipeline_images(width, height, num_of_frames, radius, 1)):
+                    start = time.perf_counter()
+                    x, y = detect(image)
+                    elapsed += time.perf_counter() - start
+                    max_error = max(max_error, abs(x - coordinates[index][0]), abs(y - coordinates[index][1]))
+                result = {"resolution": name, "radius": radius, "detector": detector,
+                          "ms_per_frame": elapsed * 1000 / num_of_frames, "max_error_px": int(max_error)}
+                results.append(result)
+                print("pyramid resolution={} radius={} detector={} ms/frame={:.3f} max_error_px={}".format(
+                    name, radius, detector, result["ms_per_frame"], result["max_error_px"]))
+    return results
+
+BENCHMARKS = {
+    "transport": run_transport_benchmarks,
+    "detector": run_detector_benchmarks,
+    "protocol": run_protocol_benchmarks,
+    "tracker": run_tracker_benchmarks,
+    "fanout": run_fanout_benchmarks,
+    "pipeline": run_pipeline_benchmarks,
+    "pyramid": run_pyramid_benchmarks,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the client benchmarks")
+    parser.add_argument("benchmarks", nargs="*", choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--frames", type=int, default=300, help="number of frames per run")
+    parser.add_argument("--json", help="file to save the results of the pipeline benchmarks in")
+    parser.add_argument("--baseline", help="results saved with --json by an earlier version, report latency regressions against them")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative latency increase reported as a regression")
+    args = parser.parse_args()
+    results = {}
+    for benchmark in args.benchmarks:
+        result = BENCHMARKS[benchmark](args.frames)
+        if result is not None:
+            results[benchmark] = result
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(),
+                       "frames": args.frames, "results": results}, file, indent=2)
+    if args.baseline and "pipeline" in results:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"].get("pipeline", [])
+        regressions = compare_results(results["pipeline"], baseline, args.tolerance)
+        for regression in regressions:
+            print("regression {}".format(regression))
+        if regressions:
+            sys.exit(1)
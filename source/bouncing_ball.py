@@ -1,14 +1,202 @@
 import asyncio,time
+from collections import OrderedDict
 import cv2
 import numpy as np
 from aiortc import VideoStreamTrack
+from aiortc.mediastreams import MediaStreamError, VIDEO_CLOCK_RATE, VIDEO_TIME_BASE
 from av import VideoFrame
+from frame_cache import sequence_key, load_sequence, create_sequence, save_sequence
+from protocol import FRAME_TICKS
 
-class BouncingBallVideoStreamTrack(VideoStreamTrack):
+def _bounce_range(start: int, speed: int, low: int, high: int):
+    """
+    The lowest position and the period of a ball moving along one axis from start, with the reflection rule of
+    BouncingBallVideoStreamTrack: move by speed, then turn around if the position is below low or at/above high.
+
+    Returns:
+        tuple: (lowest position, steps from the lowest position to start, period in steps).
+    """
+    if speed <= 0 or not low <= start < high:
+        raise ValueError("closed form positions need a positive speed and a ball starting inside the frame")
+    # the ball turns around on the first positions of its lattice (start + k * speed) at/above high and below low
+    steps_up = -((start - high) // speed)
+    steps_down = (start - low) // speed + 1
+    return start - steps_down * speed, steps_down, 2 * (steps_up + steps_down)
+
+class BallPath:
+    """
+    The (x, y) coordinates of the ball in each frame of the sequence, computed in closed form from the frame index
+    instead of being stored. Matches the coordinates of the precomputed sequence exactly.
+    """
+    def __init__(self, width: int, height: int, num_of_frames: int, radius: int, speed: int):
+        self.num_of_frames = num_of_frames
+        self.speed = speed
+        self.x_range = _bounce_range(int(width/2), speed, radius, width - radius)
+        self.y_range = _bounce_range(int(height/2), speed, radius, height - radius)
+
+    def _position(self, bounce_range: tuple, index: int) -> int:
+        lowest, offset, period = bounce_range
+        # frame 0 is already one step away from the start
+        step = (offset + index + 1) % period
+        return lowest + min(step, period - step) * self.speed
+
+    def __len__(self) -> int:
+        return self.num_of_frames
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.num_of_frames))]
+        if index < 0:
+            index += self.num_of_frames
+        if not 0 <= index < self.num_of_frames:
+            raise IndexError("frame index out of range")
+        return self._position(self.x_range, index), self._position(self.y_range, index)
+
+class BallSwarm:
+    """
+    The positions of several balls, each with its own radius, velocity and colour, in every frame of the sequence.
+    All the balls are moved and bounced at once with NumPy, with the reflection rule of the single ball.
+    """
+    def __init__(self, width: int, height: int, num_of_frames: int, num_of_balls: int, radius: int, speed: int, seed: int = 0):
+        """
+        Args:
+            width (int): The width of the frame.
+            height (int): The height of the frame.
+            num_of_frames (int): Number of frames in the sequence.
+            num_of_balls (int): Number of balls.
+            radius (int): The largest radius, every ball gets a radius between radius/2 and radius.
+            speed (int): The largest speed along each axis, in pixels per frame.
+            seed (int, optional): Seed of the random radii, speeds, colours and start positions. Defaults to 0.
+        """
+        rng = np.random.default_rng(seed)
+        self.radii = rng.integers(max(radius // 2, 1), radius + 1, num_of_balls)
+        # bright enough in every channel to stay well above the luma threshold of the detector
+        self.colors = rng.integers(64, 256, (num_of_balls, 3))
+        size = np.array([width, height])
+        low = self.radii[:, None]
+        high = size - self.radii[:, None]
+        position = rng.integers(low, high, (num_of_balls, 2))
+        velocity = rng.integers(1, speed + 1, (num_of_balls, 2)) * rng.choice((-1, 1), (num_of_balls, 2))
+        self.positions = np.empty((num_of_frames, num_of_balls, 2), dtype=np.int32)
+        for index in range(num_of_frames):
+            position += velocity
+            velocity[(position < low) | (position >= high)] *= -1
+            self.positions[index] = position
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __getitem__(self, index) -> np.ndarray:
+        """
+        Returns:
+            np.ndarray: The (num_of_balls, 2) x, y positions of the balls in a frame.
+        """
+        return self.positions[index]
+
+class GroundTruthTrack(VideoStreamTrack):
+    """
+    Base of the tracks the server streams, remembers where the ball was in every recently sent frame.
+    """
+    def __init__(self, history_size: int = 300):
+        """
+        Args:
+            history_size (int, optional): Number of sent frames kept in the ground truth history. Defaults to 300.
+        """
+        super().__init__()
+        self.counter = 0
+        self.cur_x_coordinate = 0
+        self.cur_y_coordinate = 0
+        # pts -> (x, y, send timestamp) of the last history_size frames sent
+        self.history = OrderedDict()
+        self.history_size = history_size
+        # frames of the sequence per sent frame, 2 sends at half the frame rate
+        self.stride = 1
+        # size of the sent frames relative to the sequence, see BouncingBallVideoStreamTrack.scaled
+        self.scale = 1.0
+        # send timestamp of the first frame, for the startup timings
+        self.first_sent = None
+
+    async def next_timestamp(self):
+        """
+        Same as VideoStreamTrack.next_timestamp, but the pts advances by stride frames. At a lower frame rate the
+        pts still counts frames of the sequence, so it keeps identifying the frame that was sent.
+        """
+        if self.readyState != "live":
+            raise MediaStreamError
+        if hasattr(self, "_timestamp"):
+            self._timestamp += self.stride * FRAME_TICKS
+            wait = self._start + (self._timestamp / VIDEO_CLOCK_RATE) - time.time()
+            await asyncio.sleep(wait)
+        else:
+            self._start = time.time()
+            self._timestamp = 0
+        return self._timestamp, VIDEO_TIME_BASE
+
+    def record(self, pts: int, xy: tuple):
+        """
+        Remember the position of the ball in the frame with the given pts, which is about to be sent.
+
+        Args:
+            pts (int): The presentation timestamp of the frame.
+            xy: The (x, y) position of the ball, or a (num_of_balls, 2) array for several balls.
+        """
+        if isinstance(xy, np.ndarray) and xy.ndim == 2:
+            # x and y are arrays with one entry per ball, the current coordinates are those of the first ball
+            x, y = xy[:, 0], xy[:, 1]
+            self.cur_x_coordinate, self.cur_y_coordinate = int(x[0]), int(y[0])
+        else:
+            x, y = xy
+            self.cur_x_coordinate, self.cur_y_coordinate = x, y
+        self.history[pts] = (x, y, time.time())
+        if self.first_sent is None:
+            self.first_sent = self.history[pts][2]
+        if len(self.history) > self.history_size:
+            self.history.popitem(last=False)
+
+    @property
+    def current_pts(self) -> int:
+        """
+        The pts of the last frame sent, None before the first one.
+        """
+        return next(reversed(self.history), None)
+
+    def position_at(self, pts: int):
+        """
+        The position of the ball in the frame with the given pts, also for a frame that has not been sent yet.
+        The subclass keeps the positions of one loop of the sequence in self.coordinates, the position returned is
+        at the current render size.
+        """
+        xy = self.coordinates[round(pts / FRAME_TICKS) % len(self.coordinates)]
+        if self.scale == 1:
+            return xy
+        return int(xy[0] * self.scale), int(xy[1] * self.scale)
+
+    def ground_truth(self, pts: int):
+        """
+        Look up a frame that was sent recently.
+
+        Args:
+            pts (int): The presentation timestamp of the frame.
+
+        Returns:
+            tuple: (x, y, send timestamp) of the frame, or None if it is not in the history.
+                With several balls x and y are arrays with one entry per ball.
+        """
+        # a pts that went through the RTP clock conversion can be one tick off
+        for candidate in (pts, pts + 1, pts - 1):
+            if candidate in self.history:
+                return self.history[candidate]
+        return None
+
+class BouncingBallVideoStreamTrack(GroundTruthTrack):
     """
     A video track that returns a continuous 2D image of a bouncing ball with radius=10 and speed=5.
+
+    By default every frame of the sequence is rendered up front into self.frames. In lazy mode the position of
+    the ball is computed from the frame index and each frame is drawn on demand into one of a few reusable
+    buffers, by clearing the previous ball's bounding box, so startup is instant and memory is constant.
     """
-    def __init__(self, width: int = 640, height: int = 480, num_of_frames: int = 300, radius: int = 10, speed: int = 5):
+    def __init__(self, width: int = 640, height: int = 480, num_of_frames: int = 300, radius: int = 10, speed: int = 5, history_size: int = 300, lazy: bool = False, pool_size: int = 4, cache_dir: str = None, num_of_balls: int = 1, seed: int = 0):
         """
         Initialize a new BouncingBall object with initial position (width/2.height/2)
 
@@ -18,16 +206,42 @@ class BouncingBallVideoStreamTrack(VideoStreamTrack):
             num_of_frames (int, optional): Number of frames to generate. Defaults to 300.
             radius (int, optional): Radius of the ball. Defaults to 10.
             speed (int, optional): The speed of the ball. Defaults to 5.
+            history_size (int, optional): Number of sent frames kept in the ground truth history. Defaults to 300.
+            lazy (bool, optional): Draw frames on demand instead of rendering them all up front. Defaults to False.
+            pool_size (int, optional): Number of reusable frame buffers in lazy mode. A frame returned by recv()
+                is overwritten pool_size frames later. Defaults to 4.
+            cache_dir (str, optional): Directory of the on-disk frame cache. The precomputed sequence is loaded
+                from there as a memory map if it was rendered before, and stored there otherwise. Defaults to None.
+            num_of_balls (int, optional): Number of balls. With more than one, every ball gets its own radius (up to
+                radius), speed (up to speed) and colour, and the frames are always drawn on demand. Defaults to 1.
+            seed (int, optional): Seed of the random balls when there is more than one. Defaults to 0.
         """
-        super().__init__()
-        self.counter = 0
-        self.cur_x_coordinate = 0
-        self.cur_y_coordinate = 0
+        super().__init__(history_size)
         # self.logger = None
         # Ball parameters
         ball_radius = radius
         ball_color = (0, 0, 255)  # Blue color (rgb)
         ball_speed = speed
+        self.lazy = lazy or num_of_balls > 1
+        if self.lazy:
+            self.radius = radius
+            self.color = ball_color
+            if num_of_balls > 1:
+                self.coordinates = BallSwarm(width, height, num_of_frames, num_of_balls, radius, speed, seed)
+            else:
+                self.coordinates = BallPath(width, height, num_of_frames, radius, speed)
+            # each buffer remembers the box of the ball drawn into it last, which is all there is to clear
+            self.pool = [np.zeros((height, width, 3), dtype=np.uint8) for _ in range(pool_size)]
+            self.pool_boxes = [None] * pool_size
+            return
+        rendered = None
+        if cache_dir is not None:
+            key = sequence_key(width, height, num_of_frames, radius, speed)
+            cached = load_sequence(cache_dir, key)
+            if cached is not None:
+                self._use_cached_sequence(*cached)
+                return
+            rendered = create_sequence(cache_dir, key, (num_of_frames, height, width, 3))
         # Create an empty canvas
         self.canvas = np.zeros((height, width, 3), dtype=np.uint8)
 
@@ -42,7 +256,7 @@ class BouncingBallVideoStreamTrack(VideoStreamTrack):
         self.frames = []
         self.coordinates = []
 
-        for _ in range(num_of_frames):
+        for index in range(num_of_frames):
             self.canvas.fill(0)
             # Update ball position based on velocity
             ball_x += ball_velocity_x
@@ -56,28 +270,93 @@ class BouncingBallVideoStreamTrack(VideoStreamTrack):
 
             # Draw the ball on the canvas
             cv2.circle(self.canvas, (ball_x, ball_y), ball_radius, ball_color, -1)
-            # Create a VideoFrame from the canvas image
-            frame = VideoFrame.from_ndarray(self.canvas, format="bgr24")
-            self.frames.append(frame)
+            if rendered is None:
+                # Create a VideoFrame from the canvas image
+                frame = VideoFrame.from_ndarray(self.canvas, format="bgr24")
+                self.frames.append(frame)
+            else:
+                rendered[index] = self.canvas
             xy_coordinates = (ball_x,ball_y)
             self.coordinates.append(xy_coordinates)
+        if rendered is not None:
+            self._use_cached_sequence(*save_sequence(cache_dir, key, rendered, self.coordinates))
+
+    def _use_cached_sequence(self, images: np.ndarray, coordinates: list):
+        # the frames are views of the memory map, nothing is copied until the encoder reads them
+        self.frames = [VideoFrame.from_numpy_buffer(image, format="bgr24") for image in images]
+        self.coordinates = coordinates
+
     async def recv(self):
         """
         Returns next video frame
         """
         pts, time_base = await self.next_timestamp()
-        frame = self.frames[self.counter % len(self.frames)]
-        xy = self.coordinates[self.counter % len(self.coordinates)]
+        # at a lower frame rate the frames in between are skipped
+        frame, xy = self.frame_at(pts // FRAME_TICKS)
+        if self.scale != 1:
+            frame, xy = self.scaled(frame, xy)
         frame.pts = pts
         frame.time_base = time_base
-        self.cur_x_coordinate = xy[0]
-        self.cur_y_coordinate = xy[1]
+        self.record(pts, xy)
         # cur_coordinates = (self.cur_x_coordinate,self.cur_y_coordinate)
         # print("{} : {}".format(time.time()*1000,cur_coordinates))
         # self.logger.info("curent-coordinates : {}".format(cur_coordinates))
         self.counter += 1
         return frame
 
+    def frame_at(self, index: int):
+        """
+        Get a frame of the sequence, which repeats after num_of_frames frames. In lazy mode the frame is drawn
+        into the buffer of the pool that belongs to the current counter.
+
+        Returns:
+            tuple: (VideoFrame without pts, (x, y) position of the ball).
+        """
+        xy = self.coordinates[index % len(self.coordinates)]
+        if self.lazy:
+            return self.render(xy), xy
+        return self.frames[index % len(self.frames)], xy
+
+    def scaled(self, frame: VideoFrame, xy):
+        """
+        Shrink a frame of the sequence, and the position of the ball in it, by self.scale.
+
+        Returns:
+            tuple: (new VideoFrame, position of the ball in it).
+        """
+        image = frame.to_ndarray(format="bgr24")
+        size = (int(image.shape[1] * self.scale), int(image.shape[0] * self.scale))
+        frame = VideoFrame.from_ndarray(cv2.resize(image, size, interpolation=cv2.INTER_AREA), format="bgr24")
+        if isinstance(xy, np.ndarray):
+            return frame, (xy * self.scale).astype(np.int32)
+        return frame, (int(xy[0] * self.scale), int(xy[1] * self.scale))
+
+    def render(self, xy: tuple) -> VideoFrame:
+        """
+        Draw the ball at the given position into the next buffer of the pool (lazy mode only).
+
+        Args:
+            xy (tuple): The (x, y) position of the ball, or the (num_of_balls, 2) positions of several balls.
+
+        Returns:
+            VideoFrame: A frame that shares the buffer's memory.
+        """
+        index = self.counter % len(self.pool)
+        canvas = self.pool[index]
+        if isinstance(self.coordinates, BallSwarm):
+            # with many balls the boxes cover much of the frame, clearing all of it is cheaper
+            canvas.fill(0)
+            for (x, y), radius, color in zip(xy.tolist(), self.coordinates.radii.tolist(), self.coordinates.colors.tolist()):
+                cv2.circle(canvas, (x, y), radius, color, -1)
+            return VideoFrame.from_numpy_buffer(canvas, format="bgr24")
+        box = self.pool_boxes[index]
+        if box is not None:
+            canvas[box[1]:box[3], box[0]:box[2]] = 0
+        x, y = xy
+        cv2.circle(canvas, (x, y), self.radius, self.color, -1)
+        self.pool_boxes[index] = (max(x - self.radius, 0), max(y - self.radius, 0), max(x + self.radius + 1, 0), max(y + self.radius + 1, 0))
+        return VideoFrame.from_numpy_buffer(canvas, format="bgr24")
+
 if __name__ == "__main__":
     video_track = BouncingBallVideoStreamTrack()
 
@@ -1,17 +1,99 @@
 import os
+import argparse
 import asyncio
-import cv2
 import json
-from multiprocessing import Value, Queue, Process
+import threading
+import time
+import cv2
+import numpy as np
+from multiprocessing import Value, Process
 from aiortc.contrib.signaling import BYE, TcpSocketSignaling
 from aiortc import RTCIceCandidate, RTCPeerConnection, RTCSessionDescription
+from aiortc.mediastreams import MediaStreamError
 from Logger.logger import setup_logging
 from helper import create_file
+from frame_ring import FrameRing, POLICIES
+from detector_pool import run_detector_pool
+from detector import find_ball, find_ball_pyramid, luma_plane, MultiBallTracker, RoiBallTracker
+from coordinate_record import CoordinateRecord
+from protocol import FRAME_TICKS, PROTOCOLS, decode_feedback, decode_report_request, encode_batch, encode_json, encode_load_report
+from predictor import AlphaBetaPredictor, LatencyCompensator
+from metrics import Metrics, start_metrics
+from adaptation import LoadMonitor
+from startup import StartupTimer
 
-image_queue = Queue()
+image_queue = None  # FrameRing shared with process_a, created in __main__ so importing this module allocates no shared memory
 x_coordinate = Value('i', 0)
 y_coordinate = Value('i', 0)
 new_coordinates_generated = Value('b', False)
+MAX_OBJECTS = 1024  # objects per frame sent by the multi detector
+coordinate_record = None  # CoordinateRecord process_a publishes to, wakes up send_coordinates, created in __main__ like image_queue
+QUEUE_STATS_INTERVAL = 100  # frames between two queue depth / dropped frames log lines
+DETECTORS = ("full", "roi", "multi", "pyramid")
+# track.recv -> conversion -> image_queue.put -> (process_a) detect -> publish -> send_coordinates
+STAGES = ("track_recv", "convert", "queue_put", "detect", "publish", "frame_to_send", "send")
+CONNECT_RETRY_INTERVAL = 0.1  # seconds between two attempts to reach a server that is not listening yet
+
+def create_detector(name: str = "full"):
+    """
+    Create the function used to find the ball in every frame.
+
+    Args:
+        name (str, optional): "full" scans the whole frame, "roi" searches around the last known position
+            and falls back to a full scan, "multi" finds and tracks every ball, "pyramid" finds the ball in a
+            downscaled image and refines it at full resolution. Defaults to "full".
+
+    Returns:
+        A function called as detect(image) that returns the (x, y) coordinates of the ball, or for "multi"
+        an (n, 3) array of the x, y and track id of every ball.
+    """
+    if name == "roi":
+        return RoiBallTracker(find_ball).find
+    if name == "multi":
+        return MultiBallTracker().find
+    if name == "pyramid":
+        return find_ball_pyramid
+    return find_ball
+
+def warm_up(detector: str = "full"):
+    """
+    Run a detector of the given kind once on a synthetic luma plane and BGR image, so the first frame doesn't
+    pay for the first calls into OpenCV. The detector is thrown away, a tracker would remember the synthetic ball.
+    """
+    image = np.zeros((480, 640), dtype=np.uint8)
+    cv2.circle(image, (320, 240), 10, 255, -1)
+    detect = create_detector(detector)
+    detect(image)
+    detect(cv2.cvtColor(image, cv2.COLOR_GRAY2BGR))
+
+def publish_coordinates(coordinates, x_coordinate, y_coordinate, new_coordinates_generated, logger, seq: int = 0, coordinate_record: CoordinateRecord = None):
+    """
+    Store the coordinates of the ball in the shared Values, and in the coordinate record read by send_coordinates.
+
+    Args:
+        coordinates: The (x, y) coordinates of the ball, or the (n, 3) objects found by the multi detector.
+        x_coordinate: The shared Value for storing the x-coordinate of the ball.
+        y_coordinate: The shared Value for storing the y-coordinate of the ball.
+        new_coordinates_generated: The shared Value indicating if new coordinates are generated.
+        logger: The logger object for logging messages.
+        seq: Sequence number of the frame the coordinates were found in.
+        coordinate_record: The CoordinateRecord to publish the coordinates to, if any.
+    """
+    if isinstance(coordinates, np.ndarray):
+        # the shared Values hold the first object
+        if len(coordinates):
+            x_coordinate.value, y_coordinate.value = coordinates[0][:2]
+        new_coordinates_generated.value = True
+        if coordinate_record is not None:
+            coordinate_record.publish_objects(seq, coordinates)
+        logger.info("calculated_objects = %d frame = %d", len(coordinates), seq)
+        return
+    x_coordinate.value, y_coordinate.value = coordinates
+    new_coordinates_generated.value = True
+    if coordinate_record is not None:
+        coordinate_record.publish(seq, *coordinates)
+    data = (x_coordinate.value, y_coordinate.value, new_coordinates_generated.value)
+    logger.info("calculated_coordinates = %s", data)
 
 def calculate_coordinates(image, x_coordinate, y_coordinate, new_coordinates_generated, logger):
     """
@@ -24,104 +106,310 @@ def calculate_coordinates(image, x_coordinate, y_coordinate, new_coordinates_gen
         new_coordinates_generated: The shared Value indicating if new coordinates are generated.
         logger: The logger object for logging messages.
     """
-    # logger.info("inside calculate_coordinates")
-    # Convert the image to grayscale
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    publish_coordinates(find_ball(image), x_coordinate, y_coordinate, new_coordinates_generated, logger)
 
-    # Apply a threshold to separate the ball from the background
-    _, threshold = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY)
-
-    # Find contours in the thresholded image, detect objects (ball)
-    contours, _ = cv2.findContours(threshold, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    # Find the contour with the largest area, this will give the ball
-    contour = max(contours, key=cv2.contourArea)
-
-    # Find the minimum enclosing circle of the contour
-    ((center_x, center_y), radius) = cv2.minEnclosingCircle(contour)
-    x_coordinate.value = int(center_x)
-    y_coordinate.value = int(center_y)
-    new_coordinates_generated.value = True
-    data = (x_coordinate.value, y_coordinate.value, new_coordinates_generated.value)
-    logger.info(f"calculated_coordinates = {data}")
-
-async def create_data_channel(pc, signaling,logger):
+async def create_data_channel(pc, signaling,logger, protocol: str = "json", flush_interval: float = 0, tracks: bool = False, compensator: LatencyCompensator = None, metrics: Metrics = None, record: CoordinateRecord = None, monitor: LoadMonitor = None, timer: StartupTimer = None):
     """
     Create a data channel for sending coordinates to the remote party.
 
     Args:
         pc: The RTCPeerConnection object.
         signaling: The signaling object used for signaling.
+        protocol: "json" sends one [x, y, pts] text message per frame, "binary" sends batches, see protocol.py.
+        flush_interval: Seconds the binary protocol collects frames before sending them in one message,
+            0 sends every frame immediately.
+        tracks: Send every object published by the multi detector with its track id, binary protocol only.
+        compensator: Send the position the ball is predicted to have when the result arrives instead of the
+            detection, for the frame the server will be showing then. Not used with tracks.
+        metrics: Records the time from queueing a frame to sending its coordinates, and the time to send them.
+        record: The CoordinateRecord process_a publishes to, defaults to the module's coordinate_record.
+        monitor: Measures the lag and dropped frames of the pipeline, reported to the server so it can adapt
+            the stream, if any. Reports are only sent once the server asks for them, see
+            protocol.encode_report_request.
+        timer: Records when the first coordinates were sent and logs its startup_timings then, if any.
     """
+    if record is None:
+        record = coordinate_record
+    # a server that offers the data channel up front needs no second offer for it
+    negotiated = pc.sctp is not None
     channel = pc.createDataChannel("coordinates")
     logger.info("channel({}) - created by local party".format(channel.label))
 
-    async def send_coordinates():
-        while True:
-            if new_coordinates_generated.value:
-                new_coordinates_generated.value = False
-                data = (x_coordinate.value, y_coordinate.value)
-                data_str = json.dumps(data)
-                logger.info("channel(%s) --> %s" % (channel.label, data_str))
+    loop = asyncio.get_event_loop()
+    batch = []
+    flush_handle = None
+    report_handle = None
+
+    def flush():
+        nonlocal flush_handle
+        flush_handle = None
+        if batch:
+            data = encode_batch(batch, tracks)
+            if tracks:
+                logger.info("channel(%s) --> %d frames in %d bytes, last = %d objects", channel.label, len(batch), len(data), len(batch[-1][1]))
+            else:
+                logger.info("channel(%s) --> %d frames in %d bytes, last = %s", channel.label, len(batch), len(data), batch[-1])
+            batch.clear()
+            channel.send(data)
+
+    def send_coordinates():
+        nonlocal flush_handle
+        # called by the event loop as soon as process_a publishes new coordinates
+        if timer is not None and "first_coordinates" not in timer.marks:
+            timer.mark("first_coordinates")
+            logger.info("startup_timings = %s", json.dumps(timer.report()))
+        if tracks:
+            seq, objects = record.receive_objects()
+            if metrics is not None:
+                metrics.observe_since("frame_to_send", seq)
+            if monitor is not None:
+                monitor.on_sent(seq)
+            batch.append((seq, objects.tolist()))
+        else:
+            seq, x, y = record.receive()
+            if metrics is not None:
+                metrics.observe_since("frame_to_send", seq)
+            if monitor is not None:
+                monitor.on_sent(seq)
+            if compensator is not None:
+                prediction = compensator.add(seq, x, y)
+                if prediction is None:
+                    return
+                seq, x, y = prediction
+            if protocol == "json":
+                # the pts lets the server compare with the frame the coordinates were found in
+                data_str = encode_json(seq, x, y)
+                logger.info("channel(%s) --> %s", channel.label, data_str)
                 channel.send(data_str)
-            await asyncio.sleep(.001)  # sending data every 1 ms,this is to reduce load to the cpu
+                return
+            batch.append((seq, [(x, y)]))
+        if flush_interval <= 0:
+            flush()
+        elif flush_handle is None:
+            flush_handle = loop.call_later(flush_interval, flush)
+
+    def send_load_report(interval: float):
+        nonlocal report_handle
+        lag_ms, drop_rate = monitor.report()
+        logger.debug("load_report lag_ms = %.1f drop_rate = %.3f", lag_ms, drop_rate)
+        channel.send(encode_load_report(lag_ms, drop_rate))
+        report_handle = loop.call_later(interval, send_load_report, interval)
+
+    @channel.on("message")
+    def on_message(message):
+        nonlocal report_handle
+        if not isinstance(message, str):
+            return
+        interval = decode_report_request(message)
+        if interval is not None:
+            if monitor is not None and report_handle is None:
+                logger.info("load_reports_requested interval = %s", interval)
+                # the first report only covers the frames since the request
+                monitor.report()
+                report_handle = loop.call_later(interval, send_load_report, interval)
+            return
+        if compensator is None:
+            return
+        lag = compensator.feedback(*decode_feedback(message))
+        if lag is not None:
+            logger.info("lag_feedback lag_frames = {:.1f} average_lag_frames = {:.1f}".format(lag / FRAME_TICKS, compensator.lag / FRAME_TICKS))
 
     @channel.on("open")
     def on_open():
-        asyncio.ensure_future(send_coordinates())
-    logger.info("sending offer signal")
-    await pc.setLocalDescription(await pc.createOffer())
-    await signaling.send(pc.localDescription)
+        loop.add_reader(record.fileno(), send_coordinates if metrics is None else metrics.timed("send", send_coordinates))
+
+    @channel.on("close")
+    def on_close():
+        loop.remove_reader(record.fileno())
+        for handle in (flush_handle, report_handle):
+            if handle is not None:
+                handle.cancel()
+    if not negotiated:
+        logger.info("sending offer signal")
+        await pc.setLocalDescription(await pc.createOffer())
+        await signaling.send(pc.localDescription)
+
 
+def log_queue_stats(image_queue, logger):
+    """
+    Log the number of frames waiting in the queue and, for a FrameRing, the number of dropped frames.
+    """
+    logger.info("image_queue_stats queue_depth={} dropped_frames={}".format(image_queue.qsize(), getattr(image_queue, "dropped", 0)))
 
-def process_a(image_queue: Queue, x_coordinate: Value, y_coordinate: Value, new_coordinates_generated: Value, logger: any=None):
+def process_a(image_queue: FrameRing, x_coordinate: Value, y_coordinate: Value, new_coordinates_generated: Value, logger: any=None, num_of_workers: int = 1, detector: str = "full", coordinate_record: CoordinateRecord = None, metrics: Metrics = None, ready: Value = None):
     """
     Process for calculating coordinates from the image frames.
+    With more than one worker the frames are detected by a thread pool and published in frame order.
 
     Args:
-        image_queue: The Queue for receiving image frames.
+        image_queue: The FrameRing (or Queue) for receiving image frames.
         x_coordinate: The shared Value for storing the x-coordinate of the ball.
         y_coordinate: The shared Value for storing the y-coordinate of the ball.
         new_coordinates_generated: The shared Value indicating if new coordinates are generated.
         logger: The logger object for logging messages.
+        num_of_workers: Number of detector threads, more than one requires a FrameRing.
+        detector: Name of the detector, see create_detector.
+        coordinate_record: The CoordinateRecord read by send_coordinates, if any.
+        metrics: Records the time of every detection and publish, if any.
+        ready: Set to the time the detector was warmed up and waits for frames, if any.
     """
     if logger == None:
         logger = setup_logging("client_process_a", create_file(os.path.join(os.getcwd(), "logs"),"client_process_a.log"))
         logger.info("process_a started")
+    warm_up(detector)
+    if ready is not None:
+        ready.value = time.time()
+    detect = create_detector(detector)
+    publish_result = publish_coordinates
+    if metrics is not None:
+        detect = metrics.timed("detect", detect)
+        publish_result = metrics.timed("publish", publish_coordinates)
+    num_of_frames = 0
+    if num_of_workers > 1:
+        frame_lock = threading.Lock()
+
+        def on_frame():
+            nonlocal num_of_frames
+            with frame_lock:
+                num_of_frames += 1
+                if num_of_frames % QUEUE_STATS_INTERVAL == 0:
+                    log_queue_stats(image_queue, logger)
+
+        def publish(seq, coordinates):
+            publish_result(coordinates, x_coordinate, y_coordinate, new_coordinates_generated, logger, seq, coordinate_record)
+
+        run_detector_pool(image_queue, detect, publish, num_of_workers, logger, on_frame)
+        return
     while True:
         # logger.info("fetching image from queue")
-        image = image_queue.get()
+        if hasattr(image_queue, "get_frame"):
+            seq, image = image_queue.get_frame()
+        else:
+            seq, image = num_of_frames + 1, image_queue.get()
         if image is None:
             break
         # logger.info("image coordinates calculation started")
-        calculate_coordinates(image, x_coordinate, y_coordinate, new_coordinates_generated, logger)
+        try:
+            coordinates = detect(image)
+        except Exception as e:
+            # such as a frame without the ball, skip it like the detector pool does
+            logger.error("error_in_detecting_frame seq={} {}".format(seq, e))
+        else:
+            publish_result(coordinates, x_coordinate, y_coordinate, new_coordinates_generated, logger, seq, coordinate_record)
         # logger.info("image coordinates calculation finished")
+        num_of_frames += 1
+        if num_of_frames % QUEUE_STATS_INTERVAL == 0:
+            log_queue_stats(image_queue, logger)
 
 
-async def run(pc: RTCPeerConnection, signaling: TcpSocketSignaling,logger):
+class Preview:
+    """
+    Shows the most recent received frame in a window from its own thread, at a limited rate,
+    so that the track is never held up by the GUI.
+    """
+    def __init__(self, fps: float = 10):
+        """
+        Args:
+            fps (float, optional): Maximum number of frames shown per second. Defaults to 10.
+        """
+        self.interval = 1 / fps
+        self.closed = threading.Event()
+        self._frame = None
+        self._thread = threading.Thread(target=self._show_frames, name="preview", daemon=True)
+        self._thread.start()
+
+    def show(self, frame):
+        """
+        Offer a frame to the preview, it replaces any frame that has not been shown yet.
+        """
+        self._frame = frame
+
+    def _show_frames(self):
+        while not self.closed.wait(self.interval):
+            frame, self._frame = self._frame, None
+            if frame is None:
+                continue
+            # the BGR conversion only happens for frames that are actually shown
+            cv2.imshow("Received Frames", frame.to_ndarray(format="bgr24"))
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                self.closed.set()
+        cv2.destroyAllWindows()
+
+    def close(self):
+        """
+        Stop the preview thread and close the window.
+        """
+        self.closed.set()
+        self._thread.join()
+
+async def run(pc: RTCPeerConnection, signaling: TcpSocketSignaling,logger, luma: bool = False, preview_fps: float = 10, protocol: str = "json", flush_interval: float = 0, tracks: bool = False, update_every: int = 0, metrics: Metrics = None, frame_queue: FrameRing = None, record: CoordinateRecord = None, timer: StartupTimer = None):
     """
     Main function for running the client.
 
     Args:
         pc: The RTCPeerConnection object.
         signaling: The signaling object used for signaling.
+        luma: Send only the luma plane of each frame to process_a instead of a BGR image.
+        preview_fps: Rate of the preview window, 0 runs headless without any GUI calls.
+        protocol: Format of the coordinate messages, see create_data_channel.
+        flush_interval: Seconds between two binary batches, see create_data_channel.
+        tracks: Send the objects of the multi detector, see create_data_channel.
+        update_every: Send a predicted position for every Nth detection, compensating the lag to the server,
+            0 sends the detections themselves.
+        metrics: Records the time spent in every stage of the pipeline, if any.
+        frame_queue: The FrameRing read by process_a, defaults to the module's image_queue.
+        record: The CoordinateRecord process_a publishes to, defaults to the module's coordinate_record.
+        timer: Records the steps of the startup, logged as startup_timings with the first coordinates, if any.
     """
+    if frame_queue is None:
+        frame_queue = image_queue
     await signaling.connect()
+    preview = Preview(preview_fps) if preview_fps > 0 else None
+    # the server adapts the stream to the reports of this monitor, if it was started with --adaptive and asks for them
+    monitor = LoadMonitor(lambda: frame_queue.dropped)
+    compensator = None
 
     @pc.on("track")
     def on_track(track):
         logger.info("Receiving = {}".format(track.kind))
-        asyncio.ensure_future(process_track(track))
+        asyncio.ensure_future(read_track(track))
+
+    async def read_track(track):
+        try:
+            await process_track(track)
+        except MediaStreamError:
+            # the connection was closed
+            logger.info("track_ended")
 
     async def process_track(track):
+        # no sleeps here, frames are taken off the track as fast as they arrive
         while True:
+            # without metrics no clock is read, only these comparisons are left
+            if metrics is not None:
+                start = time.perf_counter()
             frame = await track.recv()
-            image = frame.to_ndarray(format="bgr24")
-            image_queue.put(image)
-            cv2.imshow("Received Frames", image)
-            if cv2.waitKey(1) & 0xFF == ord('q'):
-                break
-            await asyncio.sleep(0.01)
+            if metrics is not None:
+                received = time.perf_counter()
+            image = luma_plane(frame) if luma else frame.to_ndarray(format="bgr24")
+            if metrics is not None:
+                converted = time.perf_counter()
+                metrics.mark(frame.pts)
+            # never wait for a free slot here, the ring policy decides which frame to drop
+            # the pts is the frame id sent back with the coordinates
+            frame_queue.put(image, block=False, seq=frame.pts)
+            if metrics is not None:
+                metrics.observe("track_recv", received - start)
+                metrics.observe("convert", converted - received)
+                metrics.observe("queue_put", time.perf_counter() - converted)
+            monitor.on_frame(frame.pts)
+            if compensator is not None:
+                compensator.predictor.set_frame_size(frame.width, frame.height)
+            if timer is not None:
+                timer.mark("first_frame")
+            if preview is not None:
+                if preview.closed.is_set():
+                    break
+                preview.show(frame)
 
     data_channel_created = False
     while True:
@@ -135,13 +423,18 @@ async def run(pc: RTCPeerConnection, signaling: TcpSocketSignaling,logger):
                         await pc.setRemoteDescription(obj)
                 else:
                     if obj.type == "offer":
+                        if timer is not None:
+                            timer.mark("offer_received")
                         # send answer
                         await pc.setRemoteDescription(obj)
                         await pc.setLocalDescription(await pc.createAnswer())
                         logger.info("sending to answer signal")
                         await signaling.send(pc.localDescription)
+                        if timer is not None:
+                            timer.mark("answer_sent")
                         if not data_channel_created:
-                            await create_data_channel(pc, signaling,logger)
+                            compensator = LatencyCompensator(AlphaBetaPredictor(), update_every) if update_every > 0 else None
+                            await create_data_channel(pc, signaling,logger, protocol, flush_interval, tracks, compensator, metrics, record, monitor, timer)
                             data_channel_created = True
             elif isinstance(obj, RTCIceCandidate):
                 logger.info("RTCIceCandidate_received")
@@ -149,20 +442,88 @@ async def run(pc: RTCPeerConnection, signaling: TcpSocketSignaling,logger):
             elif obj is BYE:
                 logger.info("received_bye_signal_exiting")
                 break
+        except ConnectionRefusedError:
+            # the server is not listening yet
+            await asyncio.sleep(CONNECT_RETRY_INTERVAL)
+            continue
         except Exception as e:
             logger.error("error_while_consuming_signal={}".format(e))
             continue
+    if preview is not None:
+        preview.close()
 
 
 if __name__ == "__main__":
+    timer = StartupTimer()
+    timer.mark("imported")
+    parser = argparse.ArgumentParser(description="Receive the bouncing ball video and send back its coordinates")
+    parser.add_argument("--policy", choices=POLICIES, default=os.environ.get("CLIENT_FRAME_POLICY", "latest"),
+                        help="which frames to drop when detection falls behind (env CLIENT_FRAME_POLICY)")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("CLIENT_DETECTOR_WORKERS", 1)),
+                        help="number of detector threads in process_a (env CLIENT_DETECTOR_WORKERS)")
+    parser.add_argument("--detector", choices=DETECTORS, default=os.environ.get("CLIENT_DETECTOR", "full"),
+                        help="full frame scan, search around the last position or track every ball (env CLIENT_DETECTOR)")
+    parser.add_argument("--luma", action="store_true", default=os.environ.get("CLIENT_LUMA") == "1",
+                        help="detect on the luma plane of the decoded frames instead of BGR images (env CLIENT_LUMA=1)")
+    parser.add_argument("--headless", action="store_true", default=os.environ.get("CLIENT_HEADLESS") == "1",
+                        help="do not open the preview window (env CLIENT_HEADLESS=1)")
+    parser.add_argument("--preview-fps", type=float, default=float(os.environ.get("CLIENT_PREVIEW_FPS", 10)),
+                        help="maximum frame rate of the preview window (env CLIENT_PREVIEW_FPS)")
+    parser.add_argument("--protocol", choices=PROTOCOLS, default=os.environ.get("CLIENT_PROTOCOL", "json"),
+                        help="format of the coordinate messages (env CLIENT_PROTOCOL)")
+    parser.add_argument("--flush-interval", type=float, default=float(os.environ.get("CLIENT_FLUSH_INTERVAL", 0)),
+                        help="seconds to batch binary coordinate messages for, 0 sends every frame (env CLIENT_FLUSH_INTERVAL)")
+    parser.add_argument("--host", default=os.environ.get("SIGNALING_HOST", "localhost"),
+                        help="signaling address of the server (env SIGNALING_HOST)")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("SIGNALING_PORT", 9000)),
+                        help="signaling port of the server (env SIGNALING_PORT)")
+    parser.add_argument("--slots", type=int, default=int(os.environ.get("CLIENT_FRAME_SLOTS", 0)),
+                        help="frame slots in the shared memory ring, defaults to workers + 2 (env CLIENT_FRAME_SLOTS)")
+    parser.add_argument("--predict", action="store_true", default=os.environ.get("CLIENT_PREDICT") == "1",
+                        help="send where the ball will be when the result arrives, measured from the server's lag feedback (env CLIENT_PREDICT=1)")
+    parser.add_argument("--update-every", type=int, default=int(os.environ.get("CLIENT_UPDATE_EVERY", 1)),
+                        help="with --predict, send a prediction for every Nth frame only (env CLIENT_UPDATE_EVERY)")
+    parser.add_argument("--metrics-port", type=int, default=int(os.environ.get("CLIENT_METRICS_PORT", 0)),
+                        help="serve per-stage timings in the Prometheus text format on this port, 0 disables it (env CLIENT_METRICS_PORT)")
+    parser.add_argument("--metrics-file", default=os.environ.get("CLIENT_METRICS_FILE"),
+                        help="file to write a JSON snapshot of the per-stage timings to (env CLIENT_METRICS_FILE)")
+    parser.add_argument("--metrics-interval", type=float, default=float(os.environ.get("CLIENT_METRICS_INTERVAL", 5)),
+                        help="seconds between two metrics snapshots (env CLIENT_METRICS_INTERVAL)")
+    args = parser.parse_args()
+    if args.detector == "multi" and args.protocol != "binary":
+        parser.error("--detector multi sends track ids, which needs --protocol binary")
+    if args.detector in ("roi", "multi") and args.workers > 1:
+        # the workers would share one tracker and update it from frames out of order
+        parser.error("--detector {} follows the ball from frame to frame, it needs a single worker".format(args.detector))
+    if args.predict and args.detector == "multi":
+        parser.error("--predict follows a single ball, it can't be used with --detector multi")
+    if args.update_every < 1:
+        parser.error("--update-every must be at least 1")
+    # every worker holds one slot while detecting, leave room for the producer on top of that
+    image_queue = FrameRing(channels=1 if args.luma else 3, num_slots=args.slots or args.workers + 2, policy=args.policy)
+    coordinate_record = CoordinateRecord(MAX_OBJECTS)
+    metrics = None
+    if args.metrics_port or args.metrics_file:
+        # created before process_a starts, so its detections are recorded in the same shared memory
+        metrics = Metrics("client", STAGES)
+        metrics.gauge("queue_depth", image_queue.qsize)
+        metrics.gauge("dropped_frames", lambda: image_queue.dropped)
+    detector_ready = Value('d', 0.0)
+    timer.watch("detector_ready", lambda: detector_ready.value)
+    # forked before the logging thread below starts, process_a warms up its detector while the connection is set up
+    image_process = Process(target=process_a, args=(image_queue, x_coordinate, y_coordinate, new_coordinates_generated, None, args.workers, args.detector, coordinate_record, metrics, detector_ready))
+    image_process.start()
+    timer.mark("process_a_started")
     log_file_path = create_file(os.path.join(os.getcwd(), "logs"),"client.log")
     print(f"Logging in file: {log_file_path}")
     logger = setup_logging("client", log_file_path)
     logger.info("started_client")
-    image_process = Process(target=process_a, args=(image_queue, x_coordinate, y_coordinate, new_coordinates_generated))
-    image_process.start()
     logger.info("started_process_a")
-    signaling = TcpSocketSignaling("localhost", 9000)
+    snapshots = None
+    if metrics is not None:
+        # the exporter threads start after the fork, process_a has no use for them
+        snapshots = start_metrics(metrics, "localhost", args.metrics_port, args.metrics_file, args.metrics_interval)
+    signaling = TcpSocketSignaling(args.host, args.port)
     logger.info("prepared tcp-socket-signaling object")
     pc = RTCPeerConnection()
     loop = asyncio.get_event_loop()
@@ -172,6 +533,15 @@ if __name__ == "__main__":
                 pc=pc,
                 signaling=signaling,
                 logger=logger,
+                luma=args.luma,
+                preview_fps=0 if args.headless else args.preview_fps,
+                protocol=args.protocol,
+                flush_interval=args.flush_interval,
+                tracks=args.detector == "multi",
+                update_every=args.update_every if args.predict else 0,
+                metrics=metrics,
+                record=coordinate_record,
+                timer=timer,
             )
         )
     except KeyboardInterrupt:
@@ -179,4 +549,9 @@ if __name__ == "__main__":
     finally:
         loop.run_until_complete(signaling.close())
         loop.run_until_complete(pc.close())
+        image_queue.put(None)
         image_process.join()
+        image_queue.close()
+        if snapshots is not None:
+            # the detections of process_a are all recorded now
+            snapshots.set()
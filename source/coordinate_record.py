@@ -0,0 +1,102 @@
+from multiprocessing import Array, Pipe
+import numpy as np
+
+SEQ, X, Y, PENDING, COUNT = range(5)
+OBJECTS = 5  # start of the (x, y, track id) rows of publish_objects
+
+class CoordinateRecord:
+    """
+    The latest (seq, x, y) coordinates of the ball, shared between the detector process and the event loop.
+
+    The three fields are written and read together under one lock, so a reader never sees the x of one frame
+    with the y of another. Every publish makes the reader end of a pipe readable, so the event loop can
+    wait for it with loop.add_reader() instead of polling. At most one notification is in the pipe at a
+    time, so the detector never blocks on a reader that is busy.
+
+    A record created with max_objects can hold every object found in a frame the same way, see publish_objects.
+    """
+    def __init__(self, max_objects: int = 0):
+        """
+        Args:
+            max_objects (int, optional): Room for the objects of publish_objects, extra objects are dropped.
+                Defaults to 0.
+        """
+        self.max_objects = max_objects
+        self._record = Array('q', OBJECTS + 3 * max_objects)
+        self._reader, self._writer = Pipe(duplex=False)
+
+    def _objects(self) -> np.ndarray:
+        return np.frombuffer(self._record.get_obj(), dtype=np.int64)[OBJECTS:].reshape(self.max_objects, 3)
+
+    def publish(self, seq: int, x: int, y: int):
+        """
+        Store new coordinates and wake up the reader.
+
+        Args:
+            seq (int): Sequence number of the frame the coordinates were found in.
+            x (int): The x-coordinate of the ball.
+            y (int): The y-coordinate of the ball.
+        """
+        with self._record.get_lock():
+            self._record[SEQ], self._record[X], self._record[Y] = seq, x, y
+            notify = not self._record[PENDING]
+            self._record[PENDING] = 1
+            if notify:
+                self._writer.send_bytes(b"")
+
+    def publish_objects(self, seq: int, objects: np.ndarray):
+        """
+        Store every object found in a frame and wake up the reader.
+
+        Args:
+            seq (int): Sequence number of the frame the objects were found in.
+            objects (np.ndarray): (n, 3) x, y, track id of every object.
+        """
+        count = min(len(objects), self.max_objects)
+        with self._record.get_lock():
+            self._record[SEQ], self._record[COUNT] = seq, count
+            if count:
+                self._record[X], self._record[Y] = objects[0][:2]
+                self._objects()[:count] = objects[:count]
+            notify = not self._record[PENDING]
+            self._record[PENDING] = 1
+            if notify:
+                self._writer.send_bytes(b"")
+
+    def fileno(self) -> int:
+        """
+        File descriptor that becomes readable when new coordinates are published.
+        """
+        return self._reader.fileno()
+
+    def receive(self):
+        """
+        Consume the pending notification, call this when fileno() is readable.
+
+        Returns:
+            tuple: The latest (seq, x, y).
+        """
+        self._reader.recv_bytes()
+        with self._record.get_lock():
+            self._record[PENDING] = 0
+            return self._record[SEQ], self._record[X], self._record[Y]
+
+    def receive_objects(self):
+        """
+        Same as receive, for the objects stored with publish_objects.
+
+        Returns:
+            tuple: (seq, (n, 3) array of the x, y, track id of every object).
+        """
+        self._reader.recv_bytes()
+        with self._record.get_lock():
+            self._record[PENDING] = 0
+            return self._record[SEQ], self._objects()[:self._record[COUNT]].copy()
+
+    def read(self):
+        """
+        Returns:
+            tuple: The latest (seq, x, y), without waiting or consuming the notification.
+        """
+        with self._record.get_lock():
+            return self._record[SEQ], self._record[X], self._record[Y]
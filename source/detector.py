@@ -0,0 +1,321 @@
+import cv2
+import numpy as np
+
+LUMA_THRESHOLD = 24  # black is 16 in a limited range luma plane, leave some headroom for codec noise
+
+def luma_plane(frame) -> np.ndarray:
+    """
+    Get the luma (Y) plane of a video frame as a numpy view of the frame's own buffer, without copying it.
+
+    Args:
+        frame (VideoFrame): A decoded frame, frames that are not in a YUV format are converted to yuv420p first.
+
+    Returns:
+        np.ndarray: A (height, width) uint8 view, which keeps the frame's buffer alive.
+    """
+    if not frame.format.name.startswith(("yuv", "nv12")):
+        frame = frame.reformat(format="yuv420p")
+    plane = frame.planes[0]
+    # rows may be padded up to line_size, slice the padding off instead of copying
+    return np.frombuffer(plane, np.uint8).reshape(plane.height, plane.line_size)[:, :plane.width]
+
+def threshold_image(image) -> np.ndarray:
+    """
+    Separate the balls from the black background.
+
+    Args:
+        image: A BGR image, or a single channel luma plane.
+
+    Returns:
+        np.ndarray: A binary image, 255 where there is a ball.
+    """
+    if image.ndim == 2:
+        # the luma plane is already a single channel image
+        _, threshold = cv2.threshold(image, LUMA_THRESHOLD, 255, cv2.THRESH_BINARY)
+    else:
+        # Convert the image to grayscale
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        # Apply a threshold to separate the ball from the background
+        _, threshold = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY)
+    return threshold
+
+def largest_contour(image):
+    """
+    Find the largest bright blob in the given image.
+
+    Args:
+        image: A BGR image, or a single channel luma plane.
+
+    Returns:
+        The contour with the largest area, or None if the image is completely black.
+    """
+    threshold = threshold_image(image)
+
+    # Find contours in the thresholded image, detect objects (ball)
+    contours, _ = cv2.findContours(threshold, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+
+    # Find the contour with the largest area, this will give the ball
+    return max(contours, key=cv2.contourArea)
+
+def find_ball(image):
+    """
+    Find the centre of the ball in the given image.
+
+    Args:
+        image: The image containing the ball, in BGR or a luma plane.
+
+    Returns:
+        tuple: (x, y) coordinates of the ball.
+    """
+    contour = largest_contour(image)
+    if contour is None:
+        raise ValueError("no ball found in the image")
+
+    # Find the minimum enclosing circle of the contour
+    ((center_x, center_y), radius) = cv2.minEnclosingCircle(contour)
+    return int(center_x), int(center_y)
+
+COARSE_WIDTH = 320  # pixels, the coarse image of find_ball_pyramid is at least this wide
+MAX_PYRAMID_FACTOR = 8
+
+def pyramid_factor(width: int) -> int:
+    """
+    The power of 2 find_ball_pyramid shrinks an image of the given width by, keeping it at least COARSE_WIDTH
+    wide so a small ball still covers a few coarse pixels: 2 at 480p, 4 at 720p and 1080p, and 8 at 4K.
+    """
+    factor = 1
+    while factor < MAX_PYRAMID_FACTOR and width // (factor * 2) >= COARSE_WIDTH:
+        factor *= 2
+    return factor
+
+def find_ball_pyramid(image, factor: int = None):
+    """
+    Find the centre of the ball coarse to fine: find the blob in every factor-th pixel of every factor-th row,
+    then take the centroid of the full resolution pixels in a patch around it. Only the patch is read at full
+    resolution, so the cost per frame stays about the same at any resolution.
+
+    Args:
+        image: The image containing the ball, in BGR or a luma plane.
+        factor (int, optional): How much to shrink the image by. Defaults to pyramid_factor of its width.
+
+    Returns:
+        tuple: (x, y) coordinates of the ball.
+    """
+    height, width = image.shape[:2]
+    if factor is None:
+        factor = pyramid_factor(width)
+    if factor == 1:
+        return find_ball(image)
+    # sampling a strided view copies 1/factor² of the pixels, an area averaging resize would read all of them.
+    # A ball can fall between the samples of one grid, but not between those of two grids half a step apart
+    # if its radius is at least factor / 2.
+    for offset in (0, factor // 2):
+        contour = largest_contour(np.ascontiguousarray(image[offset::factor, offset::factor]))
+        if contour is not None:
+            break
+    else:
+        return find_ball(image)
+    # the ball reaches up to one coarse pixel beyond the samples that hit it
+    bx, by, bw, bh = cv2.boundingRect(contour)
+    x0, y0 = max((bx - 1) * factor + offset, 0), max((by - 1) * factor + offset, 0)
+    x1, y1 = min((bx + bw + 1) * factor + offset, width), min((by + bh + 1) * factor + offset, height)
+    moments = cv2.moments(threshold_image(image[y0:y1, x0:x1]), binaryImage=True)
+    if not moments["m00"]:
+        return find_ball(image)
+    return int(moments["m10"] / moments["m00"]) + x0, int(moments["m01"] / moments["m00"]) + y0
+
+class RoiBallTracker:
+    """
+    Incremental ball detector that only searches a small window around the predicted position of the ball.
+
+    The prediction is the last position plus the last per-frame motion. If the ball is not found inside the
+    window, or touches its border (so it may be cut off), the whole frame is scanned instead.
+    """
+    def __init__(self, find_ball, search_radius: int = 32):
+        """
+        Args:
+            find_ball: Full frame detector, called as find_ball(image) and returns (x, y).
+            search_radius (int, optional): Half the side of the search window in pixels. Defaults to 32.
+        """
+        self.find_ball = find_ball
+        self.search_radius = search_radius
+        self.last_position = None
+        self.velocity = (0, 0)
+        self.full_scans = 0
+        self.window_hits = 0
+
+    def predict(self):
+        """
+        Returns:
+            tuple: The expected (x, y) position of the ball in the next frame, or None before the first detection.
+        """
+        if self.last_position is None:
+            return None
+        return self.last_position[0] + self.velocity[0], self.last_position[1] + self.velocity[1]
+
+    def _find_in_window(self, image, center):
+        height, width = image.shape[:2]
+        x0 = max(center[0] - self.search_radius, 0)
+        y0 = max(center[1] - self.search_radius, 0)
+        x1 = min(center[0] + self.search_radius + 1, width)
+        y1 = min(center[1] + self.search_radius + 1, height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        contour = largest_contour(image[y0:y1, x0:x1])
+        if contour is None:
+            return None
+        # a blob touching an inner edge of the window may continue outside of it
+        bx, by, bw, bh = cv2.boundingRect(contour)
+        if (bx == 0 and x0 > 0) or (by == 0 and y0 > 0) or (bx + bw == x1 - x0 and x1 < width) or (by + bh == y1 - y0 and y1 < height):
+            return None
+        ((center_x, center_y), radius) = cv2.minEnclosingCircle(contour)
+        return int(center_x) + x0, int(center_y) + y0
+
+    def find(self, image):
+        """
+        Find the centre of the ball, searching the window around the predicted position first.
+
+        Args:
+            image: The image containing the ball.
+
+        Returns:
+            tuple: (x, y) coordinates of the ball.
+        """
+        position = None
+        predicted = self.predict()
+        if predicted is not None:
+            position = self._find_in_window(image, predicted)
+        if position is None:
+            self.full_scans += 1
+            position = self.find_ball(image)
+        else:
+            self.window_hits += 1
+        if self.last_position is not None:
+            self.velocity = (position[0] - self.last_position[0], position[1] - self.last_position[1])
+        self.last_position = position
+        return position
+
+MIN_BALL_AREA = 4  # pixels, smaller blobs are codec noise
+
+def find_balls(image, min_area: int = MIN_BALL_AREA) -> np.ndarray:
+    """
+    Find the centre of every ball in the given image, with one connected components pass.
+
+    Args:
+        image: A BGR image, or a single channel luma plane.
+        min_area (int, optional): Smallest blob, in pixels, that counts as a ball. Defaults to MIN_BALL_AREA.
+
+    Returns:
+        np.ndarray: The (n, 2) float x, y centres of the balls.
+    """
+    # Grana's block based labelling is about three times faster than the default algorithm on mostly empty frames
+    _, _, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(threshold_image(image), 8, cv2.CV_32S, cv2.CCL_GRANA)
+    # label 0 is the background
+    return centroids[1:][stats[1:, cv2.CC_STAT_AREA] >= min_area]
+
+def greedy_assignment(distances: np.ndarray, max_distance: float):
+    """
+    Match rows to columns, closest pairs first, without matching pairs further apart than max_distance.
+
+    Every round matches all the pairs that are each other's nearest neighbour at once, which gives the same
+    result as taking the pairs one by one in order of distance, in a few vectorized rounds.
+
+    Args:
+        distances (np.ndarray): (rows, columns) distances.
+        max_distance (float): The largest distance of a matched pair.
+
+    Returns:
+        tuple: (row indexes, column indexes) of the matched pairs.
+    """
+    distances = np.where(distances <= max_distance, distances, np.inf)
+    matched_rows, matched_columns = [], []
+    while distances.size and np.isfinite(distances).any():
+        nearest_column = distances.argmin(axis=1)
+        nearest_row = distances.argmin(axis=0)
+        rows = np.flatnonzero((nearest_row[nearest_column] == np.arange(len(distances)))
+                              & np.isfinite(distances.min(axis=1)))
+        columns = nearest_column[rows]
+        matched_rows.append(rows)
+        matched_columns.append(columns)
+        distances[rows, :] = np.inf
+        distances[:, columns] = np.inf
+    if not matched_rows:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    return np.concatenate(matched_rows), np.concatenate(matched_columns)
+
+class MultiBallTracker:
+    """
+    Keeps the identity of many balls across frames.
+
+    Every track predicts its next position from its last motion, and the balls found in a frame are matched to
+    the predictions with greedy_assignment. Balls that match no track start a new one, and a track that is
+    not matched for more than max_missed frames is dropped.
+    """
+    def __init__(self, max_distance: float = 20, max_missed: int = 5):
+        """
+        Args:
+            max_distance (float, optional): Largest distance in pixels between a prediction and the ball it is
+                matched to. Defaults to 20.
+            max_missed (int, optional): Frames a track survives without a match. Defaults to 5.
+        """
+        self.max_distance = max_distance
+        self.max_missed = max_missed
+        self.ids = np.empty(0, dtype=np.int64)
+        self.positions = np.empty((0, 2))
+        self.velocities = np.empty((0, 2))
+        self.missed = np.empty(0, dtype=np.int64)
+        self.next_id = 0
+
+    def update(self, centres: np.ndarray) -> np.ndarray:
+        """
+        Match the balls found in a frame to the tracks.
+
+        Args:
+            centres (np.ndarray): The (n, 2) x, y centres of the balls, see find_balls.
+
+        Returns:
+            np.ndarray: (n, 3) int64 x, y, track id of every ball.
+        """
+        predicted = self.positions + self.velocities
+        distances = np.linalg.norm(predicted[:, None, :] - centres[None, :, :], axis=2)
+        rows, columns = greedy_assignment(distances, self.max_distance)
+        ids = np.empty(len(centres), dtype=np.int64)
+        ids[columns] = self.ids[rows]
+
+        # unmatched tracks coast along their prediction
+        self.velocities[rows] = centres[columns] - self.positions[rows]
+        self.positions = predicted
+        self.positions[rows] = centres[columns]
+        self.missed += 1
+        self.missed[rows] = 0
+        alive = self.missed <= self.max_missed
+
+        new = np.ones(len(centres), dtype=bool)
+        new[columns] = False
+        ids[new] = np.arange(self.next_id, self.next_id + new.sum())
+        self.next_id += int(new.sum())
+
+        self.ids = np.concatenate((self.ids[alive], ids[new]))
+        self.positions = np.concatenate((self.positions[alive], centres[new]))
+        self.velocities = np.concatenate((self.velocities[alive], np.zeros((new.sum(), 2))))
+        self.missed = np.concatenate((self.missed[alive], np.zeros(new.sum(), dtype=np.int64)))
+
+        objects = np.empty((len(centres), 3), dtype=np.int64)
+        objects[:, :2] = np.rint(centres)
+        objects[:, 2] = ids
+        return objects
+
+    def find(self, image) -> np.ndarray:
+        """
+        Find and identify every ball in an image.
+
+        Args:
+            image: A BGR image, or a single channel luma plane.
+
+        Returns:
+            np.ndarray: (n, 3) int64 x, y, track id of every ball.
+        """
+        return self.update(find_balls(image))
@@ -0,0 +1,80 @@
+import threading
+from collections import deque
+
+class ReorderBuffer:
+    """
+    Publishes results in the order their frames were taken off the ring, whatever order the workers finish in.
+    """
+    def __init__(self, publish):
+        """
+        Args:
+            publish: Called as publish(seq, result) for every result, in increasing seq order.
+        """
+        self._publish = publish
+        self._lock = threading.Lock()
+        self._in_flight = deque()
+        self._done = {}
+
+    def dispatch(self, seq: int):
+        """
+        Register a frame that a worker has started on. Must be called in increasing seq order.
+        """
+        with self._lock:
+            self._in_flight.append(seq)
+
+    def complete(self, seq: int, result):
+        """
+        Store the result of a dispatched frame and publish every result that is no longer waiting on an older frame.
+        A result of None (failed detection) releases the frame without publishing anything.
+        """
+        with self._lock:
+            self._done[seq] = result
+            while self._in_flight and self._in_flight[0] in self._done:
+                head = self._in_flight.popleft()
+                head_result = self._done.pop(head)
+                if head_result is not None:
+                    self._publish(head, head_result)
+
+def run_detector_pool(image_queue, detect, publish, num_of_workers: int, logger, on_frame=None):
+    """
+    Run detect() on frames from image_queue in num_of_workers threads until None is received.
+    cv2 releases the GIL, so the threads detect in parallel within a single process.
+
+    Args:
+        image_queue: The FrameRing for receiving image frames.
+        detect: Called as detect(image) and returns the result for the frame.
+        publish: Called as publish(seq, result) in frame order.
+        num_of_workers (int): Number of detector threads.
+        logger: The logger object for logging messages.
+        on_frame (optional): Called with no arguments after every frame taken off the queue.
+    """
+    reorder_buffer = ReorderBuffer(publish)
+    take_lock = threading.Lock()
+
+    def worker():
+        while True:
+            # taking the frame and registering it happen together, so frames are dispatched in seq order
+            with take_lock:
+                seq, image = image_queue.get_frame()
+                if seq is not None:
+                    reorder_buffer.dispatch(seq)
+            if seq is None:
+                # wake up the next worker
+                image_queue.put(None)
+                break
+            result = None
+            try:
+                result = detect(image)
+            except Exception as e:
+                logger.error("error_in_detecting_frame seq={} {}".format(seq, e))
+            finally:
+                reorder_buffer.complete(seq, result)
+            if on_frame is not None:
+                on_frame()
+        image_queue.release()
+
+    workers = [threading.Thread(target=worker, name="detector-{}".format(i), daemon=True) for i in range(num_of_workers)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
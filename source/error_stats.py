@@ -0,0 +1,95 @@
+import bisect
+import math
+import time
+from metrics import quantile
+
+# upper bounds in pixels of the error histogram buckets, one per pixel up to 32 then coarser
+ERROR_BUCKETS = tuple(i + 0.5 for i in range(32)) + (47.5, 63.5, 95.5, 127.5, 255.5, 511.5, 1023.5)
+AXES = ("x", "y", "distance")
+
+class StreamingStats:
+    """
+    Count, mean, RMSE, maximum and approximate quantiles of a stream of errors, in constant memory.
+
+    The quantiles are of the absolute error, interpolated within fixed histogram buckets, so they are exact to
+    within a pixel up to 32 pixels.
+    """
+    def __init__(self, buckets: tuple = ERROR_BUCKETS):
+        self.buckets = buckets
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.max = 0.0
+        self.counts = [0] * (len(buckets) + 1)
+
+    def add(self, error: float):
+        magnitude = abs(error)
+        self.count += 1
+        self.total += error
+        self.total_squares += error * error
+        if magnitude > self.max:
+            self.max = magnitude
+        self.counts[bisect.bisect_left(self.buckets, magnitude)] += 1
+
+    def summary(self) -> dict:
+        """
+        Returns:
+            dict: count, mean (signed, the bias of the errors), rmse, max of the absolute error, and the p50, p95
+                and p99 of the absolute error.
+        """
+        if not self.count:
+            return {"count": 0}
+        summary = {
+            "count": self.count,
+            "mean": round(self.total / self.count, 3),
+            "rmse": round(math.sqrt(self.total_squares / self.count), 3),
+            "max": round(self.max, 3),
+        }
+        for q in (0.5, 0.95, 0.99):
+            summary["p{}".format(round(q * 100))] = round(quantile(self.buckets, self.counts, q), 2)
+        return summary
+
+class ErrorAggregator:
+    """
+    Streaming statistics of the x, y and Euclidean errors of one session, since it started and in the window
+    since the previous snapshot.
+    """
+    def __init__(self):
+        self.total = {axis: StreamingStats() for axis in AXES}
+        self.window = {axis: StreamingStats() for axis in AXES}
+        self.window_start = time.monotonic()
+
+    def add(self, error_x: float, error_y: float):
+        """
+        Add the (x, y) error of one result.
+        """
+        distance = math.hypot(error_x, error_y)
+        for stats in (self.total, self.window):
+            stats["x"].add(error_x)
+            stats["y"].add(error_y)
+            stats["distance"].add(distance)
+
+    def add_distance(self, distance: float):
+        """
+        Add the Euclidean error of a result whose x and y errors are not known, such as a matched track.
+        """
+        self.total["distance"].add(distance)
+        self.window["distance"].add(distance)
+
+    def snapshot(self) -> dict:
+        """
+        Summarize the totals and the window, and start a new window.
+
+        Returns:
+            dict: The length of the window in seconds, and the StreamingStats.summary of every axis of the window
+                and of the totals.
+        """
+        now = time.monotonic()
+        snapshot = {
+            "window_seconds": round(now - self.window_start, 1),
+            "window": {axis: stats.summary() for axis, stats in self.window.items()},
+            "total": {axis: stats.summary() for axis, stats in self.total.items()},
+        }
+        self.window = {axis: StreamingStats() for axis in AXES}
+        self.window_start = now
+        return snapshot
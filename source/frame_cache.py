@@ -0,0 +1,67 @@
+import os
+import numpy as np
+
+CACHE_VERSION = 1  # bump when the rendering of the sequence changes
+
+def sequence_key(width: int, height: int, num_of_frames: int, radius: int, speed: int) -> str:
+    """
+    Name of the cache entry of a rendered sequence, made of every parameter that changes its pixels.
+    """
+    return "bouncing_ball_v{}_{}x{}_n{}_r{}_s{}".format(CACHE_VERSION, width, height, num_of_frames, radius, speed)
+
+def _paths(cache_dir: str, key: str):
+    return os.path.join(cache_dir, key + ".frames.npy"), os.path.join(cache_dir, key + ".coordinates.npy")
+
+def load_sequence(cache_dir: str, key: str):
+    """
+    Open a cached sequence as a read-only memory map, so the frames are paged in by the OS on first use
+    and shared between every process that opens the same entry.
+
+    Args:
+        cache_dir (str): The cache directory.
+        key (str): The entry, see sequence_key.
+
+    Returns:
+        tuple: (frames array of shape (num_of_frames, height, width, 3), list of (x, y) coordinates),
+            or None if the entry does not exist.
+    """
+    frames_path, coordinates_path = _paths(cache_dir, key)
+    # the frames file is renamed into place last, so its presence means the entry is complete
+    if not os.path.isfile(frames_path):
+        return None
+    frames = np.load(frames_path, mmap_mode="r")
+    coordinates = [tuple(xy) for xy in np.load(coordinates_path).tolist()]
+    return frames, coordinates
+
+def create_sequence(cache_dir: str, key: str, shape: tuple) -> np.memmap:
+    """
+    Create a writable memory map to render a new entry into, in a temporary file of this process.
+
+    Args:
+        cache_dir (str): The cache directory, created if it doesn't exist.
+        key (str): The entry, see sequence_key.
+        shape (tuple): (num_of_frames, height, width, 3).
+
+    Returns:
+        np.memmap: The array to render the frames into.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    frames_path, _ = _paths(cache_dir, key)
+    return np.lib.format.open_memmap("{}.{}.tmp".format(frames_path, os.getpid()), mode="w+", dtype=np.uint8, shape=shape)
+
+def save_sequence(cache_dir: str, key: str, frames: np.memmap, coordinates: list):
+    """
+    Store the coordinates next to a sequence rendered into create_sequence's array and publish the entry.
+    Several processes may render the same entry at once, the last rename wins.
+
+    Returns:
+        tuple: The entry opened again with load_sequence.
+    """
+    frames_path, coordinates_path = _paths(cache_dir, key)
+    frames.flush()
+    coordinates_tmp_path = "{}.{}.tmp".format(coordinates_path, os.getpid())
+    with open(coordinates_tmp_path, "wb") as file:
+        np.save(file, np.asarray(coordinates, dtype=np.int32).reshape(-1, 2))
+    os.replace(coordinates_tmp_path, coordinates_path)
+    os.replace(frames.filename, frames_path)
+    return load_sequence(cache_dir, key)
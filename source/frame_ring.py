@@ -0,0 +1,195 @@
+import queue
+import threading
+import time
+from multiprocessing import Queue, Value, shared_memory
+import numpy as np
+
+POLICIES = ("latest", "bounded")
+SLOT_POLL_INTERVAL = 0.005  # seconds between two checks for a slot when put() has to wait
+
+class FrameRing:
+    """
+    A fixed-size ring of frame slots in shared memory, used in place of a multiprocessing.Queue of images.
+
+    The producer copies each frame into a free slot and only the (sequence, slot, shape) record travels
+    through a queue, so the pixel data is never pickled. The consumer gets a numpy view of the slot, which
+    stays valid until its next call to get()/get_frame() or release(), after which the slot is reused.
+    Several consumer threads may share one ring, each of them holds at most one slot at a time.
+
+    When the consumers fall behind, the policy decides which frames are dropped:
+        latest: put() reuses the slot of the oldest waiting frame and get() skips ahead to the newest one,
+            so consumers always work on the most recent frame.
+        bounded: frames are kept in order and put() drops the incoming frame once every slot is taken.
+    """
+    def __init__(self, width: int = 640, height: int = 480, channels: int = 3, num_slots: int = 8, policy: str = "latest"):
+        """
+        Allocate the shared memory block and mark every slot as free.
+
+        Args:
+            width (int, optional): Largest frame width the ring has to hold. Defaults to 640.
+            height (int, optional): Largest frame height the ring has to hold. Defaults to 480.
+            channels (int, optional): Number of channels per pixel. Defaults to 3.
+            num_slots (int, optional): Number of frames that can be in flight at once. Defaults to 8.
+            policy (str, optional): "latest" or "bounded", see the class docstring. Defaults to "latest".
+
+        Raises:
+            ValueError: If the policy is unknown.
+        """
+        if policy not in POLICIES:
+            raise ValueError("unknown policy {}, expected one of {}".format(policy, POLICIES))
+        self.policy = policy
+        self.num_slots = num_slots
+        self.slot_size = width * height * channels
+        self.dtype = np.dtype(np.uint8)
+        self._shm = shared_memory.SharedMemory(create=True, size=self.slot_size * num_slots)
+        self._free = Queue()
+        self._ready = Queue()
+        for slot in range(num_slots):
+            self._free.put(slot)
+        self._dropped = Value('i', 0)
+        self._seq = 0
+        self._held = {}  # consumer thread id -> slot it is reading
+        self._owner = True
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # only the creating process unlinks the shared memory, and a slot is never held across processes
+        state["_owner"] = False
+        state["_held"] = {}
+        return state
+
+    @property
+    def dropped(self) -> int:
+        """
+        Number of frames dropped by the policy so far, across all processes.
+        """
+        return self._dropped.value
+
+    def _count_drop(self):
+        with self._dropped.get_lock():
+            self._dropped.value += 1
+
+    def _acquire_slot(self, block: bool, timeout: float):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return self._free.get_nowait()
+            except queue.Empty:
+                pass
+            if self.policy == "latest":
+                try:
+                    item = self._ready.get_nowait()
+                except queue.Empty:
+                    item = False
+                if item is None:
+                    # leave the stop marker for the consumer
+                    self._ready.put(None)
+                elif item:
+                    self._count_drop()
+                    return item[1]
+            # every slot is taken by a consumer (latest) or the ring is full (bounded)
+            if not block or (deadline is not None and time.monotonic() >= deadline):
+                return None
+            # poll, a waiting frame may show up in the ready queue while we wait for a free slot
+            try:
+                return self._free.get(timeout=SLOT_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+
+    def _slot_view(self, slot: int, shape: tuple) -> np.ndarray:
+        return np.ndarray(shape, dtype=self.dtype, buffer=self._shm.buf, offset=slot * self.slot_size)
+
+    def put(self, image: np.ndarray, block: bool = True, timeout: float = None, seq: int = None) -> bool:
+        """
+        Copy a frame into a free slot and publish it to the consumer.
+
+        Args:
+            image (np.ndarray): The frame to publish, or None to tell the consumer to stop.
+            block (bool, optional): Wait for a free slot if the policy cannot provide one. Defaults to True.
+            timeout (float, optional): Maximum time to wait for a free slot. Defaults to None.
+            seq (int, optional): Sequence number of the frame, such as its pts. Must increase from frame to frame.
+                Defaults to a counter of the frames put.
+
+        Returns:
+            bool: False if the frame was dropped because no slot was available.
+
+        Raises:
+            ValueError: If the frame does not fit in a slot.
+        """
+        if image is None:
+            self._ready.put(None)
+            return True
+        if image.nbytes > self.slot_size:
+            raise ValueError("frame of {} bytes does not fit in a slot of {} bytes".format(image.nbytes, self.slot_size))
+        slot = self._acquire_slot(block, timeout)
+        if slot is None:
+            self._count_drop()
+            return False
+        np.copyto(self._slot_view(slot, image.shape), image, casting="unsafe")
+        self._seq = self._seq + 1 if seq is None else seq
+        self._ready.put((self._seq, slot, image.shape))
+        return True
+
+    def get_frame(self, block: bool = True, timeout: float = None):
+        """
+        Release the previously returned slot and wait for the next frame.
+
+        Args:
+            block (bool, optional): Wait for a frame if none is ready. Defaults to True.
+            timeout (float, optional): Maximum time to wait for a frame. Defaults to None.
+
+        Returns:
+            tuple: (sequence number, image view), or (None, None) once the producer has put None.
+
+        Raises:
+            queue.Empty: If no frame became ready in time.
+        """
+        self.release()
+        item = self._ready.get(block, timeout)
+        while item is not None and self.policy == "latest":
+            try:
+                newer = self._ready.get_nowait()
+            except queue.Empty:
+                break
+            if newer is None:
+                # leave the stop marker for the next call
+                self._ready.put(None)
+                break
+            self._free.put(item[1])
+            self._count_drop()
+            item = newer
+        if item is None:
+            return None, None
+        seq, slot, shape = item
+        self._held[threading.get_ident()] = slot
+        return seq, self._slot_view(slot, shape)
+
+    def get(self, block: bool = True, timeout: float = None) -> np.ndarray:
+        """
+        Same as get_frame() but returns only the image, matching multiprocessing.Queue.get().
+        """
+        return self.get_frame(block, timeout)[1]
+
+    def release(self):
+        """
+        Hand the slot returned to this thread by the last get()/get_frame() back to the producer.
+        """
+        slot = self._held.pop(threading.get_ident(), None)
+        if slot is not None:
+            self._free.put(slot)
+
+    def qsize(self) -> int:
+        """
+        Number of frames published but not yet taken by the consumer.
+        """
+        return self._ready.qsize()
+
+    def close(self):
+        """
+        Detach from the shared memory, and free it if this is the process that created the ring.
+        Views returned by get() must not be used after this.
+        """
+        self.release()
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
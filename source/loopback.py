@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import os
+import threading
+import time
+import numpy as np
+from multiprocessing import Value
+from aiortc import RTCPeerConnection
+from aiortc.contrib.signaling import BYE, BaseSignaling, object_from_string, object_to_string
+from Logger.logger import setup_logging
+from helper import create_file
+from protocol import PROTOCOLS
+from frame_ring import FrameRing
+from coordinate_record import CoordinateRecord
+import client
+import server
+
+class LoopbackSignaling(BaseSignaling):
+    """
+    One end of an in-memory signaling channel, see create_signaling_pair. Objects go through the same string
+    format as TcpSocketSignaling, so both ends get their own copies.
+    """
+    def __init__(self):
+        self._inbox = asyncio.Queue()
+        self.peer = None
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        await self.send(BYE)
+
+    async def receive(self):
+        return object_from_string(await self._inbox.get())
+
+    async def send(self, descr):
+        await self.peer._inbox.put(object_to_string(descr))
+
+def create_signaling_pair():
+    """
+    Returns:
+        tuple: (server end, client end) of a new in-memory signaling channel.
+    """
+    server_end, client_end = LoopbackSignaling(), LoopbackSignaling()
+    server_end.peer, client_end.peer = client_end, server_end
+    return server_end, client_end
+
+async def run_pair(index: int, duration: float, logger, detector: str = "full", luma: bool = True, protocol: str = "json", packet_cache: bool = False) -> server.ResultStats:
+    """
+    Run the server's and the client's run() against each other in this event loop for duration seconds, with
+    process_a on a thread, then say BYE from both ends and clean up.
+
+    Args:
+        index (int): Number of the pair, used in its logger names.
+        duration (float): Seconds to stream for once the coroutines are started.
+        detector (str, optional): Name of the client's detector. Defaults to "full".
+        luma (bool, optional): Detect on the luma plane. Defaults to True.
+        protocol (str, optional): Format of the coordinate messages. Defaults to "json".
+        packet_cache (bool, optional): Replay pre-encoded packets instead of encoding every frame. Defaults to False.
+
+    Returns:
+        ResultStats: The error and latency of the pair's results, as scored by its server.
+    """
+    pair_logger = logger.getChild("pair{}".format(index))
+    server_signaling, client_signaling = create_signaling_pair()
+    server_pc, client_pc = server.create_peer_connection(), RTCPeerConnection()
+    stats = server.ResultStats()
+    frame_queue = FrameRing(channels=1 if luma else 3, num_slots=3)
+    record = CoordinateRecord(client.MAX_OBJECTS)
+    detector_thread = threading.Thread(
+        target=client.process_a, name="process_a_pair{}".format(index),
+        args=(frame_queue, Value('i', 0), Value('i', 0), Value('b', False), pair_logger.getChild("process_a"), 1, detector, record))
+    detector_thread.start()
+    server_task = asyncio.ensure_future(server.run(server_pc, server_signaling, pair_logger.getChild("server"), lazy=True,
+                                                   packet_cache=packet_cache, stats=stats))
+    client_task = asyncio.ensure_future(client.run(client_pc, client_signaling, pair_logger.getChild("client"), luma=luma,
+                                                   preview_fps=0, protocol=protocol, tracks=detector == "multi",
+                                                   frame_queue=frame_queue, record=record))
+    try:
+        await asyncio.sleep(duration)
+        # the server logs its stats when the client says BYE, then tells the client to stop too
+        await client_signaling.close()
+        await asyncio.wait_for(server_task, 10)
+        await server_signaling.close()
+        await asyncio.wait_for(client_task, 10)
+    finally:
+        for task in (server_task, client_task):
+            task.cancel()
+        await client_pc.close()
+        await server_pc.close()
+        frame_queue.put(None)
+        await asyncio.get_running_loop().run_in_executor(None, detector_thread.join)
+        frame_queue.close()
+    return stats
+
+def summarize(results: list, duration: float, elapsed: float) -> dict:
+    """
+    Args:
+        results (list): The ResultStats of every pair.
+        duration (float): Seconds every pair streamed for, including the connection setup.
+        elapsed (float): Seconds the whole run took, including the shutdown.
+
+    Returns:
+        dict: Results per second of streaming, over all pairs, and the error and latency percentiles over the
+            results of every pair.
+    """
+    received = sum(stats.received for stats in results)
+    summary = {"pairs": len(results), "received": received, "results_per_sec": round(received / duration, 1),
+               "unmatched": sum(stats.unmatched for stats in results), "elapsed_s": round(elapsed, 1)}
+    for name, samples, scale in (("error_px", [error for stats in results for error in stats.errors], 1),
+                                 ("latency_ms", [latency for stats in results for latency in stats.latencies], 1000)):
+        if samples:
+            for percentile, value in zip((50, 95, 99), np.percentile(samples, (50, 95, 99))):
+                summary["{}_p{}".format(name, percentile)] = round(float(value) * scale, 2)
+    return summary
+
+async def run_loopback(num_of_pairs: int, duration: float, logger, detector: str = "full", luma: bool = True, protocol: str = "json", packet_cache: bool = False) -> dict:
+    """
+    Run num_of_pairs client/server pairs at once in this event loop, see run_pair.
+
+    Returns:
+        dict: The aggregate of all pairs, see summarize.
+    """
+    start = time.perf_counter()
+    results = await asyncio.gather(*(run_pair(index, duration, logger, detector, luma, protocol, packet_cache)
+                                     for index in range(1, num_of_pairs + 1)))
+    for index, stats in enumerate(results, 1):
+        logger.info("pair%d result_stats = %s", index, stats.report())
+    return summarize(results, duration, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run client/server pairs in one process, without sockets or a display")
+    parser.add_argument("--pairs", type=int, default=int(os.environ.get("LOOPBACK_PAIRS", 1)),
+                        help="number of client/server pairs (env LOOPBACK_PAIRS)")
+    parser.add_argument("--duration", type=float, default=float(os.environ.get("LOOPBACK_DURATION", 10)),
+                        help="seconds every pair streams for (env LOOPBACK_DURATION)")
+    parser.add_argument("--detector", choices=client.DETECTORS, default=os.environ.get("CLIENT_DETECTOR", "full"),
+                        help="detector of the clients (env CLIENT_DETECTOR)")
+    parser.add_argument("--bgr", action="store_true", help="detect on BGR images instead of the luma plane")
+    parser.add_argument("--protocol", choices=PROTOCOLS, default=os.environ.get("CLIENT_PROTOCOL", "json"),
+                        help="format of the coordinate messages (env CLIENT_PROTOCOL)")
+    parser.add_argument("--packet-cache", action="store_true", default=os.environ.get("SERVER_PACKET_CACHE") == "1",
+                        help="servers replay pre-encoded packets instead of encoding (env SERVER_PACKET_CACHE=1)")
+    args = parser.parse_args()
+    if args.detector == "multi" and args.protocol != "binary":
+        parser.error("--detector multi sends track ids, which needs --protocol binary")
+    log_file_path = create_file(os.path.join(os.getcwd(), "logs"), "loopback.log")
+    print(f"Logging in file: {log_file_path}")
+    logger = setup_logging("loopback", log_file_path)
+    summary = asyncio.run(run_loopback(args.pairs, args.duration, logger, args.detector, not args.bgr, args.protocol, args.packet_cache))
+    logger.info("loopback_summary = %s", summary)
+    print("loopback pairs={} results/s={} latency_ms_p50={} latency_ms_p99={} error_px_p50={}".format(
+        summary["pairs"], summary["results_per_sec"], summary.get("latency_ms_p50"), summary.get("latency_ms_p99"), summary.get("error_px_p50")))
@@ -0,0 +1,223 @@
+import bisect
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Lock
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+# upper bounds in seconds of the histogram buckets, the last bucket is everything above
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+MAX_MARKS = 256  # frames waiting for observe_since, older ones are forgotten (dropped frames never arrive)
+
+class Histogram:
+    """
+    Counts of the durations of one stage in fixed buckets, in shared memory.
+
+    The counts are created before the detector process is started, so that process records into the same
+    memory and the exporters of the main process see its stages too. A stage can be written by several
+    detector threads at once, so an observation takes a lock shared by the processes.
+    """
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self._counts = RawArray('q', len(buckets) + 1)
+        self._sum = RawValue('d', 0.0)
+        self._lock = Lock()
+
+    def observe(self, seconds: float):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum.value += seconds
+
+    def read(self):
+        """
+        Returns:
+            tuple: (count of every bucket, sum of the durations in seconds).
+        """
+        with self._lock:
+            return list(self._counts), self._sum.value
+
+def quantile(buckets: tuple, counts: list, q: float) -> float:
+    """
+    Estimate a quantile of the observations of a histogram, interpolating within the bucket it falls in.
+
+    Returns:
+        float: The quantile in seconds, None without observations.
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for index, count in enumerate(counts):
+        if count and seen + count >= rank:
+            low = buckets[index - 1] if index else 0.0
+            # the last bucket has no upper bound, report its lower one
+            high = buckets[index] if index < len(buckets) else low
+            return low + (high - low) * (rank - seen) / count
+        seen += count
+    return buckets[-1]
+
+class Metrics:
+    """
+    Per-stage duration histograms and gauges of one program, exported by serve_metrics and write_snapshots.
+
+    Code that is not given a Metrics (None) skips its timing entirely, so disabled metrics cost one comparison.
+    """
+    def __init__(self, prefix: str, stages: tuple):
+        """
+        Args:
+            prefix (str): Prefix of the exported metric names, such as "client".
+            stages (tuple): Names of the stages that are timed, every histogram is created up front.
+        """
+        self.prefix = prefix
+        self.histograms = {stage: Histogram() for stage in stages}
+        self.gauges = {}
+        self._marks = OrderedDict()
+        self._previous = {}  # stage -> counts at the last snapshot
+
+    def observe(self, stage: str, seconds: float):
+        self.histograms[stage].observe(seconds)
+
+    def timed(self, stage: str, function):
+        """
+        Returns:
+            A function that calls function and records how long it took in stage.
+        """
+        histogram = self.histograms[stage]
+
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return timed_function
+
+    def mark(self, key):
+        """
+        Remember the current time for key, such as the seq of a frame, see observe_since.
+        """
+        self._marks[key] = time.perf_counter()
+        if len(self._marks) > MAX_MARKS:
+            self._marks.popitem(last=False)
+
+    def observe_since(self, stage: str, key):
+        """
+        Record the time since key was marked in stage, if it was.
+        """
+        start = self._marks.pop(key, None)
+        if start is not None:
+            self.histograms[stage].observe(time.perf_counter() - start)
+
+    def gauge(self, name: str, read):
+        """
+        Export the value returned by read() when the metrics are exported, such as a queue depth.
+        """
+        self.gauges[name] = read
+
+    def prometheus(self) -> str:
+        """
+        Returns:
+            str: Every histogram and gauge in the Prometheus text exposition format.
+        """
+        name = "{}_stage_seconds".format(self.prefix)
+        lines = ["# HELP {} Time spent in each stage of the pipeline.".format(name), "# TYPE {} histogram".format(name)]
+        for stage, histogram in self.histograms.items():
+            counts, total = histogram.read()
+            cumulative = 0
+            for bound, count in zip([repr(bound) for bound in histogram.buckets] + ["+Inf"], counts):
+                cumulative += count
+                lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, bound, cumulative))
+            lines.append('{}_sum{{stage="{}"}} {}'.format(name, stage, total))
+            lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, cumulative))
+        for gauge, read in self.gauges.items():
+            lines.append("# TYPE {}_{} gauge".format(self.prefix, gauge))
+            lines.append("{}_{} {}".format(self.prefix, gauge, read()))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """
+        Returns:
+            dict: The count, p50 and p99 in milliseconds of every stage since the previous snapshot, the total
+                count of every stage, and the gauges.
+        """
+        stages = {}
+        for stage, histogram in self.histograms.items():
+            counts, _ = histogram.read()
+            previous = self._previous.get(stage, [0] * len(counts))
+            window = [count - before for count, before in zip(counts, previous)]
+            self._previous[stage] = counts
+            stages[stage] = {"count": sum(window), "total": sum(counts)}
+            for q in (0.5, 0.99):
+                value = quantile(histogram.buckets, window, q)
+                stages[stage]["p{}_ms".format(round(q * 100))] = None if value is None else round(value * 1000, 3)
+        return {"time": time.time(), "stages": stages, "gauges": {gauge: read() for gauge, read in self.gauges.items()}}
+
+def serve_metrics(metrics: Metrics, host: str, port: int) -> ThreadingHTTPServer:
+    """
+    Serve the metrics in the Prometheus text format at http://host:port/metrics from a daemon thread.
+
+    Returns:
+        ThreadingHTTPServer: The server, call shutdown() to stop it.
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # scrapes are not worth a line on stderr each
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+def write_snapshots(metrics: Metrics, path: str, interval: float = 5.0) -> threading.Event:
+    """
+    Write a JSON snapshot of the metrics to path every interval seconds from a thread. The file is replaced as
+    a whole, so a reader never sees a partial snapshot.
+
+    Returns:
+        threading.Event: Set it to stop writing, a last snapshot is written then. The thread also stops, after
+            a last snapshot, within interval seconds of the main thread ending.
+    """
+    stopped = threading.Event()
+
+    def write():
+        while True:
+            done = stopped.wait(interval) or not threading.main_thread().is_alive()
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, "w") as file:
+                json.dump(metrics.snapshot(), file)
+            os.replace(tmp_path, path)
+            if done:
+                break
+
+    # not a daemon, so the last snapshot isn't cut off when the program exits
+    threading.Thread(target=write, name="metrics_snapshot").start()
+    return stopped
+
+def start_metrics(metrics: Metrics, host: str = "localhost", port: int = None, path: str = None, interval: float = 5.0) -> threading.Event:
+    """
+    Start the exporters chosen on the command line, see serve_metrics and write_snapshots.
+
+    Returns:
+        threading.Event: Set it on shutdown to write the last snapshot, None without a path.
+    """
+    if port:
+        serve_metrics(metrics, host, port)
+    if path:
+        return write_snapshots(metrics, path, interval)
+    return None
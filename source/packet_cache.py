@@ -0,0 +1,86 @@
+import fractions
+import av
+from ball_bouncing import GroundTruthTrack
+
+DEFAULT_BITRATE = 500000  # bits per second, aiortc's default VP8 bitrate
+KEYFRAME_INTERVAL = 30  # frames, how long a peer that lost a packet waits for a clean picture
+
+def encode_sequence(bouncing_ball, bitrate: int = DEFAULT_BITRATE, keyframe_interval: int = KEYFRAME_INTERVAL) -> list:
+    """
+    Encode one loop of a bouncing ball sequence with VP8, with the realtime settings of aiortc's own encoder
+    but at a constant bitrate, so it can be replayed to any number of peers without encoding it again.
+
+    The first frame is a keyframe, so the loop can be replayed from the start and wrap around to it.
+
+    Args:
+        bouncing_ball (BouncingBallVideoStreamTrack): The sequence to encode.
+        bitrate (int, optional): Target bitrate in bits per second. Defaults to DEFAULT_BITRATE.
+        keyframe_interval (int, optional): Frames between two keyframes. Defaults to KEYFRAME_INTERVAL.
+
+    Returns:
+        list: The encoded frames as bytes, in order.
+    """
+    codec = None
+    packets = []
+    for index in range(len(bouncing_ball.coordinates)):
+        frame, _ = bouncing_ball.frame_at(index)
+        frame = frame.reformat(format="yuv420p")
+        frame.pts = index
+        frame.time_base = fractions.Fraction(1, 30)
+        if codec is None:
+            codec = av.CodecContext.create("libvpx", "w")
+            codec.width = frame.width
+            codec.height = frame.height
+            codec.bit_rate = bitrate
+            codec.pix_fmt = "yuv420p"
+            codec.gop_size = keyframe_interval
+            codec.qmin = 2
+            codec.qmax = 56
+            codec.options = {
+                "bufsize": str(bitrate),
+                "cpu-used": "-6",
+                "deadline": "realtime",
+                "lag-in-frames": "0",
+                "minrate": str(bitrate),
+                "maxrate": str(bitrate),
+                "noise-sensitivity": "4",
+                "overshoot-pct": "15",
+                "partitions": "0",
+                "static-thresh": "1",
+                "undershoot-pct": "100",
+            }
+        # without lag every frame comes out as exactly one packet
+        packets.append(b"".join(bytes(packet) for packet in codec.encode(frame)))
+    return packets
+
+class PacketTrack(GroundTruthTrack):
+    """
+    Replays a sequence encoded by encode_sequence to one peer, with the pts and pacing of a live track.
+
+    aiortc only packetizes the av.Packets a track returns instead of encoding them, so the per-peer cost is
+    a copy and the RTP packetization. Every peer needs its own PacketTrack, which starts at the first
+    (key)frame, but the packets are shared.
+    """
+    def __init__(self, packets: list, coordinates, history_size: int = 300):
+        """
+        Args:
+            packets (list): The encoded frames, see encode_sequence.
+            coordinates: The (x, y) position of the ball in each frame of the sequence.
+            history_size (int, optional): Number of sent frames kept in the ground truth history. Defaults to 300.
+        """
+        super().__init__(history_size)
+        self.packets = packets
+        self.coordinates = coordinates
+
+    async def recv(self):
+        """
+        Returns the next encoded frame
+        """
+        pts, time_base = await self.next_timestamp()
+        index = self.counter % len(self.packets)
+        packet = av.Packet(self.packets[index])
+        packet.pts = pts
+        packet.time_base = time_base
+        self.record(pts, self.coordinates[index])
+        self.counter += 1
+        return packet
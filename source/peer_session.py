@@ -0,0 +1,166 @@
+import asyncio
+from aiortc import MediaStreamTrack
+from aiortc.contrib.signaling import BYE, BaseSignaling, object_from_string, object_to_string
+
+class PeerSignaling(BaseSignaling):
+    """
+    Signaling over one accepted TCP connection, with the same newline delimited format as TcpSocketSignaling,
+    so an unchanged client can talk to a server that accepts many connections.
+    """
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        if not self._writer.is_closing():
+            await self.send(BYE)
+            self._writer.close()
+
+    async def receive(self):
+        """
+        Returns the next signaling object, or BYE once the peer has disconnected.
+        """
+        try:
+            data = await self._reader.readuntil()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return BYE
+        return object_from_string(data.decode("utf8"))
+
+    async def send(self, descr):
+        self._writer.write(object_to_string(descr).encode("utf8") + b"\n")
+        await self._writer.drain()
+
+class ListeningSignaling(PeerSignaling):
+    """
+    The server end of TcpSocketSignaling, listening from connect() on instead of from the first send(). The
+    client can connect as soon as the server is ready, and the server can send its offer while it still waits.
+    Later connections are refused, only one peer is served.
+    """
+    def __init__(self, host: str, port: int):
+        """
+        Args:
+            host (str): Address to listen on.
+            port (int): Port to listen on, 0 picks a free one, see port after connect().
+        """
+        self.host = host
+        self.port = port
+        self._server = None
+        self._connected = None
+
+    async def connect(self):
+        """
+        Start listening, without waiting for the peer.
+        """
+        if self._server is not None:
+            return
+        self._connected = asyncio.get_running_loop().create_future()
+
+        def on_connection(reader, writer):
+            if self._connected.done():
+                writer.close()
+                return
+            self._reader, self._writer = reader, writer
+            self._connected.set_result(None)
+
+        self._server = await asyncio.start_server(on_connection, host=self.host, port=self.port)
+        # the port actually bound, for a port of 0
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._connected is not None and self._connected.done():
+            await super().close()
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    async def receive(self):
+        await self.connect()
+        await self._connected
+        return await super().receive()
+
+    async def send(self, descr):
+        await self.connect()
+        await self._connected
+        await super().send(descr)
+
+class EncoderInputTrack(MediaStreamTrack):
+    """
+    Converts the frames of a track to yuv420p, the input format of the video encoders, once per frame.
+
+    A MediaRelay hands the same frame object to every peer, and each peer's encoder would otherwise reformat
+    it on its own thread. That repeats the conversion for every peer and is not thread safe, concurrent
+    reformats of one frame crash the process.
+    """
+    kind = "video"
+
+    def __init__(self, track: MediaStreamTrack):
+        super().__init__()
+        self.track = track
+
+    async def recv(self):
+        frame = await self.track.recv()
+        if frame.format.name != "yuv420p":
+            # keeps pts and time_base
+            frame = frame.reformat(format="yuv420p")
+        return frame
+
+    def stop(self):
+        super().stop()
+        self.track.stop()
+
+class SessionTrack(MediaStreamTrack):
+    """
+    One peer's view of a shared BouncingBallVideoStreamTrack, fed by a MediaRelay subscription.
+
+    The peer's receiver numbers pts from the first frame it got, so a peer that joins later sees pts that are
+    offset from the shared track's. This track remembers the first pts it forwarded and stands in for the
+    BouncingBallVideoStreamTrack in the peer's error accounting, translating the peer's pts back.
+    """
+    kind = "video"
+
+    def __init__(self, track: MediaStreamTrack, bouncing_ball):
+        """
+        Args:
+            track (MediaStreamTrack): The relayed track to forward frames from.
+            bouncing_ball (BouncingBallVideoStreamTrack): The shared track that produces the frames.
+        """
+        super().__init__()
+        self.track = track
+        self.bouncing_ball = bouncing_ball
+        self.first_pts = None
+
+    async def recv(self):
+        frame = await self.track.recv()
+        if self.first_pts is None:
+            self.first_pts = frame.pts
+        return frame
+
+    def stop(self):
+        super().stop()
+        self.track.stop()
+
+    @property
+    def cur_x_coordinate(self) -> int:
+        return self.bouncing_ball.cur_x_coordinate
+
+    @property
+    def cur_y_coordinate(self) -> int:
+        return self.bouncing_ball.cur_y_coordinate
+
+    @property
+    def current_pts(self) -> int:
+        if self.first_pts is None:
+            return None
+        return self.bouncing_ball.current_pts - self.first_pts
+
+    def position_at(self, pts: int):
+        return self.bouncing_ball.position_at(pts + (self.first_pts or 0))
+
+    def ground_truth(self, pts: int):
+        """
+        Same as BouncingBallVideoStreamTrack.ground_truth, for a pts numbered from this peer's first frame.
+        """
+        return self.bouncing_ball.ground_truth(pts + (self.first_pts or 0))
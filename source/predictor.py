@@ -0,0 +1,148 @@
+from collections import OrderedDict
+import numpy as np
+from protocol import FRAME_TICKS
+
+class AlphaBetaPredictor:
+    """
+    Constant velocity alpha-beta filter for the position of the ball, which smooths the detections and predicts
+    where the ball will be a number of frames later.
+
+    Between frames the ball moves with the reflection rule of BouncingBallVideoStreamTrack: move by the velocity,
+    then turn around if the centre is below radius or at/above the frame size minus radius. The filter moves its
+    state with the same rule, so predictions across a wall bounce stay on the ball's path.
+    """
+    def __init__(self, width: int = 640, height: int = 480, radius: int = 10, alpha: float = 0.5, beta: float = 0.1):
+        """
+        Args:
+            width (int, optional): The width of the frame. Defaults to 640.
+            height (int, optional): The height of the frame. Defaults to 480.
+            radius (int, optional): Radius of the ball. Defaults to 10.
+            alpha (float, optional): Weight of a new detection in the position. Defaults to 0.5.
+            beta (float, optional): Weight of a new detection in the velocity. Defaults to 0.1.
+        """
+        self.radius = radius
+        self.low = np.array([radius, radius], dtype=np.float64)
+        self.high = np.array([width - radius, height - radius], dtype=np.float64)
+        self.alpha = alpha
+        self.beta = beta
+        self.position = None
+        self.velocity = np.zeros(2)
+        self.pts = None
+        self.updates = 0
+
+    def set_frame_size(self, width: int, height: int):
+        """
+        Move the walls to the size of the received frames. If the size changed, such as when the server scales
+        the stream, the filter starts over, positions in frames of another size don't compare.
+        """
+        high = np.array([width - self.radius, height - self.radius], dtype=np.float64)
+        if np.array_equal(high, self.high):
+            return
+        self.high = high
+        self.position = None
+        self.velocity = np.zeros(2)
+        self.pts = None
+        self.updates = 0
+
+    def _advance(self, position: np.ndarray, velocity: np.ndarray, frames: int):
+        position, velocity = position.copy(), velocity.copy()
+        for _ in range(frames):
+            position += velocity
+            velocity[(position < self.low) | (position >= self.high)] *= -1
+        return position, velocity
+
+    def update(self, pts: int, x: int, y: int):
+        """
+        Add the detection of the ball in the frame with the given pts.
+
+        Args:
+            pts (int): The pts of the frame.
+            x (int): The detected x-coordinate of the ball.
+            y (int): The detected y-coordinate of the ball.
+        """
+        measured = np.array([x, y], dtype=np.float64)
+        if self.position is None:
+            self.position, self.pts, self.updates = measured, pts, 1
+            return
+        frames = round((pts - self.pts) / FRAME_TICKS)
+        if frames <= 0:
+            # the same or an older frame
+            return
+        if self.updates == 1:
+            # two detections give the velocity directly
+            self.velocity = (measured - self.position) / frames
+            self.position = measured
+        else:
+            position, velocity = self._advance(self.position, self.velocity, frames)
+            residual = measured - position
+            self.position = position + self.alpha * residual
+            self.velocity = velocity + self.beta * residual / frames
+        self.pts = pts
+        self.updates += 1
+
+    def predict(self, pts: int):
+        """
+        Returns:
+            tuple: The expected (x, y) coordinates of the ball in the frame with the given pts, or None before the
+                first detection.
+        """
+        if self.position is None:
+            return None
+        position, _ = self._advance(self.position, self.velocity, max(round((pts - self.pts) / FRAME_TICKS), 0))
+        return int(round(position[0])), int(round(position[1]))
+
+class LatencyCompensator:
+    """
+    Turns the detections of the client into predictions for the frame the server will be showing when they
+    arrive, so the server scores the tracking and not the lag.
+
+    The server answers results with the frame it was showing when they arrived (see protocol.encode_feedback),
+    the difference to the frame the detection was made in is the lag, averaged over the feedback.
+    """
+    def __init__(self, predictor: AlphaBetaPredictor, update_every: int = 1, smoothing: float = 0.2, history_size: int = 300):
+        """
+        Args:
+            predictor (AlphaBetaPredictor): The filter the detections are added to.
+            update_every (int, optional): Send a prediction for every Nth detection only. Defaults to 1.
+            smoothing (float, optional): Weight of a new feedback in the average lag. Defaults to 0.2.
+            history_size (int, optional): Number of sent predictions remembered to match feedback with. Defaults to 300.
+        """
+        self.predictor = predictor
+        self.update_every = update_every
+        self.smoothing = smoothing
+        self.history_size = history_size
+        self.lag = 0.0  # pts ticks
+        self.detections = 0
+        # pts of a sent prediction -> pts of the detection it was made from
+        self.sent = OrderedDict()
+
+    def add(self, pts: int, x: int, y: int):
+        """
+        Add the detection of the ball in the frame with the given pts.
+
+        Returns:
+            tuple: (pts, x, y) of the prediction to send, or None if this detection is not sent.
+        """
+        self.predictor.update(pts, x, y)
+        self.detections += 1
+        if (self.detections - 1) % self.update_every:
+            return None
+        target = pts + round(self.lag / FRAME_TICKS) * FRAME_TICKS
+        self.sent[target] = pts
+        if len(self.sent) > self.history_size:
+            self.sent.popitem(last=False)
+        return (target,) + self.predictor.predict(target)
+
+    def feedback(self, pts: int, current_pts: int):
+        """
+        Add the server's feedback for the prediction sent for pts.
+
+        Returns:
+            float: The lag in pts ticks of this result, or None for a prediction this compensator did not send.
+        """
+        detection_pts = self.sent.get(pts)
+        if detection_pts is None:
+            return None
+        lag = current_pts - detection_pts
+        self.lag += self.smoothing * (max(lag, 0) - self.lag)
+        return lag
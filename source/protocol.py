@@ -0,0 +1,139 @@
+import json
+import struct
+
+PROTOCOLS = ("json", "binary")
+FRAME_TICKS = 3000  # pts ticks between two frames, 90 kHz clock at 30 fps
+VERSION = 1
+TRACKS_VERSION = 2  # every object also carries the id of its track
+
+# version, reserved, number of frames in the message
+HEADER = struct.Struct("<BBH")
+# frame id (pts), number of objects found in the frame
+FRAME = struct.Struct("<qH")
+# x, y of one object
+POINT = struct.Struct("<hh")
+# x, y, track id of one object
+TRACK_POINT = struct.Struct("<hhI")
+
+def encode_json(frame_id: int, x: int, y: int) -> str:
+    """
+    Encode the coordinates found in one frame in the original JSON format, [x, y, frame id].
+    """
+    return json.dumps((x, y, frame_id))
+
+def encode_feedback(frame_id: int, current_frame_id: int) -> str:
+    """
+    Encode the server's answer to a result, the id of the frame it was showing when the result for frame_id
+    arrived. The difference is the lag the client has to predict over.
+    """
+    return json.dumps({"frame": frame_id, "now": current_frame_id})
+
+def decode_feedback(message: str) -> tuple:
+    """
+    Returns:
+        tuple: (frame id of the result, frame id the server was showing when it arrived).
+    """
+    feedback = json.loads(message)
+    return feedback["frame"], feedback["now"]
+
+def encode_report_request(interval: float) -> str:
+    """
+    Encode the server's request for load reports every interval seconds, sent when the data channel opens. A
+    client only reports its load to a server that asked for it.
+    """
+    return json.dumps({"load_reports": interval})
+
+def decode_report_request(message: str):
+    """
+    Returns:
+        float: The seconds between two requested load reports, or None if the text message is not a request.
+    """
+    if not message.startswith("{"):
+        return None
+    return json.loads(message).get("load_reports")
+
+def encode_load_report(lag_ms: float, drop_rate: float) -> str:
+    """
+    Encode the client's report of how well it keeps up with the stream, see adaptation.LoadMonitor.
+    """
+    return json.dumps({"lag_ms": round(lag_ms, 1), "drop_rate": round(drop_rate, 3)})
+
+def decode_load_report(message: str):
+    """
+    Returns:
+        tuple: (lag in milliseconds, drop rate), or None if the text message is not a load report.
+
+    Raises:
+        ValueError: If the message looks like a JSON object but is not valid JSON.
+    """
+    if not message.startswith("{"):
+        return None
+    report = json.loads(message)
+    if not isinstance(report, dict) or "lag_ms" not in report or "drop_rate" not in report:
+        return None
+    return report["lag_ms"], report["drop_rate"]
+
+def encode_batch(frames: list, tracks: bool = False) -> bytes:
+    """
+    Encode the coordinates of several frames into one binary message.
+
+    Args:
+        frames (list): (frame id, [(x, y), ...]) for every frame, in order.
+        tracks (bool, optional): The objects are (x, y, track id), sent with TRACKS_VERSION. Defaults to False.
+
+    Returns:
+        bytes: The message.
+    """
+    point_struct = TRACK_POINT if tracks else POINT
+    parts = [HEADER.pack(TRACKS_VERSION if tracks else VERSION, 0, len(frames))]
+    for frame_id, points in frames:
+        parts.append(FRAME.pack(frame_id, len(points)))
+        for point in points:
+            parts.append(point_struct.pack(*point))
+    return b"".join(parts)
+
+def message_version(data: bytes) -> int:
+    """
+    Returns:
+        int: The version of a binary message, VERSION or TRACKS_VERSION.
+
+    Raises:
+        ValueError: If the message is shorter than its header.
+    """
+    try:
+        return HEADER.unpack_from(data)[0]
+    except struct.error as e:
+        raise ValueError("truncated coordinates message: {}".format(e))
+
+def decode_batch(data: bytes) -> list:
+    """
+    Decode a binary message created by encode_batch.
+
+    Args:
+        data (bytes): The message.
+
+    Returns:
+        list: (frame id, [(x, y), ...]) for every frame, in order, with (x, y, track id) objects in a
+            TRACKS_VERSION message.
+
+    Raises:
+        ValueError: If the message has an unknown version or is truncated.
+    """
+    frames = []
+    try:
+        version, _, num_of_frames = HEADER.unpack_from(data)
+        if version not in (VERSION, TRACKS_VERSION):
+            raise ValueError("unsupported coordinates protocol version {}".format(version))
+        point_struct = TRACK_POINT if version == TRACKS_VERSION else POINT
+        offset = HEADER.size
+        for _ in range(num_of_frames):
+            frame_id, num_of_points = FRAME.unpack_from(data, offset)
+            offset += FRAME.size
+            points = list(point_struct.iter_unpack(data[offset:offset + num_of_points * point_struct.size]))
+            if len(points) != num_of_points:
+                raise ValueError("truncated coordinates message")
+            offset += num_of_points * point_struct.size
+            frames.append((frame_id, points))
+    except struct.error as e:
+        raise ValueError("truncated coordinates message: {}".format(e))
+    return frames
@@ -1,112 +1,622 @@
+import argparse
 import asyncio
+import itertools
 import json
 import os
+import time
+from collections import deque
+import numpy as np
 from Logger.logger import setup_logging
 from ball_bouncing import BouncingBallVideoStreamTrack
-from aiortc import RTCIceCandidate, RTCPeerConnection, RTCSessionDescription
+from aiortc import MediaStreamTrack, RTCConfiguration, RTCIceCandidate, RTCPeerConnection, RTCRtpSender, RTCSessionDescription
+from aiortc.contrib.media import MediaRelay
 from aiortc.contrib.signaling import BYE, TcpSocketSignaling
 from helper import create_file
+from protocol import FRAME_TICKS, TRACKS_VERSION, decode_batch, decode_load_report, encode_feedback, encode_report_request, message_version
+from detector import greedy_assignment
+from peer_session import EncoderInputTrack, ListeningSignaling, PeerSignaling, SessionTrack
+from packet_cache import PacketTrack, encode_sequence
+from metrics import Metrics, start_metrics
+from error_stats import ErrorAggregator
+from adaptation import REPORT_INTERVAL, RateController
+from startup import StartupTimer, write_ready_file
 
-def calculate_coordinates_error(bouncing_ball: BouncingBallVideoStreamTrack, message: str,logger):
+STATS_INTERVAL = 100  # messages between two logged percentile reports
+ERROR_STATS_INTERVAL = 10  # seconds between two logged error_stats snapshots of a session
+MAX_TRACK_ERROR = 20  # pixels, a reported object further than this from every ball is a false positive
+MAX_PREDICTION_FRAMES = 30  # frames, how far ahead of the sent frames a predicted result may be
+FEEDBACK_INTERVAL = 0.25  # seconds between two lag feedback messages to the client
+# handling of one data channel message, and the time from sending a frame to receiving its result
+STAGES = ("on_message", "result_latency")
+
+class ResultStats:
     """
-    Calculate the error in coordinates based on the received message.
+    The per-frame error and glass-to-result latency of the last received results, for percentile reports.
+    """
+    def __init__(self, size: int = 1000, metrics: Metrics = None):
+        """
+        Args:
+            size (int, optional): Number of most recent results kept. Defaults to 1000.
+            metrics (Metrics, optional): Also records every latency in its result_latency histogram.
+        """
+        self.metrics = metrics
+        self.errors = deque(maxlen=size)
+        self.latencies = deque(maxlen=size)
+        self.received = 0
+        self.reported = 0  # value of received at the last logged report
+        self.count = 0
+        self.unmatched = 0
+        # track id -> [frames, sum of the errors, ball it was last matched to, id switches]
+        self.tracks = {}
+        self.missed_objects = 0
+        self.false_positives = 0
+        self.ahead = 0  # predicted results for frames that were not sent yet
+        self.last_pts = None  # pts of the last scored result
+        self.feedback_time = 0.0  # time.monotonic() of the last lag feedback
+        # every error of the session in constant memory, logged as error_stats
+        self.aggregate = ErrorAggregator()
+
+    def add(self, error: tuple, latency: float = None):
+        """
+        Args:
+            error (tuple): The (x, y) error of a result.
+            latency (float, optional): Seconds between sending the frame and receiving its result, None for a
+                predicted result for a frame that was not sent yet.
+        """
+        self.errors.append(np.hypot(*error))
+        self.aggregate.add(*error)
+        if latency is not None:
+            self.latencies.append(latency)
+            if self.metrics is not None:
+                self.metrics.observe("result_latency", latency)
+        self.count += 1
+
+    def add_tracks(self, track_ids: list, balls: list, errors: list, latency: float, missed: int, false_positives: int):
+        """
+        Args:
+            track_ids (list): The client's track id of every object matched to a ball in a frame.
+            balls (list): The index of the ball each of those objects was matched to.
+            errors (list): The distance in pixels between each of those objects and its ball.
+            latency (float): Seconds between sending the frame and receiving its result.
+            missed (int): Number of balls no object was matched to.
+            false_positives (int): Number of objects not matched to any ball.
+        """
+        for track_id, ball, error in zip(track_ids, balls, errors):
+            track = self.tracks.setdefault(track_id, [0, 0.0, ball, 0])
+            track[0] += 1
+            track[1] += error
+            if track[2] != ball:
+                # the client's track followed a different ball than before
+                track[2] = ball
+                track[3] += 1
+        self.errors.extend(errors)
+        for error in errors:
+            self.aggregate.add_distance(error)
+        self.latencies.append(latency)
+        if self.metrics is not None:
+            self.metrics.observe("result_latency", latency)
+        self.missed_objects += missed
+        self.false_positives += false_positives
+        self.count += 1
+
+    def report(self) -> dict:
+        """
+        Returns:
+            dict: p50, p95 and p99 of the error in pixels and of the latency in milliseconds.
+        """
+        report = {"received": self.received, "matched": self.count, "unmatched": self.unmatched}
+        if self.count:
+            for name, samples, scale in (("error_px", self.errors, 1), ("latency_ms", self.latencies, 1000)):
+                if not samples:
+                    continue
+                for percentile, value in zip((50, 95, 99), np.percentile(samples, (50, 95, 99))):
+                    report["{}_p{}".format(name, percentile)] = round(float(value) * scale, 2)
+        if self.ahead:
+            report["ahead"] = self.ahead
+        if self.tracks:
+            report["tracks"] = len(self.tracks)
+            report["id_switches"] = sum(track[3] for track in self.tracks.values())
+            report["missed_objects"] = self.missed_objects
+            report["false_positives"] = self.false_positives
+        return report
+
+    def track_report(self) -> dict:
+        """
+        Returns:
+            dict: track id -> frames, mean error in pixels and id switches of every track of the client.
+        """
+        return {track_id: {"frames": frames, "error_px_mean": round(error / frames, 2), "id_switches": switches}
+                for track_id, (frames, error, _, switches) in sorted(self.tracks.items())}
+
+def score_coordinates(bouncing_ball: BouncingBallVideoStreamTrack, coordinates: tuple, pts: int, logger, stats: ResultStats = None):
+    """
+    Calculate the error of the coordinates found in one frame.
+
+    Coordinates with a pts are compared with the frame they were calculated from, and the time since that frame
+    was sent is recorded as their latency. Coordinates without one are compared with the frame currently being sent.
+    A client that predicts where the ball will be can send coordinates for a frame that was not sent yet, up to
+    MAX_PREDICTION_FRAMES ahead, which are compared with the position of the ball in that frame.
 
     Args:
         bouncing_ball (BouncingBallVideoStreamTrack): The BouncingBallVideoStreamTrack object.
-        message (str): The message containing coordinates in JSON format.
+        coordinates (tuple): The (x, y) coordinates received.
+        pts (int): The pts of the frame the coordinates were found in, or None.
+        stats (ResultStats, optional): Collects the error and latency of every result.
     """
-    logger.info("received_coordinates = %s" % (message))
-    coordinates = json.loads(message)
-    error_x = bouncing_ball.cur_x_coordinate - coordinates[0]
-    error_y = bouncing_ball.cur_y_coordinate - coordinates[1]
+    if stats is not None:
+        stats.received += 1
+    expected = (bouncing_ball.cur_x_coordinate, bouncing_ball.cur_y_coordinate)
+    latency = None
+    ahead = None
+    if pts is not None:
+        # the client's pts is relative to the first frame it received, which is our first frame (pts 0)
+        ground_truth = bouncing_ball.ground_truth(pts)
+        if ground_truth is not None:
+            expected = ground_truth[:2]
+            latency = time.time() - ground_truth[2]
+        elif bouncing_ball.current_pts is not None and 0 < pts - bouncing_ball.current_pts <= MAX_PREDICTION_FRAMES * FRAME_TICKS:
+            expected = bouncing_ball.position_at(pts)
+            ahead = round((pts - bouncing_ball.current_pts) / FRAME_TICKS)
+        elif stats is not None:
+            stats.unmatched += 1
+    error_x = expected[0] - coordinates[0]
+    error_y = expected[1] - coordinates[1]
     error = (error_x, error_y)
-    logger.info("calculated_error_in_coordinates = {}".format(error))
+    if ahead is not None:
+        logger.info("calculated_error_in_coordinates = %s ahead_frames = %d", error, ahead)
+        if stats is not None:
+            stats.ahead += 1
+            stats.last_pts = pts
+            stats.add(error)
+    elif latency is None:
+        logger.info("calculated_error_in_coordinates = %s", error)
+    else:
+        logger.info("calculated_error_in_coordinates = %s latency_ms = %.1f", error, latency * 1000)
+        if stats is not None:
+            stats.last_pts = pts
+            stats.add(error, latency)
     return error
 
-async def run(pc: RTCPeerConnection, signaling: TcpSocketSignaling,logger):
+def score_tracks(bouncing_ball: BouncingBallVideoStreamTrack, objects: list, pts: int, logger, stats: ResultStats = None):
     """
-    Create an offer with a video track of a bouncing ball and listen for signals from other peers.
+    Calculate the error of every tracked object found in one frame.
+
+    The objects are matched to the balls of the frame closest first, and every track is scored against the ball
+    it was matched to, so a track that jumps to another ball counts as an id switch.
+
+    Args:
+        bouncing_ball (BouncingBallVideoStreamTrack): The BouncingBallVideoStreamTrack object.
+        objects (list): (x, y, track id) of every object reported for the frame.
+        pts (int): The pts of the frame the objects were found in.
+        stats (ResultStats, optional): Collects the error and latency of every track.
+
+    Returns:
+        list: The error in pixels of every object that was matched to a ball.
+    """
+    if stats is not None:
+        stats.received += 1
+    ground_truth = bouncing_ball.ground_truth(pts)
+    if ground_truth is None:
+        if stats is not None:
+            stats.unmatched += 1
+        return []
+    balls = np.column_stack((np.atleast_1d(ground_truth[0]), np.atleast_1d(ground_truth[1])))
+    reported = np.array(objects, dtype=np.float64).reshape(-1, 3)
+    distances = np.linalg.norm(balls[:, None, :] - reported[None, :, :2], axis=2)
+    rows, columns = greedy_assignment(distances, MAX_TRACK_ERROR)
+    errors = distances[rows, columns].tolist()
+    latency = time.time() - ground_truth[2]
+    logger.info("calculated_track_errors objects=%d matched=%d latency_ms = %.1f", len(reported), len(rows), latency * 1000)
+    if stats is not None:
+        stats.last_pts = pts
+        stats.add_tracks(reported[columns, 2].astype(int).tolist(), rows.tolist(), errors, latency,
+                         len(balls) - len(rows), len(reported) - len(rows))
+    return errors
+
+def calculate_coordinates_error(bouncing_ball: BouncingBallVideoStreamTrack, message: str,logger, stats: ResultStats = None):
+    """
+    Calculate the error in coordinates based on the received message.
+
+    Args:
+        bouncing_ball (BouncingBallVideoStreamTrack): The BouncingBallVideoStreamTrack object.
+        message (str): The message containing coordinates in JSON format, [x, y] or [x, y, pts].
+        stats (ResultStats, optional): Collects the error and latency of every result.
+
+    Raises:
+        ValueError: If the message is not a JSON list of coordinates.
+    """
+    logger.info("received_coordinates = %s", message)
+    coordinates = json.loads(message)
+    if not isinstance(coordinates, list) or len(coordinates) < 2:
+        raise ValueError("coordinates message {!r} is not [x, y] or [x, y, pts]".format(message))
+    pts = coordinates[2] if len(coordinates) > 2 else None
+    return score_coordinates(bouncing_ball, coordinates[:2], pts, logger, stats)
+
+def calculate_batch_error(bouncing_ball: BouncingBallVideoStreamTrack, message: bytes, logger, stats: ResultStats = None):
+    """
+    Calculate the error of every frame in a binary coordinates message, see protocol.py.
+
+    Args:
+        bouncing_ball (BouncingBallVideoStreamTrack): The BouncingBallVideoStreamTrack object.
+        message (bytes): The binary message.
+        stats (ResultStats, optional): Collects the error and latency of every result.
+
+    Returns:
+        list: The error of every object in every frame, in order.
+    """
+    frames = decode_batch(message)
+    tracks = message_version(message) == TRACKS_VERSION
+    if tracks:
+        logger.info("received_objects = {}".format([(pts, len(points)) for pts, points in frames]))
+    else:
+        logger.info("received_coordinates = %s", frames)
+    errors = []
+    for pts, points in frames:
+        if tracks:
+            errors.extend(score_tracks(bouncing_ball, points, pts, logger, stats))
+            continue
+        for point in points:
+            errors.append(score_coordinates(bouncing_ball, point, pts, logger, stats))
+    return errors
+
+def adapt_stream(bouncing_ball: BouncingBallVideoStreamTrack, controller: RateController, report: tuple, logger):
+    """
+    Add a load report of the client to the controller, and apply the frame rate and render size it picks to the
+    track from the next frame on.
+    """
+    lag_ms, drop_rate = report
+    logger.debug("load_report lag_ms = %s drop_rate = %s", lag_ms, drop_rate)
+    if controller.update(lag_ms, drop_rate):
+        bouncing_ball.stride, bouncing_ball.scale = controller.stride, controller.scale
+        logger.info("adapted_stream fps = %.1f scale = %s lag_ms = %s drop_rate = %s", controller.fps, controller.scale, lag_ms, drop_rate)
+
+def create_peer_connection() -> RTCPeerConnection:
+    """
+    A peer connection whose offer already includes the data channel, so the client's coordinates channel
+    opens together with the video. Negotiating it in a second offer started the SCTP association of the
+    server before the client's end was listening at times, and the retry only came after 3 s.
+    """
+    return RTCPeerConnection(RTCConfiguration(alwaysNegotiateDataChannels=True))
+
+async def serve_peer(pc: RTCPeerConnection, signaling, bouncing_ball, logger, stats: ResultStats, metrics: Metrics = None, controller: RateController = None, vp8_only: bool = False, timer: StartupTimer = None):
+    """
+    Send an offer with the video track to one peer and consume its signaling until it says BYE.
 
     When receiving an offer, create an answer to listen for messages on the data channel.
 
     Args:
         pc (RTCPeerConnection): The RTCPeerConnection used for P2P communication.
-        signaling (TcpSocketSignaling): The signaling object used for signaling.
+        signaling: The signaling object connected to the peer.
+        bouncing_ball: The track to send, a BouncingBallVideoStreamTrack, SessionTrack or PacketTrack, or a future
+            of it while it is still being prepared. The offer is negotiated meanwhile, and the track is put in
+            place before the peer's answer is applied, which starts the sending.
+        stats (ResultStats): Collects the error and latency of this peer's results.
+        metrics (Metrics, optional): Records the time spent handling every message.
+        controller (RateController, optional): Adapts the frame rate and render size of bouncing_ball to the
+            client's load reports, which are ignored without one.
+        vp8_only (bool, optional): Only offer VP8, needed by a PacketTrack that is still being prepared.
+        timer (StartupTimer, optional): Records when the offer went out and the answer, the first frame and the
+            first result arrived, logged as startup_timings with the stats of the session.
     """
-    width, height = 640, 480
-    bouncing_ball = None
-    try:
-        bouncing_ball = BouncingBallVideoStreamTrack(width, height)
-        bouncing_ball.logger = logger
-    except Exception as e:
-        logger.error("error_in_creating_bouncing_ball_frames {}".format(e))
-    await signaling.connect()
+    preparing = None if isinstance(bouncing_ball, MediaStreamTrack) else bouncing_ball
+
     def add_tracks():
-        pc.addTrack(bouncing_ball)
+        if preparing is None:
+            pc.addTrack(bouncing_ball)
+        else:
+            pc.addTransceiver("video")
+        if vp8_only or isinstance(bouncing_ball, PacketTrack):
+            # the cached packets are VP8, the peer can't be allowed to pick another codec
+            codecs = RTCRtpSender.getCapabilities("video").codecs
+            pc.getTransceivers()[-1].setCodecPreferences([codec for codec in codecs if codec.mimeType in ("video/VP8", "video/rtx")])
+
+    # the offer includes the data channel, the client creates it
+    @pc.on("datachannel")
+    def on_datachannel(channel):
+        logger.info("channel({}) - created by remote party".format(channel.label))
+
+        def on_message(message):
+            try:
+                if isinstance(message, bytes):
+                    calculate_batch_error(bouncing_ball, message, logger, stats)
+                else:
+                    report = decode_load_report(message)
+                    if report is not None:
+                        if controller is not None:
+                            adapt_stream(bouncing_ball, controller, report, logger)
+                        return
+                    calculate_coordinates_error(bouncing_ball, message,logger, stats)
+            except ValueError as e:
+                # a malformed message is dropped, the channel keeps going
+                logger.error("invalid_message error = %s", e)
+                return
+            # only coordinates get this far, a load report is not a result
+            if timer is not None:
+                timer.mark("first_result")
+            if stats.last_pts is not None and time.monotonic() >= stats.feedback_time + FEEDBACK_INTERVAL:
+                # tell the client how far behind the sent frames its results arrive
+                stats.feedback_time = time.monotonic()
+                channel.send(encode_feedback(stats.last_pts, bouncing_ball.current_pts))
+            if stats.received >= stats.reported + STATS_INTERVAL:
+                stats.reported = stats.received
+                logger.info("result_stats = {}".format(stats.report()))
+
+        channel.on("message", on_message if metrics is None else metrics.timed("on_message", on_message))
+        if controller is not None:
+            # the client only sends load reports when asked to
+            channel.send(encode_report_request(REPORT_INTERVAL))
+
+    loop = asyncio.get_running_loop()
+    error_stats_handle = None
+
+    def log_error_stats():
+        # on a timer rather than with the results, so a session whose client stalls still logs its windows
+        nonlocal error_stats_handle
+        logger.info("error_stats = %s", json.dumps(stats.aggregate.snapshot()))
+        error_stats_handle = loop.call_later(ERROR_STATS_INTERVAL, log_error_stats)
 
     add_tracks()
     # send initial offer for media track
     await pc.setLocalDescription(await pc.createOffer())
     logger.info("sending offer signal")
     await signaling.send(pc.localDescription)
+    if timer is not None:
+        timer.mark("offer_sent")
 
+    error_stats_handle = loop.call_later(ERROR_STATS_INTERVAL, log_error_stats)
     # consume signaling
-    while True:
+    try:
+        while True:
+            try:
+                logger.info("waiting to receive signal")
+                obj = await signaling.receive()
+                if isinstance(obj, RTCSessionDescription):
+                    logger.info("RTCSessionDescription: signaling_state={} object_type={}".format(pc.signalingState, obj.type))
+                    if pc.signalingState == "have-local-offer":
+                        if obj.type == "answer":
+                            if timer is not None:
+                                timer.mark("answer_received")
+                            if preparing is not None:
+                                bouncing_ball = await preparing
+                                pc.getTransceivers()[0].sender.replaceTrack(bouncing_ball)
+                                preparing = None
+                            await pc.setRemoteDescription(obj)
+                    else:
+                        if obj.type == "offer":
+                            # a client that negotiates its data channel on its own
+                            await pc.setRemoteDescription(obj)
+                            await pc.setLocalDescription(await pc.createAnswer())
+                            logger.info("sending answer signal")
+                            await signaling.send(pc.localDescription)
+                elif isinstance(obj, RTCIceCandidate):
+                    logger.info("RTCIceCandidate_received")
+                    await pc.addIceCandidate(obj)
+                elif obj is BYE:
+                    logger.info("received_bye_signal_exiting")
+                    logger.info("result_stats = {}".format(stats.report()))
+                    if stats.tracks:
+                        logger.info("track_stats = {}".format(stats.track_report()))
+                    logger.info("error_stats = %s", json.dumps(stats.aggregate.snapshot()))
+                    if timer is not None:
+                        first_sent = getattr(bouncing_ball, "first_sent", None)
+                        if first_sent is not None:
+                            timer.mark("first_frame", first_sent)
+                        logger.info("startup_timings = %s", json.dumps(timer.report()))
+                    break
+            except Exception as e:
+                logger.error("error_while_consuming_signal={}".format(e))
+                continue
+            await asyncio.sleep(0.1)
+    finally:
+        error_stats_handle.cancel()
+
+def create_bouncing_ball(logger, lazy: bool = False, cache_dir: str = None, num_of_balls: int = 1) -> BouncingBallVideoStreamTrack:
+    """
+    Create the 640x480 bouncing ball track the server streams.
+
+    Args:
+        lazy (bool): Draw the frames on demand instead of rendering the whole sequence up front.
+        cache_dir (str): Directory of the on-disk frame cache for the precomputed sequence, if any.
+        num_of_balls (int): Number of balls, each with its own radius, speed and colour when more than one.
+    """
+    width, height = 640, 480
+    bouncing_ball = None
+    try:
+        bouncing_ball = BouncingBallVideoStreamTrack(width, height, lazy=lazy, cache_dir=cache_dir, num_of_balls=num_of_balls)
+        bouncing_ball.logger = logger
+    except Exception as e:
+        logger.error("error_in_creating_bouncing_ball_frames {}".format(e))
+    return bouncing_ball
+
+def prepare_track(logger, lazy: bool = False, cache_dir: str = None, packet_cache: bool = False, num_of_balls: int = 1, timer: StartupTimer = None):
+    """
+    Create the track run() streams, the bouncing ball or a PacketTrack replaying its encoded sequence.
+    """
+    bouncing_ball = create_bouncing_ball(logger, lazy, cache_dir, num_of_balls)
+    track = bouncing_ball
+    if packet_cache:
+        track = PacketTrack(encode_packets(bouncing_ball, logger), bouncing_ball.coordinates)
+    if timer is not None:
+        timer.mark("frames_ready")
+    return track
+
+def encode_packets(bouncing_ball: BouncingBallVideoStreamTrack, logger) -> list:
+    """
+    Encode the sequence of the bouncing ball once for every PacketTrack, see packet_cache.py.
+    """
+    start = time.perf_counter()
+    packets = encode_sequence(bouncing_ball)
+    logger.info("encoded_packet_cache frames={} bytes={} seconds={:.2f}".format(len(packets), sum(map(len, packets)), time.perf_counter() - start))
+    return packets
+
+async def run(pc: RTCPeerConnection, signaling: TcpSocketSignaling,logger, lazy: bool = False, cache_dir: str = None, packet_cache: bool = False, num_of_balls: int = 1, metrics: Metrics = None, stats: ResultStats = None, controller: RateController = None, timer: StartupTimer = None, ready_file: str = None):
+    """
+    Create an offer with a video track of a bouncing ball and listen for signals from other peers.
+
+    When receiving an offer, create an answer to listen for messages on the data channel.
+
+    Args:
+        pc (RTCPeerConnection): The RTCPeerConnection used for P2P communication.
+        signaling (TcpSocketSignaling): The signaling object used for signaling.
+        lazy (bool): Draw the frames on demand instead of rendering the whole sequence up front.
+        cache_dir (str): Directory of the on-disk frame cache for the precomputed sequence, if any.
+        packet_cache (bool): Encode the sequence once up front and replay the packets instead of encoding every frame.
+        num_of_balls (int): Number of balls in the video.
+        metrics (Metrics): Records the time spent in every stage, if any.
+        stats (ResultStats): Collects the error and latency of the peer's results, a new one by default.
+        controller (RateController): Adapts the frame rate and render size to the client's load reports, if any.
+            The replayed packets of packet_cache can't be adapted.
+        timer (StartupTimer): Records the steps of the startup, if any.
+        ready_file (str): File to create once the signaling accepts the peer, see write_ready_file.
+    """
+    # the frames are rendered, and encoded, on a thread while the peer connects and the offer is negotiated
+    track = asyncio.get_running_loop().run_in_executor(None, prepare_track, logger, lazy, cache_dir, packet_cache, num_of_balls, timer)
+    await signaling.connect()
+    if timer is not None:
+        timer.mark("listening")
+    if ready_file:
+        write_ready_file(ready_file)
+    if stats is None:
+        stats = ResultStats(metrics=metrics)
+    await serve_peer(pc, signaling, track, logger, stats, metrics, None if packet_cache else controller, packet_cache, timer)
+
+async def run_multi_peer(host: str, port: int, logger, lazy: bool = False, cache_dir: str = None, packet_cache: bool = False, num_of_balls: int = 1, metrics: Metrics = None, ready_file: str = None):
+    """
+    Accept any number of concurrent peers on host:port, each with its own RTCPeerConnection, signaling and
+    error accounting. All of them are fed from one bouncing ball track through a MediaRelay, so every frame
+    is generated, and converted to the encoders' input format, once however many peers are connected.
+
+    Args:
+        host (str): Address to listen on.
+        port (int): Port to listen on.
+        lazy (bool): Draw the frames on demand instead of rendering the whole sequence up front.
+        cache_dir (str): Directory of the on-disk frame cache for the precomputed sequence, if any.
+        packet_cache (bool): Encode the sequence once up front and replay the packets to every peer, so there is
+            no encoder per peer either.
+        num_of_balls (int): Number of balls in the video.
+        metrics (Metrics): Records the time spent in every stage and the number of connected peers, if any.
+        ready_file (str): File to create once peers are accepted, see write_ready_file.
+    """
+    bouncing_ball = create_bouncing_ball(logger, lazy, cache_dir, num_of_balls)
+    packets = encode_packets(bouncing_ball, logger) if packet_cache else None
+    source = EncoderInputTrack(bouncing_ball)
+    relay = MediaRelay()
+    session_ids = itertools.count(1)
+    peers = set()
+    if metrics is not None:
+        metrics.gauge("peers", lambda: len(peers))
+
+    async def on_connection(reader, writer):
+        session_logger = logger.getChild("peer{}".format(next(session_ids)))
+        session_logger.info("peer_connected")
+        pc = create_peer_connection()
+        if packets is not None:
+            track = PacketTrack(packets, bouncing_ball.coordinates)
+        else:
+            track = SessionTrack(relay.subscribe(source, buffered=False), bouncing_ball)
+        peers.add(pc)
         try:
-            logger.info("waiting to receive signal")
-            obj = await signaling.receive()
-            if isinstance(obj, RTCSessionDescription):
-                logger.info("RTCSessionDescription: signaling_state={} object_type={}".format(pc.signalingState, obj.type))
-                if pc.signalingState == "have-local-offer":
-                    if obj.type == "answer":
-                        await pc.setRemoteDescription(obj)
-                else:
-                    if obj.type == "offer":
-                        # send answer for data channel
-                        @pc.on("datachannel")
-                        def on_datachannel(channel):
-                            logger.info("channel({}) - created by remote party".format(channel.label))
-
-                            @channel.on("message")
-                            def on_message(message):
-                                calculate_coordinates_error(bouncing_ball, message,logger)
-                        await pc.setRemoteDescription(obj)
-                        await pc.setLocalDescription(await pc.createAnswer())
-                        logger.info("sending answer signal")
-                        await signaling.send(pc.localDescription)
-            elif isinstance(obj, RTCIceCandidate):
-                logger.info("RTCIceCandidate_received")
-                await pc.addIceCandidate(obj)
-            elif obj is BYE:
-                logger.info("received_bye_signal_exiting")
-                break
-        except Exception as e:
-            logger.error("error_while_consuming_signal={}".format(e))
-            continue
-        await asyncio.sleep(0.1)
+            await serve_peer(pc, PeerSignaling(reader, writer), track, session_logger, ResultStats(metrics=metrics), metrics)
+        finally:
+            peers.discard(pc)
+            await pc.close()
+            writer.close()
+            session_logger.info("peer_disconnected")
+
+    server = await asyncio.start_server(on_connection, host=host, port=port)
+    logger.info("listening_for_peers on {}:{}".format(host, port))
+    if ready_file:
+        write_ready_file(ready_file)
+    async with server:
+        await server.serve_forever()
 
 
 if __name__ == "__main__":
+    timer = StartupTimer()
+    timer.mark("imported")
+    parser = argparse.ArgumentParser(description="Stream a bouncing ball video and score the coordinates sent back")
+    parser.add_argument("--lazy", action="store_true", default=os.environ.get("SERVER_LAZY_FRAMES") == "1",
+                        help="draw frames on demand with constant memory (env SERVER_LAZY_FRAMES=1)")
+    parser.add_argument("--frame-cache", default=os.environ.get("SERVER_FRAME_CACHE"),
+                        help="directory to cache the rendered sequence in as a memory mapped file (env SERVER_FRAME_CACHE)")
+    parser.add_argument("--multi-peer", action="store_true", default=os.environ.get("SERVER_MULTI_PEER") == "1",
+                        help="serve any number of clients from one shared frame source (env SERVER_MULTI_PEER=1)")
+    parser.add_argument("--packet-cache", action="store_true", default=os.environ.get("SERVER_PACKET_CACHE") == "1",
+                        help="encode the sequence once and replay the packets to every peer (env SERVER_PACKET_CACHE=1)")
+    parser.add_argument("--balls", type=int, default=int(os.environ.get("SERVER_BALLS", 1)),
+                        help="number of balls, the client needs --detector multi to track more than one (env SERVER_BALLS)")
+    parser.add_argument("--host", default=os.environ.get("SIGNALING_HOST", "localhost"),
+                        help="signaling address (env SIGNALING_HOST)")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("SIGNALING_PORT", 9000)),
+                        help="signaling port (env SIGNALING_PORT)")
+    parser.add_argument("--metrics-port", type=int, default=int(os.environ.get("SERVER_METRICS_PORT", 0)),
+                        help="serve per-stage timings in the Prometheus text format on this port, 0 disables it (env SERVER_METRICS_PORT)")
+    parser.add_argument("--metrics-file", default=os.environ.get("SERVER_METRICS_FILE"),
+                        help="file to write a JSON snapshot of the per-stage timings to (env SERVER_METRICS_FILE)")
+    parser.add_argument("--metrics-interval", type=float, default=float(os.environ.get("SERVER_METRICS_INTERVAL", 5)),
+                        help="seconds between two metrics snapshots (env SERVER_METRICS_INTERVAL)")
+    parser.add_argument("--adaptive", action="store_true", default=os.environ.get("SERVER_ADAPTIVE") == "1",
+                        help="lower the frame rate, then the resolution, while the client can't keep up (env SERVER_ADAPTIVE=1)")
+    parser.add_argument("--min-fps", type=float, default=float(os.environ.get("SERVER_MIN_FPS", 10)),
+                        help="lowest frame rate of --adaptive (env SERVER_MIN_FPS)")
+    parser.add_argument("--max-fps", type=float, default=float(os.environ.get("SERVER_MAX_FPS", 30)),
+                        help="highest frame rate of --adaptive, which starts at it (env SERVER_MAX_FPS)")
+    parser.add_argument("--min-scale", type=float, default=float(os.environ.get("SERVER_MIN_SCALE", 0.5)),
+                        help="smallest resolution of --adaptive relative to 640x480 (env SERVER_MIN_SCALE)")
+    parser.add_argument("--ready-file", default=os.environ.get("SERVER_READY_FILE"),
+                        help="file to create once clients can connect, start.sh waits for it (env SERVER_READY_FILE)")
+    args = parser.parse_args()
+    controller = None
+    if args.adaptive:
+        # a shared relay or replayed inter-coded packets can't change for one client
+        if args.multi_peer or args.packet_cache:
+            parser.error("--adaptive needs one peer and encoding every frame, not --multi-peer or --packet-cache")
+        try:
+            controller = RateController(args.min_fps, args.max_fps, args.min_scale)
+        except ValueError as e:
+            parser.error(str(e))
     log_file_path = create_file(os.path.join(os.getcwd(), "logs"),"server.log")
     print(f"Logging in file: {log_file_path}")
     logger = setup_logging("client", log_file_path)
     logger.info("starting_server")
-    signaling = TcpSocketSignaling("localhost", 9000)
-    logger.info("prepared tcp-socket-signaling object")
-    pc = RTCPeerConnection()
-    # run event loop
-    loop = asyncio.get_event_loop()
-    try:
-        loop.run_until_complete(
-            run(
-                pc=pc,
-                signaling=signaling,
-                logger=logger,
+    metrics = None
+    snapshots = None
+    if args.metrics_port or args.metrics_file:
+        metrics = Metrics("server", STAGES)
+        snapshots = start_metrics(metrics, "localhost", args.metrics_port, args.metrics_file, args.metrics_interval)
+    if args.multi_peer:
+        try:
+            asyncio.run(run_multi_peer(args.host, args.port, logger, args.lazy, args.frame_cache, args.packet_cache, args.balls, metrics, args.ready_file))
+        except KeyboardInterrupt:
+            pass
+    else:
+        # listens from the start, the client can connect while the frames are being prepared
+        signaling = ListeningSignaling(args.host, args.port)
+        logger.info("prepared tcp-socket-signaling object")
+        pc = create_peer_connection()
+        # run event loop
+        loop = asyncio.get_event_loop()
+        try:
+            loop.run_until_complete(
+                run(
+                    pc=pc,
+                    signaling=signaling,
+                    logger=logger,
+                    lazy=args.lazy,
+                    cache_dir=args.frame_cache,
+                    packet_cache=args.packet_cache,
+                    num_of_balls=args.balls,
+                    metrics=metrics,
+                    controller=controller,
+                    timer=timer,
+                    ready_file=args.ready_file,
+                )
             )
-        )
-    except KeyboardInterrupt:
-        pass
-    finally:
-        # cleanup
-        loop.run_until_complete(signaling.close())
-        loop.run_until_complete(pc.close())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # cleanup
+            loop.run_until_complete(signaling.close())
+            loop.run_until_complete(pc.close())
+    if snapshots is not None:
+        snapshots.set()
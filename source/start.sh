@@ -1,10 +1,28 @@
 #!/bin/bash
+# the server creates this file once it is listening for the client
+ready_file=$(mktemp -u /tmp/server_ready.XXXXXX)
+ready_timeout=${SERVER_READY_TIMEOUT:-30}
+
 echo "starting the server in the background"
-python3 server.py >/dev/null 2>&1 &
-# python3 server.py >server_start.log 2>&1 &
+python3 server.py --ready-file "$ready_file" >/dev/null 2>&1 &
+# python3 server.py --ready-file "$ready_file" >server_start.log 2>&1 &
+server_pid=$!
 
-echo "waiting for 5 sec before starting client"
-sleep 5
+echo "waiting for the server to listen, at most $ready_timeout sec"
+waited=0
+while [ ! -e "$ready_file" ]; do
+    if ! kill -0 "$server_pid" 2>/dev/null; then
+        echo "the server exited before it was ready"
+        exit 1
+    fi
+    if [ "$waited" -ge $((ready_timeout * 10)) ]; then
+        echo "the server was not ready after $ready_timeout sec"
+        exit 1
+    fi
+    sleep 0.1
+    waited=$((waited + 1))
+done
+rm -f "$ready_file"
 
 echo "starting the client in the background"
 python3 client.py >/dev/null 2>&1 &
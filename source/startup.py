@@ -0,0 +1,71 @@
+import json
+import os
+import time
+from collections import OrderedDict
+
+def process_start_time() -> float:
+    """
+    The time the current process was started, so the interpreter's own startup and the imports are counted too.
+
+    Returns:
+        float: Seconds since the epoch, or now where /proc is not available.
+    """
+    try:
+        with open("/proc/self/stat") as file:
+            # the command name in brackets can contain spaces, the fields after it can't
+            fields = file.read().rpartition(")")[2].split()
+        with open("/proc/uptime") as file:
+            uptime = float(file.read().split()[0])
+        # the start time is in clock ticks since boot, the boot time in /proc/stat only has whole seconds
+        return time.time() - (uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+    except (OSError, IndexError, ValueError):
+        return time.time()
+
+class StartupTimer:
+    """
+    Milliseconds from the launch of the process to the first time each step of its startup was reached, such as
+    the first frame sent or the first coordinates received.
+    """
+    def __init__(self, start: float = None):
+        """
+        Args:
+            start (float, optional): Launch time in seconds since the epoch. Defaults to process_start_time().
+        """
+        self.start = process_start_time() if start is None else start
+        self.marks = OrderedDict()
+        self.watched = {}
+
+    def mark(self, step: str, when: float = None):
+        """
+        Record that step was reached now, or at the time when, unless it was reached before.
+        """
+        if step not in self.marks:
+            self.marks[step] = ((time.time() if when is None else when) - self.start) * 1000
+
+    def watch(self, step: str, read):
+        """
+        Record step at the time returned by read(), for a step reached in another process, such as the time in
+        a shared Value set by it. read() returns 0 until the step is reached.
+        """
+        self.watched[step] = read
+
+    def report(self) -> dict:
+        """
+        Returns:
+            dict: step -> milliseconds since the launch, in the order the steps were reached.
+        """
+        for step, read in self.watched.items():
+            when = read()
+            if when:
+                self.mark(step, when)
+        return {step: round(ms, 1) for step, ms in sorted(self.marks.items(), key=lambda item: item[1])}
+
+def write_ready_file(path: str, **details):
+    """
+    Tell a launcher such as start.sh that the program is ready, by creating path with details as JSON. The file
+    is renamed into place, so its existence means its content is complete.
+    """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as file:
+        json.dump(dict(details, pid=os.getpid()), file)
+    os.replace(tmp_path, path)
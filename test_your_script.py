@@ -1,11 +1,37 @@
 import pytest
 import os
+import json
+import time
+import asyncio
+import threading
+import logging
+import numpy as np
+from multiprocessing import Process
 from source.ball_bouncing import BouncingBallVideoStreamTrack
 from multiprocessing import Value,Queue
-from source.server import calculate_coordinates_error
-from source.client import calculate_coordinates, process_a
+from source.server import calculate_coordinates_error, calculate_batch_error, ResultStats
+from source.protocol import encode_batch, decode_batch, message_version
+from source.client import calculate_coordinates, process_a, find_ball
+from source.detector import MultiBallTracker, RoiBallTracker, find_ball_pyramid, luma_plane, pyramid_factor
+from source.frame_ring import FrameRing
+from source.coordinate_record import CoordinateRecord
+from source.peer_session import EncoderInputTrack, SessionTrack
+from source.packet_cache import PacketTrack, encode_sequence
+from source.predictor import AlphaBetaPredictor, LatencyCompensator
+from source.protocol import decode_feedback, encode_feedback
+from source.metrics import Metrics, quantile, write_snapshots
+from source.error_stats import ErrorAggregator
+from source.loopback import run_loopback
+from source.adaptation import LoadMonitor, RateController
+from source.server import adapt_stream
+from source.protocol import decode_load_report, decode_report_request, encode_load_report, encode_report_request
+from aiortc.contrib.media import MediaRelay
 from source.helper import create_file
-from source.Logger.logger import setup_logging
+from source.Logger.logger import SamplingFilter, parse_sampling, setup_logging
+from source.startup import StartupTimer, write_ready_file
+from source.peer_session import ListeningSignaling
+from aiortc import RTCSessionDescription
+from aiortc.contrib.signaling import BYE, TcpSocketSignaling
 
 logger = setup_logging("test", create_file(os.path.join(os.getcwd(), "logs"), "test.log"))
 
@@ -35,6 +61,82 @@ def test_calculate_coordinates_error():
     assert error[1] == -50
 
 
+# Test that results tagged with a pts are compared with the frame they were calculated from
+def test_calculate_coordinates_error_pts():
+    width, height = 640, 480
+    bouncing_ball = BouncingBallVideoStreamTrack(width, height,10,10,5)
+    stats = ResultStats()
+
+    async def send_frames():
+        return [await bouncing_ball.recv() for _ in range(3)]
+    frames = asyncio.run(send_frames())
+    x, y = bouncing_ball.coordinates[0]
+
+    # the ball has moved on since frame 0, the result is still matched with frame 0
+    error = calculate_coordinates_error(bouncing_ball, '[%d, %d, %d]' % (x + 2, y - 3, frames[0].pts), logger, stats)
+    assert error == (-2, 3)
+    assert stats.count == 1
+    assert stats.latencies[0] >= 0
+    # rounding in the RTP clock conversion can shift the pts by one tick
+    assert bouncing_ball.ground_truth(frames[1].pts - 1)[:2] == bouncing_ball.coordinates[1]
+
+    # an unknown pts falls back to the current frame
+    calculate_coordinates_error(bouncing_ball, '[0, 0, 123456789]', logger, stats)
+    assert stats.unmatched == 1
+    report = stats.report()
+    assert report["received"] == 2
+    assert report["error_px_p50"] == round(float(np.hypot(2, 3)), 2)
+    assert "latency_ms_p99" in report
+
+
+# Test the binary batched coordinates protocol
+def test_calculate_batch_error():
+    frames = [(0, [(100, 200)]), (3000, [(105, 205), (7, 8)]), (6000, [])]
+    message = encode_batch(frames)
+    assert decode_batch(message) == frames
+    with pytest.raises(ValueError):
+        decode_batch(message[:-1])
+    with pytest.raises(ValueError):
+        decode_batch(b"\x01")
+    with pytest.raises(ValueError):
+        message_version(b"")
+
+    width, height = 640, 480
+    bouncing_ball = BouncingBallVideoStreamTrack(width, height,10,10,5)
+    bouncing_ball.cur_x_coordinate = 100
+    bouncing_ball.cur_y_coordinate = 200
+    # no frame has been sent yet, every point is compared with the current position
+    errors = calculate_batch_error(bouncing_ball, message, logger)
+    assert errors == [(0, 0), (-5, -5), (93, 192)]
+
+
+# Test that the lazily drawn sequence matches the precomputed one
+def test_bouncing_ball_lazy():
+    for width, height, num_of_frames, radius, speed in ((640, 480, 300, 10, 5), (100, 60, 200, 10, 30)):
+        bouncing_ball = BouncingBallVideoStreamTrack(width, height, num_of_frames, radius, speed)
+        lazy_ball = BouncingBallVideoStreamTrack(width, height, num_of_frames, radius, speed, lazy=True)
+        assert not hasattr(lazy_ball, "frames")
+        assert list(lazy_ball.coordinates) == bouncing_ball.coordinates
+        assert lazy_ball.coordinates[-1] == bouncing_ball.coordinates[-1]
+        for index in range(num_of_frames):
+            lazy_ball.counter = index
+            frame = lazy_ball.render(lazy_ball.coordinates[index])
+            assert (frame.to_ndarray(format="bgr24") == bouncing_ball.frames[index].to_ndarray(format="bgr24")).all()
+
+
+# Test that a sequence loaded from the frame cache matches a freshly rendered one
+def test_bouncing_ball_frame_cache(tmp_path):
+    width, height = 640, 480
+    bouncing_ball = BouncingBallVideoStreamTrack(width, height,10,10,5)
+    cold = BouncingBallVideoStreamTrack(width, height,10,10,5, cache_dir=str(tmp_path))
+    warm = BouncingBallVideoStreamTrack(width, height,10,10,5, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 2
+    for cached in (cold, warm):
+        assert cached.coordinates == bouncing_ball.coordinates
+        for frame, cached_frame in zip(bouncing_ball.frames, cached.frames):
+            assert (frame.to_ndarray(format="bgr24") == cached_frame.to_ndarray(format="bgr24")).all()
+
+
 # Test calculate_coordinates function
 def test_calculate_coordinates():
     # Test with a sample image and expected coordinates
@@ -104,6 +206,529 @@ def test_process_a():
     assert y_coordinate.value < y + 10 and y_coordinate.value > y - 10  # Expected y-coordinate value
     assert new_coordinates_generated.value == True
 
+# Test FrameRing round trip
+def test_frame_ring():
+    width, height = 640, 480
+    bouncing_ball = BouncingBallVideoStreamTrack(width, height,10,10,5)
+    frame_ring = FrameRing(width, height, num_slots=2, policy="bounded")
+    first = bouncing_ball.frames[0].to_ndarray(format="bgr24")
+    second = bouncing_ball.frames[1].to_ndarray(format="bgr24")
+    frame_ring.put(first)
+    frame_ring.put(second)
+    frame_ring.put(None)
+
+    seq, image = frame_ring.get_frame()
+    assert seq == 1
+    assert (image == first).all()
+    seq, image = frame_ring.get_frame()
+    assert seq == 2
+    assert (image == second).all()
+    del image
+    assert frame_ring.get() is None
+    frame_ring.close()
+
+
+# Test that the latest policy drops stale frames instead of queueing them
+def test_frame_ring_latest():
+    width, height = 640, 480
+    bouncing_ball = BouncingBallVideoStreamTrack(width, height,10,10,5)
+    frame_ring = FrameRing(width, height, num_slots=2, policy="latest")
+    for frame in bouncing_ball.frames[:5]:
+        assert frame_ring.put(frame.to_ndarray(format="bgr24"))
+    time.sleep(0.1)  # let the queue feeder thread flush
+
+    seq, image = frame_ring.get_frame()
+    assert seq == 5
+    assert (image == bouncing_ball.frames[4].to_ndarray(format="bgr24")).all()
+    assert frame_ring.dropped == 4
+    del image
+    frame_ring.close()
+
+
+# Test process_a with a pool of detector workers
+def test_process_a_workers():
+    width, height = 640, 480
+    bouncing_ball = BouncingBallVideoStreamTrack(width, height,10,10,5)
+    frame_ring = FrameRing(width, height, num_slots=12, policy="bounded")
+    for frame in bouncing_ball.frames:
+        frame_ring.put(frame.to_ndarray(format="bgr24"))
+    frame_ring.put(None)
+    x_coordinate = Value('i', 0)
+    y_coordinate = Value('i', 0)
+    new_coordinates_generated = Value('b', False)
+
+    process_a(frame_ring, x_coordinate, y_coordinate, new_coordinates_generated, logger, num_of_workers=3)
+
+    # results are published in frame order, so the last frame's coordinates win
+    x, y = bouncing_ball.coordinates[-1]
+    assert x_coordinate.value < x + 10 and x_coordinate.value > x - 10
+    assert y_coordinate.value < y + 10 and y_coordinate.value > y - 10
+    assert frame_ring.dropped == 0
+    frame_ring.close()
+
+# Test that a frame without the ball doesn't stop the single worker
+def test_process_a_blank_frame():
+    width, height = 640, 480
+    bouncing_ball = BouncingBallVideoStreamTrack(width, height,10,10,5)
+    frame_ring = FrameRing(width, height, num_slots=4, policy="bounded")
+    frame_ring.put(np.zeros((height, width, 3), dtype=np.uint8))
+    frame_ring.put(bouncing_ball.frames[3].to_ndarray(format="bgr24"))
+    frame_ring.put(None)
+    x_coordinate = Value('i', 0)
+    y_coordinate = Value('i', 0)
+    new_coordinates_generated = Value('b', False)
+
+    process_a(frame_ring, x_coordinate, y_coordinate, new_coordinates_generated, logger)
+
+    x, y = bouncing_ball.coordinates[3]
+    assert x_coordinate.value < x + 10 and x_coordinate.value > x - 10
+    assert y_coordinate.value < y + 10 and y_coordinate.value > y - 10
+    assert new_coordinates_generated.value == True
+    frame_ring.close()
+
+# Test that the windowed detector finds the same coordinates as the full frame scan
+def test_roi_ball_tracker():
+    width, height = 640, 480
+    bouncing_ball = BouncingBallVideoStreamTrack(width, height)
+    tracker = RoiBallTracker(find_ball)
+    for frame, (x, y) in zip(bouncing_ball.frames, bouncing_ball.coordinates):
+        image = frame.to_ndarray(format="bgr24")
+        assert tracker.find(image) == find_ball(image)
+        assert tracker.last_position[0] < x + 10 and tracker.last_position[0] > x - 10
+        assert tracker.last_position[1] < y + 10 and tracker.last_position[1] > y - 10
+    assert tracker.window_hits > tracker.full_scans
+
+    # the ball jumping out of the window falls back to a full frame scan
+    image = bouncing_ball.frames[0].to_ndarray(format="bgr24")
+    full_scans = tracker.full_scans
+    assert tracker.find(image) == find_ball(image)
+    assert tracker.full_scans == full_scans + 1
+
+
+# Test the coarse to fine detector at 1080p and 4K, on BGR images and luma planes
+def test_find_ball_pyramid():
+    assert [pyramid_factor(width) for width in (640, 1280, 1920, 3840)] == [2, 4, 4, 8]
+    for width, height in ((1920, 1080), (3840, 2160)):
+        for radius in (5, 20):
+            bouncing_ball = BouncingBallVideoStreamTrack(width, height, 10, radius, lazy=True)
+            for index in range(10):
+                bouncing_ball.counter = index
+                frame, (x, y) = bouncing_ball.frame_at(index)
+                for image in (frame.to_ndarray(format="bgr24"), luma_plane(frame.reformat(format="yuv420p"))):
+                    found_x, found_y = find_ball_pyramid(image)
+                    assert abs(found_x - x) < 10 and abs(found_y - y) < 10
+    with pytest.raises(ValueError):
+        find_ball_pyramid(np.zeros((1080, 1920), dtype=np.uint8))
+
+# Test detection on the luma plane of decoded (yuv420p) frames
+def test_calculate_coordinates_luma():
+    width, height = 640, 480
+    bouncing_ball = BouncingBallVideoStreamTrack(width, height,10,10,5)
+    for index in (0, 7):
+        frame = bouncing_ball.frames[index].reformat(format="yuv420p")
+        x, y = bouncing_ball.coordinates[index]
+        image = luma_plane(frame)
+        del frame
+        assert image.shape == (height, width)
+        x_coordinate = Value('i', 0)
+        y_coordinate = Value('i', 0)
+        new_coordinates_generated = Value('b', False)
+
+        calculate_coordinates(image, x_coordinate, y_coordinate, new_coordinates_generated, logger)
+
+        assert x_coordinate.value < x + 10 and x_coordinate.value > x - 10
+        assert y_coordinate.value < y + 10 and y_coordinate.value > y - 10
+        assert new_coordinates_generated.value == True
+
+
+# Test that coordinates published by another process wake up the event loop
+def test_coordinate_record():
+    coordinate_record = CoordinateRecord()
+    received = []
+
+    async def wait_for_coordinates():
+        loop = asyncio.get_event_loop()
+        done = asyncio.Event()
+
+        def on_coordinates():
+            received.append(coordinate_record.receive())
+            if received[-1][0] == 3:
+                done.set()
+
+        loop.add_reader(coordinate_record.fileno(), on_coordinates)
+        publisher = Process(target=_publish_coordinates, args=(coordinate_record,))
+        publisher.start()
+        await asyncio.wait_for(done.wait(), 5)
+        loop.remove_reader(coordinate_record.fileno())
+        publisher.join()
+
+    asyncio.run(wait_for_coordinates())
+    # notifications are coalesced, but the last record always arrives whole
+    assert received[-1] == (3, 30, 300)
+    assert coordinate_record.read() == (3, 30, 300)
+
+def _publish_coordinates(coordinate_record):
+    for seq in (1, 2, 3):
+        coordinate_record.publish(seq, seq * 10, seq * 100)
+
+
+# Test that a peer joining a shared stream late is scored against the frames it actually received
+def test_session_track():
+    bouncing_ball = BouncingBallVideoStreamTrack(640, 480, 30, lazy=True)
+    relay = MediaRelay()
+    source = EncoderInputTrack(bouncing_ball)
+
+    async def receive_frames():
+        first = SessionTrack(relay.subscribe(source, buffered=False), bouncing_ball)
+        for _ in range(5):
+            await first.recv()
+        second = SessionTrack(relay.subscribe(source, buffered=False), bouncing_ball)
+        frame = await second.recv()
+        first.stop()
+        second.stop()
+        return first, second, frame
+
+    first, second, frame = asyncio.run(receive_frames())
+    # every peer's encoder gets the frame already converted
+    assert frame.format.name == "yuv420p"
+    assert first.first_pts == 0
+    assert second.first_pts == frame.pts > 0
+    # the second peer's receiver numbers this frame 0
+    assert second.ground_truth(0) == bouncing_ball.ground_truth(frame.pts)
+    assert first.ground_truth(frame.pts) == bouncing_ball.ground_truth(frame.pts)
+
+
+# Test that the encoded sequence decodes back to the ball positions and is replayed with live pts
+def test_packet_cache():
+    import av
+    bouncing_ball = BouncingBallVideoStreamTrack(640, 480, 30, lazy=True)
+    packets = encode_sequence(bouncing_ball, keyframe_interval=10)
+    assert len(packets) == 30
+    decoder = av.CodecContext.create("libvpx", "r")
+    for index, packet in enumerate(packets):
+        frames = decoder.decode(av.Packet(packet))
+        x, y = find_ball(luma_plane(frames[0]))
+        expected_x, expected_y = bouncing_ball.coordinates[index]
+        assert x < expected_x + 10 and x > expected_x - 10
+        assert y < expected_y + 10 and y > expected_y - 10
+
+    track = PacketTrack(packets, bouncing_ball.coordinates)
+
+    async def replay():
+        return [await track.recv() for _ in range(32)]
+
+    replayed = asyncio.run(replay())
+    # the sequence wraps around to its first frame
+    assert bytes(replayed[30]) == packets[0]
+    assert replayed[31].pts > replayed[30].pts > replayed[29].pts
+    assert track.ground_truth(replayed[31].pts)[:2] == bouncing_ball.coordinates[1]
+
+
+# Test that the multi detector finds every ball and keeps following the same one with each track
+def test_multi_ball_tracker():
+    bouncing_ball = BouncingBallVideoStreamTrack(640, 480, 60, num_of_balls=5, seed=3)
+    tracker = MultiBallTracker()
+    followed = {}
+    for index in range(60):
+        bouncing_ball.counter = index
+        frame, positions = bouncing_ball.frame_at(index)
+        objects = tracker.find(luma_plane(frame.reformat(format="yuv420p")))
+        for x, y, track_id in objects:
+            distances = np.hypot(positions[:, 0] - x, positions[:, 1] - y)
+            assert distances.min() < 10
+            followed.setdefault(track_id, set()).add(int(distances.argmin()))
+    # balls that touch merge into one blob, which may restart their tracks, but no track swaps balls
+    assert all(len(balls) == 1 for balls in followed.values())
+    assert len(followed) < 10
+
+
+# Test the per-track scores of a tracked objects message
+def test_calculate_batch_error_tracks():
+    bouncing_ball = BouncingBallVideoStreamTrack(640, 480, 30, num_of_balls=3)
+    positions = bouncing_ball.coordinates[0]
+    bouncing_ball.record(0, positions)
+    bouncing_ball.record(3000, bouncing_ball.coordinates[1])
+    stats = ResultStats()
+    # track 7 is on ball 0, track 8 on ball 1, then track 7 jumps to ball 2, and an object nowhere near a ball
+    message = encode_batch([
+        (0, [(positions[0][0] + 3, positions[0][1] + 4, 7), (positions[1][0], positions[1][1], 8)]),
+        (3000, [tuple(bouncing_ball.coordinates[1][2]) + (7,), (-100, -100, 9)]),
+    ], tracks=True)
+    errors = calculate_batch_error(bouncing_ball, message, logger, stats)
+    assert errors == [5.0, 0.0, 0.0]
+    report = stats.report()
+    assert report["tracks"] == 2
+    assert report["id_switches"] == 1
+    assert report["false_positives"] == 1
+    assert report["missed_objects"] == 1 + 2
+    assert stats.track_report()[8] == {"frames": 1, "error_px_mean": 0.0, "id_switches": 0}
+    assert decode_batch(message)[1][1][1] == (-100, -100, 9)
+
+# Test the prediction of the ball's position, across wall bounces
+def test_alpha_beta_predictor():
+    bouncing_ball = BouncingBallVideoStreamTrack(640, 480, 300, lazy=True)
+    predictor = AlphaBetaPredictor(640, 480, 10)
+    assert predictor.predict(0) is None
+    errors = []
+    for index in range(290):
+        x, y = bouncing_ball.coordinates[index]
+        predictor.update(index * 3000, x, y)
+        if index >= 2 and index + 3 < 300:
+            # noise free detections, the prediction three frames ahead follows the ball through its bounces
+            errors.append(np.hypot(*np.subtract(predictor.predict((index + 3) * 3000), bouncing_ball.coordinates[index + 3])))
+    assert max(errors) <= 1
+    # the walls follow the size of the received frames, a scaled stream starts the filter over
+    predictor.set_frame_size(640, 480)
+    assert predictor.predict(290 * 3000) is not None
+    predictor.set_frame_size(320, 240)
+    assert predictor.predict(290 * 3000) is None
+    assert predictor.high.tolist() == [310, 230]
+
+# Test scoring predicted coordinates for a frame that was not sent yet, and the lag feedback
+def test_latency_compensation():
+    bouncing_ball = BouncingBallVideoStreamTrack(640, 480, 30)
+    for index in range(5):
+        bouncing_ball.record(index * 3000, bouncing_ball.coordinates[index])
+    stats = ResultStats()
+    x, y = bouncing_ball.coordinates[8]
+    assert calculate_coordinates_error(bouncing_ball, '[%d, %d, %d]' % (x + 1, y, 8 * 3000), logger, stats) == (-1, 0)
+    assert stats.report()["ahead"] == 1
+    assert stats.last_pts == 8 * 3000
+    assert "latency_ms_p50" not in stats.report()
+    # too far ahead to be a prediction
+    calculate_coordinates_error(bouncing_ball, '[0, 0, %d]' % (100 * 3000), logger, stats)
+    assert stats.unmatched == 1
+
+    compensator = LatencyCompensator(AlphaBetaPredictor(), update_every=2)
+    assert compensator.add(0, *bouncing_ball.coordinates[0]) == (0,) + bouncing_ball.coordinates[0]
+    assert compensator.add(3000, *bouncing_ball.coordinates[1]) is None
+    # the result for frame 0 arrived while the server was sending frame 4
+    assert compensator.feedback(*decode_feedback(encode_feedback(0, 4 * 3000))) == 4 * 3000
+    compensator.smoothing = 1
+    compensator.feedback(0, 4 * 3000)
+    pts, x, y = compensator.add(6000, *bouncing_ball.coordinates[2])
+    assert pts == 6 * 3000
+    assert np.hypot(x - bouncing_ball.coordinates[6][0], y - bouncing_ball.coordinates[6][1]) <= 1
+    assert compensator.feedback(123, 0) is None
+
+def _observe_detections(metrics):
+    for _ in range(100):
+        metrics.observe("detect", 0.002)
+
+# Test the per-stage histograms, also recorded from another process
+def test_metrics(tmp_path):
+    metrics = Metrics("client", ("detect", "send"))
+    process = Process(target=_observe_detections, args=(metrics,))
+    process.start()
+    process.join()
+    metrics.timed("send", time.sleep)(0.001)
+    metrics.mark(3000)
+    metrics.observe_since("send", 3000)
+    metrics.observe_since("send", 6000)
+    metrics.gauge("queue_depth", lambda: 2)
+    text = metrics.prometheus()
+    assert 'client_stage_seconds_count{stage="detect"} 100' in text
+    assert 'client_stage_seconds_bucket{stage="detect",le="0.0025"} 100' in text
+    assert 'client_stage_seconds_count{stage="send"} 2' in text
+    assert "client_queue_depth 2" in text
+    snapshot = metrics.snapshot()
+    assert snapshot["stages"]["detect"]["count"] == 100
+    assert 1 < snapshot["stages"]["detect"]["p50_ms"] <= 2.5
+    # the next snapshot only covers what happened since
+    assert metrics.snapshot()["stages"]["detect"]["count"] == 0
+    assert quantile((1, 2), [0, 0, 0], 0.5) is None
+
+    # several detector threads write the same stage at once without losing counts
+    threads = [threading.Thread(target=lambda: [metrics.observe("detect", 0.002) for _ in range(5000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(metrics.histograms["detect"].read()[0]) == 100 + 4 * 5000
+
+    # stopping the writer writes a last snapshot without waiting for the interval
+    path = str(tmp_path / "metrics.json")
+    write_snapshots(metrics, path, interval=60).set()
+    for _ in range(50):
+        if os.path.exists(path):
+            break
+        time.sleep(0.1)
+    with open(path) as file:
+        assert json.load(file)["stages"]["detect"]["count"] == 4 * 5000
+
+# Test the asynchronous logger with sampling and the JSON format
+def test_logging_sampling(tmp_path):
+    path = str(tmp_path / "sampled.log")
+    sampled = setup_logging("test_sampled", path, asynchronous=True, sampling="calculated_coordinates=10,channel=3/s", structured=True)
+    sampled.propagate = False
+    for i in range(100):
+        sampled.info("calculated_coordinates = %s", (i, i, True))
+        sampled.info("channel(%s) --> %s", "coordinates", i)
+    # the message is merged with its arguments when it is logged, not when it is written
+    objects = [1, 2]
+    sampled.info("received_objects = %s", objects)
+    objects.append(3)
+    sampled.info("received_bye_signal_exiting")
+    for handler in sampled.handlers:
+        sampled.removeHandler(handler)
+    deadline = time.time() + 5
+    while time.time() < deadline and "received_bye" not in open(path).read():
+        time.sleep(0.01)
+    lines = [json.loads(line) for line in open(path)]
+    assert [line["msg"] for line in lines if line["type"] == "calculated_coordinates"][:2] == [
+        "calculated_coordinates = (0, 0, True)", "calculated_coordinates = (10, 10, True)"]
+    assert sum(line["type"] == "calculated_coordinates" for line in lines) == 10
+    assert sum(line["type"] == "channel" for line in lines) <= 6
+    assert lines[-1]["type"] == "received_bye_signal_exiting"
+    assert lines[-2]["msg"] == "received_objects = [1, 2]"
+    with pytest.raises(ValueError):
+        parse_sampling("channel=0")
+
+    # detector threads share the counts of a filter
+    sampling = SamplingFilter(parse_sampling("calculated_coordinates=10"))
+    record = logging.LogRecord("test", logging.INFO, __file__, 0, "calculated_coordinates = %s", (1,), None)
+    kept = []
+    threads = [threading.Thread(target=lambda: kept.append(sum(sampling.filter(record) for _ in range(10000)))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(kept) == 4000
+
+# Test the streaming error statistics of a session
+def test_error_aggregator():
+    aggregate = ErrorAggregator()
+    for error_x, error_y in [(3, 4)] * 90 + [(-6, 8)] * 10:
+        aggregate.add(error_x, error_y)
+    aggregate.add_distance(20)
+    snapshot = aggregate.snapshot()
+    distance = snapshot["total"]["distance"]
+    assert distance["count"] == 101
+    assert distance["max"] == 20
+    assert 4.5 <= distance["p50"] <= 5.5
+    assert 9.5 <= distance["p99"] <= 10.5
+    x = snapshot["window"]["x"]
+    assert x["count"] == 100
+    assert x["mean"] == round((90 * 3 - 10 * 6) / 100, 3)
+    assert x["rmse"] == round(float(np.sqrt((90 * 9 + 10 * 36) / 100)), 3)
+    # a snapshot starts a new window, the totals go on
+    aggregate.add(1, 1)
+    snapshot = aggregate.snapshot()
+    assert snapshot["window"]["x"]["count"] == 1
+    assert snapshot["total"]["x"]["count"] == 101
+    assert aggregate.snapshot()["window"]["y"] == {"count": 0}
+
+# Test a client/server pair wired together in one event loop
+def test_loopback_pair():
+    summary = asyncio.run(run_loopback(1, 5, logger))
+    assert summary["pairs"] == 1
+    assert summary["received"] > 0
+    assert summary["unmatched"] == 0
+    assert summary["error_px_p50"] <= 10
+
+# Test that the stream steps down under load and back up, with hysteresis
+def test_rate_controller():
+    controller = RateController(min_fps=15, max_fps=30, min_scale=0.5)
+    assert controller.levels == [(1, 1.0), (2, 1.0), (2, 0.75), (2, 0.5)]
+    # a single overloaded report is not enough
+    assert not controller.update(200, 0)
+    assert not controller.update(20, 0.1)
+    assert not controller.update(20, 0.5)
+    assert controller.update(20, 0.5)
+    assert controller.fps == 15
+    for _ in range(6):
+        controller.update(500, 0.9)
+    assert (controller.stride, controller.scale) == (2, 0.5)
+    for _ in range(4):
+        assert not controller.update(10, 0)
+    assert controller.update(10, 0)
+    assert controller.scale == 0.75
+    with pytest.raises(ValueError):
+        RateController(min_fps=40)
+
+    dropped = Value('i', 0)
+    monitor = LoadMonitor(lambda: dropped.value)
+    for pts in range(0, 10 * 3000, 3000):
+        monitor.on_frame(pts)
+    time.sleep(0.05)
+    monitor.on_sent(3 * 3000)
+    dropped.value = 5
+    lag_ms, drop_rate = decode_load_report(encode_load_report(*monitor.report()))
+    assert 50 <= lag_ms < 500
+    assert drop_rate == 0.5
+    assert monitor.report() == (0, 0)
+    monitor.on_frame(10 * 3000)
+    # no result for the frames since the last report
+    assert monitor.report()[0] == 1000
+    assert decode_load_report('[1, 2, 3000]') is None
+    # other JSON objects are not load reports
+    assert decode_load_report(encode_feedback(3000, 6000)) is None
+    assert decode_load_report('{"lag_ms": 20}') is None
+    with pytest.raises(ValueError):
+        calculate_coordinates_error(BouncingBallVideoStreamTrack(640, 480, 1), '{"lag_ms": 20}', logger)
+    # only a server that asks for load reports is sent any
+    assert decode_report_request(encode_report_request(1.0)) == 1.0
+    assert decode_report_request(encode_feedback(3000, 6000)) is None
+    assert decode_report_request('[1, 2, 3000]') is None
+
+# Test a lower frame rate and resolution keep the ground truth of the sent frames
+def test_adapted_stream():
+    bouncing_ball = BouncingBallVideoStreamTrack(640, 480, 30)
+    controller = RateController(min_fps=10, min_scale=0.5)
+    for _ in range(2 * len(controller.levels)):
+        adapt_stream(bouncing_ball, controller, (500, 0.9), logger)
+    assert (bouncing_ball.stride, bouncing_ball.scale) == (3, 0.5)
+
+    async def receive():
+        return [await bouncing_ball.recv() for _ in range(3)]
+    frames = asyncio.run(receive())
+    assert [frame.pts for frame in frames] == [0, 9000, 18000]
+    assert (frames[1].width, frames[1].height) == (320, 240)
+    x, y = bouncing_ball.coordinates[3]
+    assert bouncing_ball.ground_truth(9000)[:2] == (x // 2, y // 2)
+    assert find_ball(frames[1].to_ndarray(format="bgr24")) == pytest.approx((x / 2, y / 2), abs=1)
+    bouncing_ball.stop()
+
+# Test the startup timings, the ready file and a client connecting to a server that listens before it sends
+def test_startup(tmp_path):
+    detector_ready = Value('d', 0.0)
+    timer = StartupTimer(start=time.time() - 1)
+    timer.watch("detector_ready", lambda: detector_ready.value)
+    timer.mark("first_frame")
+    timer.mark("first_frame", time.time() + 10)
+    timer.mark("imported", timer.start + 0.5)
+    assert list(timer.report()) == ["imported", "first_frame"]
+    detector_ready.value = timer.start + 0.75
+    report = timer.report()
+    assert list(report) == ["imported", "detector_ready", "first_frame"]
+    assert report["imported"] == 500
+    assert 1000 <= report["first_frame"] < 2000
+    assert StartupTimer().start <= time.time()
+
+    ready_file = str(tmp_path / "ready.json")
+    write_ready_file(ready_file, port=9000)
+    with open(ready_file) as file:
+        assert json.load(file) == {"port": 9000, "pid": os.getpid()}
+    assert os.listdir(tmp_path) == ["ready.json"]
+
+    async def exchange():
+        server = ListeningSignaling("127.0.0.1", 0)
+        await server.connect()
+        assert server.port != 0
+        client = TcpSocketSignaling("127.0.0.1", server.port)
+        # the client only connects when it receives, while the server's send waits for it
+        _, offer = await asyncio.gather(server.send(RTCSessionDescription("v=0", "offer")), client.receive())
+        await client.send(RTCSessionDescription("v=1", "answer"))
+        answer = await server.receive()
+        await client.close()
+        bye = await server.receive()
+        await server.close()
+        return offer, answer, bye
+    offer, answer, bye = asyncio.run(asyncio.wait_for(exchange(), 10))
+    assert (offer.type, offer.sdp) == ("offer", "v=0")
+    assert (answer.type, answer.sdp) == ("answer", "v=1")
+    assert bye is BYE
+
 
 # Run the tests
 if __name__ == "__main__":